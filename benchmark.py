@@ -0,0 +1,722 @@
+"""
+Benchmarks for scraper pipeline stages. Nothing here touches otomoto.pl.
+
+Usage:
+    python benchmark.py dedup --sizes 1000 10000 100000
+    python benchmark.py parse [--page saved_search_page.html]
+    python benchmark.py filter --pages 1000
+    python benchmark.py crawl --replay recordings [--latency 0.05]
+    python benchmark.py pricing --rows 100000
+    python benchmark.py export --rows 100000
+    python benchmark.py db --articles 100000
+    python benchmark.py memory --articles 100000
+    python benchmark.py insert --articles 100000
+
+Recordings for crawl benchmark are made with: python scraper.py --record recordings
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import pickle
+import tempfile
+import tracemalloc
+from lxml import html
+import numpy as np
+import pandas as pd
+import xlsxwriter
+from decimal import Decimal
+from hashlib import md5
+import random
+import resource
+import time
+from aiohttp import web
+
+import export
+from metrics import REGISTRY
+from models import Base, CarArticle, Dictionary, Phone, article_key
+import report
+from utils import DictionaryCache, setup_db, get_cc_value, cc_value_vector
+import scraper
+import session as http_session
+
+MANUFACTURERS = ('audi', 'bmw', 'opel', 'skoda', 'toyota', 'volkswagen', 'ford', 'renault')
+FUEL_TYPES = ('benzyna', 'diesel', 'benzyna+lpg', 'hybryda')
+PRICE_DETAILS = (('brutto', 'donegocjacji'), ('netto', 'fakturavat'), ('brutto',), ('netto',))
+
+
+def make_articles(count: int, seed: int = 0) -> list:
+    """
+    Generate synthetic parsed articles with phones.
+    """
+    rnd = random.Random(seed)
+    articles = []
+    for i in range(count):
+        link = 'https://www.otomoto.pl/oferta/car-ID{}.html'.format(md5(str(i).encode()).hexdigest()[:8])
+        articles.append(scraper.Article(
+            name='model {}'.format(i % 500),
+            manufacturer=rnd.choice(MANUFACTURERS),
+            price=Decimal(rnd.randint(1000, 200000)).quantize(Decimal('.00')),
+            currency='pln',
+            price_detail=rnd.choice(PRICE_DETAILS),
+            item_year=datetime.datetime(rnd.randint(1995, 2017), 1, 1),
+            item_mileage=rnd.randint(0, 400000),
+            item_engine_capacity=rnd.choice((1.2, 1.4, 1.6, 2.0, 2.5, 3.0)),
+            item_fuel_type=rnd.choice(FUEL_TYPES),
+            link=link,
+            seller_location='warszawa',
+            seller_id=link[-13:-5],
+            phones=['600000{:03d}'.format(i % 1000)],
+        ))
+    return articles
+
+
+ARTICLE_HTML = """
+<article class="offer-item">
+  <div class="offer-item__content">
+    <div class="offer-item__title">
+      <h2><a href="https://www.otomoto.pl/oferta/{manufacturer}-model-ID{seller_id}.html#{anchor}">
+        {manufacturer} model {index}</a></h2>
+    </div>
+    <ul class="offer-item__params">
+      <li data-code="year"><span>{year}</span></li>
+      <li data-code="mileage"><span>{mileage} km</span></li>
+      <li data-code="engine_capacity"><span>{capacity} cm3</span></li>
+      <li data-code="fuel_type"><span>{fuel}</span></li>
+    </ul>
+    <div class="offer-item__price">
+      <div class="offer-price">
+        <span class="offer-price__number">{price} <span class="offer-price__currency">PLN</span></span>
+        <span class="offer-price__details">{details}</span>
+      </div>
+    </div>
+    <div class="offer-item__bottom-row ">
+      <span class="offer-item__location"><h4>Warszawa <em>(Mazowieckie)</em></h4></span>
+    </div>
+  </div>
+</article>
+"""
+
+
+def make_page(count: int = 32, seed: int = 0) -> str:
+    """
+    Generate search page with the same markup as otomoto.pl search results.
+    """
+    rnd = random.Random(seed)
+    articles = []
+    for i in range(count):
+        articles.append(ARTICLE_HTML.format(
+            manufacturer=rnd.choice(MANUFACTURERS),
+            seller_id=md5(str(i).encode()).hexdigest()[:8],
+            anchor=md5(str(-i).encode()).hexdigest()[:8],
+            index=i,
+            year=rnd.randint(1995, 2017),
+            mileage='{:,}'.format(rnd.randint(0, 400000)).replace(',', ' '),
+            capacity='{:,}'.format(rnd.choice((1198, 1390, 1598, 1968, 2494))).replace(',', ' '),
+            fuel=rnd.choice(FUEL_TYPES),
+            price='{:,}'.format(rnd.randint(1000, 200000)).replace(',', ' '),
+            details=rnd.choice(('Do negocjacji, Brutto', 'Faktura VAT, Netto', 'Brutto')),
+        ))
+    return '<html><body><div class="offers list">{}</div></body></html>'.format(''.join(articles))
+
+
+def legacy_extract(page_content: str) -> list:
+    """
+    Articles extraction as it was done before: string paths re-walked for every field.
+    """
+    result = []
+    root = html.fromstring(page_content)
+    for article in root.xpath('//article'):
+        name = article.findtext('./div[@class="offer-item__content"]/div[@class="offer-item__title"]/h2/a')
+        link = article.find('./div[@class="offer-item__content"]/div[@class="offer-item__title"]/h2/a').attrib['href']
+        offer_detail = article.find('./div[@class="offer-item__content"]/div[@class="offer-item__price"]/'
+                                    'div[@class="offer-price"]')
+        price = offer_detail.findtext('./span[@class="offer-price__number"]')
+        currency = offer_detail.findtext('./span[@class="offer-price__number"]/span[@class="offer-price__currency"]')
+        price_detail = offer_detail.findtext('./span[@class="offer-price__details"]')
+        item_params = article.find('./div[@class="offer-item__content"]/ul[@class="offer-item__params"]')
+        item_year = item_params.findtext('./li[@data-code="year"]/span')
+        item_mileage = item_params.findtext('./li[@data-code="mileage"]/span')
+        item_engine_capacity = item_params.findtext('./li[@data-code="engine_capacity"]/span')
+        item_fuel_type = item_params.findtext('./li[@data-code="fuel_type"]/span')
+        location_temp = article.xpath('./div[@class="offer-item__content"]'
+                                      '/div[contains(@class, "offer-item__bottom-row ")]')
+        location = ''
+        if location_temp:
+            location = location_temp[0].findtext('./span[@class="offer-item__location"]/h4')
+        result.append((name, price, currency, price_detail, item_year, item_mileage,
+                       item_engine_capacity, item_fuel_type, link, location))
+    return result
+
+
+def compiled_extract(page_content: str) -> list:
+    root = html.fromstring(page_content)
+    return [scraper.extract_article(article) for article in scraper.XPATH_ARTICLES(root)]
+
+
+def legacy_insert(session, collection, ids_pool):
+    """
+    Per-article dedup as it was done before: list lookup and one SELECT per article.
+    """
+    ins_counter = 0
+    for article in collection:
+        article_id = article_key(article.link)
+        if article_id in ids_pool:
+            continue
+        ids_pool.append(article_id)
+        if not session.query(CarArticle).get(article_id):
+            ins_counter += 1
+            session.add(CarArticle(**scraper.article_row(article_id, article, DictionaryCache.of(session))))
+    session.flush()
+    return ins_counter
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_dedup(sizes, legacy_limit):
+    print('{:>8} {:>12} {:>12}'.format('articles', 'set+IN (s)', 'legacy (s)'))
+    for size in sizes:
+        articles = make_articles(size)
+        # half of articles already stored, quarter of articles repeated within run
+        preload = articles[:size // 2]
+        incoming = articles + articles[:size // 4]
+
+        results = []
+        for insert_func, pool_type in ((scraper.db_insert, set), (legacy_insert, list)):
+            if insert_func is legacy_insert and size > legacy_limit:
+                results.append(None)
+                continue
+            session = setup_db(db_url='sqlite://')
+            scraper.db_insert(session, preload, set())
+            session.commit()
+            _, elapsed = timed(insert_func, session, incoming, pool_type())
+            session.close()
+            results.append(elapsed)
+
+        print('{:>8} {:>12.3f} {:>12}'.format(size, results[0],
+                                             '-' if results[1] is None else '{:.3f}'.format(results[1])))
+
+
+def bench_parse(page_path, repeat):
+    if page_path:
+        with open(page_path, encoding='utf-8') as page_file:
+            page = page_file.read()
+    else:
+        page = make_page()
+
+    legacy = legacy_extract(page)
+    compiled = compiled_extract(page)
+    if legacy != compiled:
+        print('WARNING: extractors results differ')
+
+    print('{} articles on page, {} repeats'.format(len(compiled), repeat))
+    for title, func in (('legacy', legacy_extract), ('compiled', compiled_extract)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func(page)
+        elapsed = time.perf_counter() - start
+        print('{:>10}: {:.3f} ms per page'.format(title, elapsed / repeat * 1000))
+
+
+def bench_filter(pages):
+    rows = []
+    for seed in range(pages):
+        rows.extend(compiled_extract(make_page(seed=seed)))
+
+    article_filter = scraper.FilterArticle()
+    normalizers = ('strip_cached', 'parse_price_detail', 'parse_year', 'parse_engine_capacity')
+    cached = {name: getattr(scraper.FilterArticle, name) for name in normalizers}
+
+    # rows are filtered one by one in both cases, the difference is lru_cache of normalizers only
+    for name, normalizer in cached.items():
+        setattr(scraper.FilterArticle, name, staticmethod(normalizer.__wrapped__))
+    try:
+        start = time.perf_counter()
+        uncached = [article_filter.get_dict(*row) for row in rows]
+        uncached_elapsed = time.perf_counter() - start
+    finally:
+        for name, normalizer in cached.items():
+            setattr(scraper.FilterArticle, name, staticmethod(normalizer))
+
+    start = time.perf_counter()
+    batch = article_filter.filter_many(rows)
+    batch_elapsed = time.perf_counter() - start
+
+    print('{} articles, results {}'.format(len(rows), 'identical' if uncached == batch else 'DIFFER'))
+    for title, elapsed in (('uncached', uncached_elapsed), ('cached', batch_elapsed)):
+        print('{:>12}: {:.3f} s, {:.0f} articles/s'.format(title, elapsed, len(rows) / elapsed))
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def bench_crawl(replay_path, latency, limit, pages_limit):
+    # default scraper.py search arguments
+    search_args = (0, 0, datetime.datetime(1990, 1, 1), datetime.datetime(datetime.date.today().year, 1, 1),
+                   0, 0, '', 0)
+    crawler = scraper.Scraper(*search_args, limit=limit, pages_limit=pages_limit,
+                              replay=replay_path, replay_latency=latency)
+    REGISTRY.reset()
+
+    # registry histograms give only bucket estimates, exact latencies are collected for percentiles
+    samples = {}
+    observe = REGISTRY.observe
+
+    def observe_sample(name, seconds, **labels):
+        samples.setdefault(name, []).append(seconds)
+        observe(name, seconds, **labels)
+
+    REGISTRY.observe = observe_sample
+    try:
+        data, crawl_elapsed = timed(crawler.start)
+    finally:
+        del REGISTRY.observe
+
+    session = setup_db(db_url='sqlite://')
+    _, db_elapsed = timed(scraper.db_fill, session, data)
+    session.close()
+
+    collections = [collection for collection in data if isinstance(collection, list)]
+    pages = len(collections)
+    articles = sum(len(collection) for collection in collections)
+    requests = len(samples.get('fetch', ()))
+    total = crawl_elapsed + db_elapsed
+
+    print('pages: {}, articles: {}, requests: {}, not recorded: {}'.format(
+        pages, articles, requests, crawler.replay.missed))
+    print('crawl: {:.3f} s, db_fill: {:.3f} s'.format(crawl_elapsed, db_elapsed))
+    print('pages/s: {:.1f}, articles/s: {:.1f}'.format(pages / total, articles / total))
+    for name, values in sorted(samples.items()):
+        print('{}: {} calls, p50 {:.1f} ms, p99 {:.1f} ms, total {:.3f} s'.format(
+            name, len(values), percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000, sum(values)))
+    # ru_maxrss is in kilobytes on Linux
+    print('peak RSS: {:.1f} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def fixed_rate(rate):
+    """
+    Currency object with constant rate, the same interface as get_ukr_rates() result.
+    """
+    def inner(amount, cur_from, buy=True):
+        return round(rate * amount, 2)
+    inner.rate = lambda cur_from, buy=True: rate
+    return inner
+
+
+def bench_pricing(rows):
+    rnd = np.random.RandomState(0)
+    value = rnd.uniform(500, 100000, rows).round(2)
+    capacity = rnd.choice([0.9, 1.0, 1.2, 1.5, 1.6, 2.0, 2.2, 2.5, 3.0, 4.4], rows)
+    engine_type = rnd.choice(['benzine', 'diesel'], rows).astype(object)
+    year = rnd.randint(1995, datetime.date.today().year + 1, rows)
+    cur_ukr = fixed_rate(31.2)
+
+    start = time.perf_counter()
+    scalar = [get_cc_value(*args, cur_ukr) for args in zip(value, capacity, engine_type, year)]
+    scalar_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vector = cc_value_vector(value, capacity, engine_type, year, cur_ukr.rate('eur'))
+    vector_elapsed = time.perf_counter() - start
+
+    print('{} rows, results {}'.format(rows, 'identical' if np.array_equal(scalar, vector) else 'DIFFER'))
+    print('  scalar: {:.3f} s'.format(scalar_elapsed))
+    print('  vector: {:.3f} s'.format(vector_elapsed))
+
+
+def make_report_frame(rows):
+    articles = make_articles(rows)
+    now = datetime.datetime.now()
+    df = pd.DataFrame({
+        'name': [article.name for article in articles],
+        'manufacturer': [article.manufacturer for article in articles],
+        'year': [article.item_year.year for article in articles],
+        'mileage': [article.item_mileage for article in articles],
+        'engine_capacity': [article.item_engine_capacity for article in articles],
+        'engine_type': [article.item_fuel_type for article in articles],
+        'value': [float(article.price) for article in articles],
+        'currency': [article.currency for article in articles],
+        'negotiation': ['donegocjacji' in article.price_detail for article in articles],
+        'netto': ['netto' in article.price_detail for article in articles],
+        'brutto': ['brutto' in article.price_detail for article in articles],
+        'vat': ['fakturavat' in article.price_detail for article in articles],
+        'location': [article.seller_location for article in articles],
+        'link': [article.link for article in articles],
+        'record_created': [now - datetime.timedelta(minutes=i) for i in range(rows)],
+    })
+    for column in ('price_eur', 'price_real', 'customs_clearing', 'price_total'):
+        df[column] = df['value'] * 0.24
+    return df, now - datetime.timedelta(minutes=rows // 10)
+
+
+def legacy_export(df, filename, last_start):
+    """
+    Export as it was done before: new Format for every cell, iterrows and A1 notation.
+    """
+    workbook = xlsxwriter.Workbook(filename, {'nan_inf_to_errors': True, 'remove_timezone': True})
+    worksheet = workbook.add_worksheet('page#1')
+    letters = [chr(ord('A') + i) for i in range(len(export.COLUMNS))]
+    index = 2
+    for _, row in df.iterrows():
+        color = '#00C7CE' if last_start < row['record_created'] else None
+        for letter, (_, field, _, cell_type, base) in zip(letters, export.COLUMNS):
+            cell_format = workbook.add_format(export.BASE_FORMATS[base])
+            if color:
+                cell_format.set_bg_color(color)
+            value = row[field]
+            cell = '{}{}'.format(letter, index)
+            if cell_type == 'url':
+                worksheet.write_url(cell, value, cell_format, string='link')
+            elif cell_type == 'boolean':
+                worksheet.write_boolean(cell, value, cell_format)
+            elif cell_type == 'datetime':
+                worksheet.write_datetime(cell, value, cell_format)
+            else:
+                worksheet.write(cell, value, cell_format)
+        index += 1
+    workbook.close()
+
+
+def bench_export(rows, legacy_limit):
+    df, last_start = make_report_frame(rows)
+
+    variants = (
+        ('cached', lambda name: export.export_xlsx(df, name, last_start=last_start)),
+        ('constant_memory', lambda name: export.export_xlsx(df, name, last_start=last_start, constant_memory=True)),
+        ('legacy', lambda name: legacy_export(df, name, last_start)),
+    )
+
+    print('{} rows'.format(rows))
+    print('{:>16} {:>10} {:>14} {:>12}'.format('exporter', 'time (s)', 'peak mem (MB)', 'size (MB)'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for title, func in variants:
+            if title == 'legacy' and rows > legacy_limit:
+                continue
+            filename = os.path.join(tmp_dir, title + '.xlsx')
+            _, elapsed = timed(func, filename)
+            # separate run for memory, tracemalloc slows allocations down a lot
+            tracemalloc.start()
+            func(filename)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('{:>16} {:>10.2f} {:>14.1f} {:>12.2f}'.format(title, elapsed, peak / 1024 ** 2,
+                                                               os.path.getsize(filename) / 1024 ** 2))
+
+
+def bench_db(count, batch_size, repeat):
+    articles = make_articles(count)
+    since = datetime.datetime.now() - datetime.timedelta(days=1)
+    queries = (
+        ('manufacturer+year', lambda session: report.report_query(session, manufacturer=['audi'],
+                                                                  year_from=2005, year_to=2010).count()),
+        ('record_created', lambda session: report.report_query(session, since=since).count()),
+        ('seller_id', lambda session: session.query(CarArticle).filter(
+            CarArticle.seller_id == articles[count // 2].seller_id).count()),
+        ('phones join', lambda session: session.query(Phone).join(CarArticle, Phone.car_id == CarArticle.id).join(
+            Dictionary, CarArticle.manufacturer_id == Dictionary.id).filter(Dictionary.value == 'bmw').count()),
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for tuned in (False, True):
+            session = setup_db(db_url='sqlite:///' + os.path.join(tmp_dir, 'tuned_{}.db'.format(tuned)), tune=tuned)
+            if not tuned:
+                for table in Base.metadata.sorted_tables:
+                    for index in table.indexes:
+                        index.drop(session.bind)
+
+            start = time.perf_counter()
+            ids_pool = set()
+            for i in range(0, count, batch_size):
+                scraper.db_insert(session, articles[i:i + batch_size], ids_pool)
+                session.commit()
+            insert_elapsed = time.perf_counter() - start
+
+            print('{}: {:.0f} articles/s inserted (commit every {})'.format(
+                'pragmas+indexes' if tuned else 'default', count / insert_elapsed, batch_size))
+            for title, query in queries:
+                elapsed = []
+                for _ in range(repeat):
+                    _, query_elapsed = timed(query, session)
+                    elapsed.append(query_elapsed)
+                print('  {:>18}: {:.2f} ms'.format(title, percentile(elapsed, 0.5) * 1000))
+            session.close()
+            session.bind.dispose()
+
+
+def bench_history(count, changed, batch_size):
+    """
+    Second run over the same articles with part of prices changed.
+    """
+    stored = make_articles(count)
+    articles = make_articles(count)
+    rnd = random.Random(1)
+    for i in rnd.sample(range(count), int(count * changed)):
+        articles[i] = articles[i]._replace(price=articles[i].price - 100)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        session = setup_db(db_url='sqlite:///' + os.path.join(tmp_dir, 'history.db'))
+        for i in range(0, count, batch_size):
+            scraper.db_insert(session, stored[i:i + batch_size], set())
+        session.commit()
+
+        start = time.perf_counter()
+        ids_pool = set()
+        updated = 0
+        for i in range(0, count, batch_size):
+            updated += scraper.db_insert(session, articles[i:i + batch_size], ids_pool)[1]
+            session.commit()
+        elapsed = time.perf_counter() - start
+
+        print('{} articles, {} price changes: {:.2f} s ({:.0f} articles/s)'.format(
+            count, updated, elapsed, count / elapsed))
+        session.close()
+        session.bind.dispose()
+
+
+def orm_write(session, new_articles):
+    """
+    Insert of the original db_fill: bulk_save_objects of CarArticle and Phone objects.
+    bulk_save_objects doesn't follow the car relationship, so car_id of phones is set explicitly.
+    """
+    dictionary = DictionaryCache.of(session)
+    articles = []
+    phones = []
+    for article_id, article in new_articles.items():
+        articles.append(CarArticle(**scraper.article_row(article_id, article, dictionary)))
+        for phone in article.phones:
+            phone_obj = Phone(phone, None)
+            phone_obj.car_id = article_id
+            phones.append(phone_obj)
+    session.bulk_save_objects(articles)
+    session.bulk_save_objects(phones)
+    return len(new_articles)
+
+
+def bench_insert(count, batch_size):
+    """
+    Insert of new articles with phones, commit every batch_size articles.
+    Dedup lookups are left out, so only the insert path is compared.
+    """
+    # synthetic links could repeat
+    articles = list({article_key(article.link): article for article in make_articles(count)}.items())
+    count = len(articles)
+    batches = [dict(articles[i:i + batch_size]) for i in range(0, count, batch_size)]
+
+    print('{} articles, commit every {}'.format(count, batch_size))
+    print('{:>8} {:>10} {:>14} {:>10}'.format('path', 'time (s)', 'articles/s', 'speedup'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        timings = {}
+        for title, write, raw_insert in (('orm', orm_write, False), ('core', scraper.db_write, False),
+                                         ('sqlite3', scraper.db_write, True)):
+            session = setup_db(db_url='sqlite:///' + os.path.join(tmp_dir, '{}.db'.format(title)),
+                               raw_insert=raw_insert)
+            start = time.perf_counter()
+            for batch in batches:
+                write(session, batch)
+                session.commit()
+            elapsed = time.perf_counter() - start
+
+            stored = session.query(CarArticle).count(), session.query(Phone).filter(Phone.car_id.isnot(None)).count()
+            if stored != (count, count):
+                print('WARNING: {} stored {} articles and {} linked phones'.format(title, *stored))
+            session.close()
+            session.bind.dispose()
+
+            timings[title] = elapsed
+            print('{:>8} {:>10.2f} {:>14.0f} {:>9.1f}x'.format(title, elapsed, count / elapsed,
+                                                                timings['orm'] / elapsed))
+
+    print('sqlite3 over core: {:.1f}x'.format(timings['core'] / timings['sqlite3']))
+
+
+def legacy_articles(page_articles):
+    """
+    Parsed articles as they were kept before: dict per article with price details and phones lists.
+    """
+    articles = []
+    for article in page_articles:
+        article_data = dict(zip(scraper.FilterArticle.FILTER_FIELDS, article))
+        article_data['price_detail'] = list(article.price_detail)
+        article_data['phones'] = []
+        articles.append(article_data)
+    return articles
+
+
+def bench_memory(count):
+    """
+    Memory held by parsed articles of a run until they are written to DB.
+    Pages are pickled as results of parse worker process are.
+    """
+    pages = []
+    for seed in range(0, count, 32):
+        page_articles, _ = scraper.parse_articles(make_page(min(32, count - seed), seed=seed))
+        pages.append(pickle.dumps(page_articles))
+
+    representations = (
+        ('dicts', lambda: [article for page in pages for article in legacy_articles(pickle.loads(page))]),
+        ('records', lambda: [article for page in pages for article in pickle.loads(page)]),
+        ('compact records', lambda: [scraper.compact_article(article)
+                                     for page in pages for article in pickle.loads(page)]),
+    )
+
+    print('{} articles'.format(count))
+    print('{:>16} {:>10} {:>12} {:>16}'.format('representation', 'time (s)', 'memory (MB)', 'bytes/article'))
+    for title, build in representations:
+        articles, elapsed = timed(build)
+        del articles
+
+        tracemalloc.start()
+        articles = build()
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del articles
+
+        print('{:>16} {:>10.2f} {:>12.1f} {:>16.0f}'.format(title, elapsed, held / 1024 ** 2, held / count))
+
+
+async def rate_server(capacity: float, port: int):
+    """
+    Local server allowing `capacity` requests per second: 429 above it, latency grows with load.
+    """
+    window = []
+
+    async def handle(request):
+        now = time.monotonic()
+        window.append(now)
+        while window and window[0] < now - 1.0:
+            window.pop(0)
+        if len(window) > capacity:
+            return web.Response(status=429)
+        await asyncio.sleep(0.02 * (1 + len(window) / capacity))
+        return web.Response(text='ok')
+
+    app = web.Application()
+    app.router.add_get('/{tail:.*}', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+async def rate_client(capacity, duration, concurrency, port):
+    runner = await rate_server(capacity, port)
+    limiter = http_session.RateLimiter(rate=5.0)
+    session = http_session.GSession(limit=concurrency, retries=0, rate_limiter=limiter)
+    statuses = []
+
+    async def worker(deadline):
+        while time.monotonic() < deadline:
+            response = await session.get('http://127.0.0.1:{}/page'.format(port))
+            statuses.append(response.status)
+
+    start = time.monotonic()
+    tasks = [asyncio.ensure_future(worker(start + duration)) for _ in range(concurrency)]
+    print('{:>6} {:>12} {:>10} {:>8}'.format('time', 'rate (1/s)', 'ok (1/s)', '429'))
+    done = 0
+    while not all(task.done() for task in tasks):
+        await asyncio.sleep(1.0)
+        recent = statuses[done:]
+        done = len(statuses)
+        print('{:>6.0f} {:>12.1f} {:>10} {:>8}'.format(time.monotonic() - start, sum(limiter.rates().values()),
+                                                   recent.count(200), recent.count(429)))
+    await asyncio.gather(*tasks)
+    await session.close()
+    await runner.cleanup()
+
+
+def bench_rate(capacity, duration, concurrency, port):
+    asyncio.get_event_loop().run_until_complete(rate_client(capacity, duration, concurrency, port))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    subparsers = arg_parser.add_subparsers(dest='bench')
+
+    dedup_parser = subparsers.add_parser('dedup', help='db_insert dedup and insert scaling')
+    dedup_parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000])
+    dedup_parser.add_argument('--legacy_limit', type=int, default=10000,
+                              help='Skip legacy implementation above this size (it is quadratic)')
+
+    parse_parser = subparsers.add_parser('parse', help='search page extraction time')
+    parse_parser.add_argument('--page', help='Saved search page, synthetic 32 articles page by default')
+    parse_parser.add_argument('--repeat', type=int, default=500)
+
+    filter_parser = subparsers.add_parser('filter', help='FilterArticle throughput with and without normalizers caches')
+    filter_parser.add_argument('--pages', type=int, default=1000, help='Number of synthetic 32 articles pages')
+
+    crawl_parser = subparsers.add_parser('crawl', help='Scraper.run + db_fill on recorded responses')
+    crawl_parser.add_argument('--replay', required=True, help='Recordings directory')
+    crawl_parser.add_argument('--latency', type=float, default=0.0, help='Artificial response delay in seconds')
+    crawl_parser.add_argument('--limit', type=int, default=50, help='Max number of simultaneous requests')
+    crawl_parser.add_argument('--pages_limit', type=int, default=500)
+
+    pricing_parser = subparsers.add_parser('pricing', help='customs clearing calculation, scalar vs vectorized')
+    pricing_parser.add_argument('--rows', type=int, default=100000)
+
+    export_parser = subparsers.add_parser('export', help='xlsx export time, memory and file size')
+    export_parser.add_argument('--rows', type=int, default=100000)
+    export_parser.add_argument('--legacy_limit', type=int, default=20000,
+                               help='Skip legacy exporter above this size')
+
+    db_parser = subparsers.add_parser('db', help='insert throughput and report queries latency, '
+                                                 'default SQLite vs pragmas and indexes')
+    db_parser.add_argument('--articles', type=int, default=100000)
+    db_parser.add_argument('--batch_size', type=int, default=500)
+    db_parser.add_argument('--repeat', type=int, default=20)
+
+    history_parser = subparsers.add_parser('history', help='price changes detection on repeated crawl')
+    history_parser.add_argument('--articles', type=int, default=100000)
+    history_parser.add_argument('--changed', type=float, default=0.1, help='Share of articles with changed price')
+    history_parser.add_argument('--batch_size', type=int, default=500)
+
+    memory_parser = subparsers.add_parser('memory', help='memory held by parsed articles, dicts vs records')
+    memory_parser.add_argument('--articles', type=int, default=100000)
+
+    insert_parser = subparsers.add_parser('insert', help='insert throughput of ORM bulk_save_objects, Core and sqlite3 paths')
+    insert_parser.add_argument('--articles', type=int, default=100000)
+    insert_parser.add_argument('--batch_size', type=int, default=5000, help='Articles per transaction')
+
+    rate_parser = subparsers.add_parser('rate', help='adaptive rate limiter against local server with fixed capacity')
+    rate_parser.add_argument('--capacity', type=float, default=50, help='Requests per second served without 429')
+    rate_parser.add_argument('--duration', type=float, default=30)
+    rate_parser.add_argument('--concurrency', type=int, default=50)
+    rate_parser.add_argument('--port', type=int, default=8765)
+
+    args = arg_parser.parse_args()
+
+    if args.bench == 'dedup':
+        bench_dedup(args.sizes, args.legacy_limit)
+    elif args.bench == 'parse':
+        bench_parse(args.page, args.repeat)
+    elif args.bench == 'filter':
+        bench_filter(args.pages)
+    elif args.bench == 'crawl':
+        bench_crawl(args.replay, args.latency, args.limit, args.pages_limit)
+    elif args.bench == 'pricing':
+        bench_pricing(args.rows)
+    elif args.bench == 'export':
+        bench_export(args.rows, args.legacy_limit)
+    elif args.bench == 'db':
+        bench_db(args.articles, args.batch_size, args.repeat)
+    elif args.bench == 'history':
+        bench_history(args.articles, args.changed, args.batch_size)
+    elif args.bench == 'memory':
+        bench_memory(args.articles)
+    elif args.bench == 'insert':
+        bench_insert(args.articles, args.batch_size)
+    elif args.bench == 'rate':
+        bench_rate(args.capacity, args.duration, args.concurrency, args.port)
+    else:
+        arg_parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import datetime
+import pandas as pd
+import xlsxwriter
+
+NEW_ROW_COLOR = '#00C7CE'
+
+BASE_FORMATS = {
+    'title': {'bold': True, 'align': 'center', 'valign': 'vcenter'},
+    'normal': {'align': 'center', 'valign': 'vcenter'},
+    'numeric': {'num_format': '#.0#', 'align': 'center', 'valign': 'vcenter'},
+    'capacity': {'num_format': '0.0#', 'align': 'center', 'valign': 'vcenter'},
+    'datetime': {'num_format': 'yy-mm-dd hh:mm:ss', 'align': 'center', 'valign': 'vcenter'},
+}
+
+# (title, DataFrame column, width, cell type, base format)
+COLUMNS = (
+    ('Name', 'name', 20, 'write', 'normal'),
+    ('Manufacturer', 'manufacturer', 15, 'write', 'normal'),
+    ('Year', 'year', 12, 'write', 'normal'),
+    ('Mileage', 'mileage', 15, 'write', 'normal'),
+    ('Engine cap.', 'engine_capacity', 12, 'write', 'capacity'),
+    ('Engine type', 'engine_type', 15, 'write', 'normal'),
+
+    ('Value', 'value', 20, 'write', 'numeric'),
+    ('Currency', 'currency', 12, 'write', 'normal'),
+
+    ('Negotiation', 'negotiation', 12, 'boolean', 'normal'),
+    ('Netto', 'netto', 12, 'boolean', 'normal'),
+    ('Brutto', 'brutto', 12, 'boolean', 'normal'),
+    ('VAT', 'vat', 12, 'boolean', 'normal'),
+
+    ('Price (EUR)', 'price_eur', 20, 'write', 'numeric'),
+    ('Price (EUR, VAT refund)', 'price_real', 20, 'write', 'numeric'),
+    ('Customs fee (EUR)', 'customs_clearing', 20, 'write', 'numeric'),
+    ('Total price', 'price_total', 20, 'write', 'numeric'),
+
+    ('Location', 'location', 20, 'write', 'normal'),
+    ('Link', 'link', 12, 'url', 'normal'),
+    ('DB date', 'record_created', 20, 'datetime', 'datetime'),
+)
+
+
+class FormatCache(object):
+    """
+    Workbook formats by (base format, background color). Every combination is created once,
+    so styles table of workbook stays small whatever the number of rows.
+    """
+
+    def __init__(self, workbook, base_formats=BASE_FORMATS):
+        self.workbook = workbook
+        self.base_formats = base_formats
+        self.formats = {}
+
+    def get(self, name, color=None):
+        key = (name, color)
+        cell_format = self.formats.get(key)
+        if cell_format is None:
+            properties = dict(self.base_formats[name])
+            if color:
+                properties['bg_color'] = color
+            cell_format = self.workbook.add_format(properties)
+            self.formats[key] = cell_format
+        return cell_format
+
+
+class XlsxExport(object):
+    """
+    Articles report writer. Rows are written in order with integer coordinates,
+    so it works in constant_memory mode and could get DataFrame chunks one by one.
+    """
+
+    def __init__(self, filename, last_start=None, constant_memory=False):
+        """
+        :param filename: output file
+        :param last_start: rows created after this time are highlighted
+        :param constant_memory: flush every row to disk instead of keeping whole sheet in memory
+        """
+        self.workbook = xlsxwriter.Workbook(filename, {
+            'constant_memory': constant_memory,
+            'nan_inf_to_errors': True,
+            'remove_timezone': True,
+        })
+        self.worksheet = self.workbook.add_worksheet('page#1')
+        self.formats = FormatCache(self.workbook)
+        self.last_start = last_start
+        self.row = 0
+
+        cell_writers = {
+            'write': self.worksheet.write,
+            'boolean': lambda row, col, value, cell_format: self.worksheet.write_boolean(row, col, bool(value),
+                                                                                       cell_format),
+            'url': lambda row, col, value, cell_format: self.worksheet.write_url(row, col, value, cell_format,
+                                                                               string='link'),
+            'datetime': self.worksheet.write_datetime,
+        }
+        self.cell_writers = [cell_writers[cell_type] for _, _, _, cell_type, _ in COLUMNS]
+        self.plain_formats = [self.formats.get(base) for _, _, _, _, base in COLUMNS]
+        self.new_formats = [self.formats.get(base, NEW_ROW_COLOR) for _, _, _, _, base in COLUMNS]
+
+        self.write_header()
+
+    def write_header(self):
+        title_format = self.formats.get('title')
+        for col, (title, _, width, _, _) in enumerate(COLUMNS):
+            self.worksheet.set_column(col, col, width)
+            self.worksheet.write_string(0, col, title, title_format)
+        self.row = 1
+
+    def write_rows(self, df):
+        if df.empty:
+            return
+
+        columns = [df[field].tolist() for _, field, _, _, _ in COLUMNS]
+
+        if self.last_start is not None:
+            is_new = (df['record_created'] > self.last_start).tolist()
+        else:
+            is_new = [False] * len(df)
+
+        write_blank = self.worksheet.write_blank
+        cells = list(zip(self.cell_writers, self.plain_formats, self.new_formats, columns))
+        row = self.row
+        for idx, new in enumerate(is_new):
+            for col, (write_cell, plain_format, new_format, values) in enumerate(cells):
+                cell_format = new_format if new else plain_format
+                value = values[idx]
+                # None, NaN and NaT
+                if value is None or value != value:
+                    write_blank(row, col, None, cell_format)
+                else:
+                    write_cell(row, col, value, cell_format)
+            row += 1
+        self.row = row
+
+    def close(self):
+        self.workbook.close()
+
+
+class CsvExport(object):
+    """
+    Articles report writer to CSV, the same columns and write_rows/close interface as XlsxExport.
+    New rows aren't marked, CSV has no cell formats.
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'w', encoding='utf-8', newline='')
+        self.header = True
+
+    def write_rows(self, df):
+        frame = pd.DataFrame({title: df[field] for title, field, _, _, _ in COLUMNS},
+                             columns=[title for title, _, _, _, _ in COLUMNS])
+        frame.to_csv(self.file, header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        self.file.close()
+
+
+def export_filename(extension='xlsx') -> str:
+    return datetime.datetime.now().strftime("%d.%m.%Y_%H.%M") + '_otomoto.' + extension
+
+
+def export_xlsx(df, filename=None, last_start=None, constant_memory=False) -> str:
+    filename = filename or export_filename()
+
+    export = XlsxExport(filename, last_start=last_start, constant_memory=constant_memory)
+    export.write_rows(df)
+    export.close()
+
+    return filename
@@ -0,0 +1,179 @@
+"""
+Counters, gauges and latency histograms of scraper pipeline stages (fetch, parse, filter, phone lookup, DB),
+exported at the end of run as Prometheus text format or JSON.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import time
+
+# upper bounds of latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last one is +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate with linear interpolation inside bucket, as Prometheus histogram_quantile does.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def cumulative(self) -> list:
+        """
+        :return: (list) (upper bound, number of values <= bound) pairs, the last bound is +Inf
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics(object):
+    """
+    Registry of counters, gauges and histograms identified by name and labels.
+    """
+
+    def __init__(self, prefix='otomoto'):
+        self.prefix = prefix
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value=1, **labels):
+        key = self.key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, **labels):
+        """
+        Set current value, the last one is exported.
+        """
+        self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = self.key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = Histogram()
+            self.histograms[key] = histogram
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        return self.histograms.get(self.key(name, labels)) or Histogram()
+
+    def reset(self):
+        self.counters.clear()
+        self.gauges.clear()
+        self.histograms.clear()
+
+    def to_dict(self) -> dict:
+        return {
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(self.counters.items())],
+            'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                       for (name, labels), value in sorted(self.gauges.items())],
+            'histograms': [{'name': name, 'labels': dict(labels), 'count': histogram.count,
+                            'sum': round(histogram.sum, 6), 'p50': round(histogram.quantile(0.5), 6),
+                            'p99': round(histogram.quantile(0.99), 6),
+                            'buckets': [['+Inf' if bound == float('inf') else bound, count]
+                                        for bound, count in histogram.cumulative()]}
+                           for (name, labels), histogram in sorted(self.histograms.items())],
+        }
+
+    def to_prometheus(self) -> str:
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            metric = '{}_{}_total'.format(self.prefix, name)
+            if metric not in typed:
+                lines.append('# TYPE {} counter'.format(metric))
+                typed.add(metric)
+            lines.append('{}{} {}'.format(metric, format_labels(labels), value))
+
+        for (name, labels), value in sorted(self.gauges.items()):
+            metric = '{}_{}'.format(self.prefix, name)
+            if metric not in typed:
+                lines.append('# TYPE {} gauge'.format(metric))
+                typed.add(metric)
+            lines.append('{}{} {}'.format(metric, format_labels(labels), value))
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            metric = '{}_{}_seconds'.format(self.prefix, name)
+            if metric not in typed:
+                lines.append('# TYPE {} histogram'.format(metric))
+                typed.add(metric)
+            for bound, count in histogram.cumulative():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(metric, format_labels(labels + (('le', le),)), count))
+            lines.append('{}_sum{} {}'.format(metric, format_labels(labels), histogram.sum))
+            lines.append('{}_count{} {}'.format(metric, format_labels(labels), histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        """
+        Write JSON if path ends with .json, Prometheus text format otherwise.
+        """
+        with open(path, 'w', encoding='utf-8') as metrics_file:
+            if path.endswith('.json'):
+                json.dump(self.to_dict(), metrics_file, indent=2)
+            else:
+                metrics_file.write(self.to_prometheus())
+
+    def summary(self) -> str:
+        """
+        One line per histogram with count and latency percentiles, for log.
+        """
+        lines = []
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            lines.append('{}{}: {} calls, p50 {:.1f} ms, p99 {:.1f} ms, total {:.1f} s'.format(
+                name, format_labels(labels), histogram.count, histogram.quantile(0.5) * 1000,
+                histogram.quantile(0.99) * 1000, histogram.sum))
+        return '\n'.join(lines)
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in labels) + '}'
+
+
+# registry of this process, used by scraper pipeline
+REGISTRY = Metrics()
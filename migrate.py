@@ -0,0 +1,138 @@
+"""
+One-time conversion of DB file with old car_article schema (md5 hex ids, string prices,
+date years, plain string manufacturer/engine type/currency) to the compact one.
+
+Usage:
+    python migrate.py db\\otomoto.db db\\otomoto_compact.db
+
+Source file is not modified.
+"""
+import argparse
+from decimal import Decimal, InvalidOperation
+import logging
+import os
+import sqlite3
+
+from utils import setup_db
+
+logger = logging.getLogger('migrate')
+
+BATCH_SIZE = 10000
+
+
+def hex_key(hex_id: str) -> int:
+    # the same value as models.article_key for link of md5 hex id
+    return int.from_bytes(bytes.fromhex(hex_id)[:8], 'big', signed=True)
+
+
+def price_cents(value) -> int:
+    try:
+        return int(Decimal(value) * 100)
+    except (InvalidOperation, TypeError):
+        return 0
+
+
+def year_number(value):
+    try:
+        return int(str(value)[:4])
+    except ValueError:
+        return None
+
+
+class DictionaryCodes(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.codes = {(kind, value): code for code, kind, value in conn.execute('SELECT id, kind, value FROM dictionary')}
+
+    def code(self, kind, value):
+        if value is None:
+            return None
+        code = self.codes.get((kind, value))
+        if code is None:
+            code = self.conn.execute('INSERT INTO dictionary (kind, value) VALUES (?, ?)', (kind, value)).lastrowid
+            self.codes[(kind, value)] = code
+        return code
+
+
+def table_exists(conn, name) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+def convert(src_path, dst_path) -> int:
+    """
+    :return: (int) number of converted articles
+    """
+    # create compact schema
+    session = setup_db(db_url='sqlite:///' + dst_path)
+    session.close()
+    session.bind.dispose()
+
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(dst_path)
+    dictionary = DictionaryCodes(dst)
+
+    articles = src.execute(
+        'SELECT id, name, manufacturer, year, mileage, engine_capacity, engine_type, value, brutto, netto, '
+        'negotiation, vat, currency, location, link, seller_id, record_created, on_delete FROM car_article'
+    )
+    counter = 0
+    while True:
+        rows = articles.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        dst.executemany(
+            'INSERT OR IGNORE INTO car_article (id, name, manufacturer_id, year, mileage, engine_capacity, '
+            'engine_type_id, value, brutto, netto, negotiation, vat, currency_id, location, link, seller_id, '
+            'record_created, on_delete) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(hex_key(row[0]), row[1], dictionary.code('manufacturer', row[2]), year_number(row[3]), row[4], row[5],
+              dictionary.code('engine_type', row[6]), price_cents(row[7]), row[8], row[9], row[10], row[11],
+              dictionary.code('currency', row[12]), row[13], row[14], row[15], row[16], row[17])
+             for row in rows]
+        )
+        counter += len(rows)
+        logger.info('{} articles converted.'.format(counter))
+
+    dst.executemany(
+        'INSERT INTO phone_number (number, car_id) VALUES (?, ?)',
+        [(number, hex_key(car_id)) for number, car_id in
+         src.execute('SELECT number, car_id FROM phone_number WHERE car_id IS NOT NULL')]
+    )
+
+    # tables without schema changes
+    for table in ('meta_info', 'query_checkpoint'):
+        if not table_exists(src, table):
+            continue
+        columns = [row[1] for row in src.execute('PRAGMA table_info({})'.format(table))]
+        dst.executemany(
+            'INSERT INTO {} ({}) VALUES ({})'.format(table, ', '.join(columns), ', '.join('?' * len(columns))),
+            src.execute('SELECT {} FROM {}'.format(', '.join(columns), table))
+        )
+
+    dst.commit()
+    dst.close()
+    src.close()
+
+    return counter
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('src', help='DB file with old schema')
+    arg_parser.add_argument('dst', help='New DB file')
+    args = arg_parser.parse_args()
+
+    if os.path.exists(args.dst):
+        arg_parser.error('{} already exists'.format(args.dst))
+
+    logging.basicConfig(level=logging.INFO)
+
+    count = convert(args.src, args.dst)
+    src_size = os.path.getsize(args.src)
+    dst_size = os.path.getsize(args.dst)
+    logger.info('{} articles converted. DB size {:.1f} MB -> {:.1f} MB.'.format(
+        count, src_size / 1024 ** 2, dst_size / 1024 ** 2))
+
+
+if __name__ == '__main__':
+    main()
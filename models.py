@@ -1,4 +1,6 @@
-from sqlalchemy import Column, DateTime, Integer, Float, String, Date, Numeric, ForeignKey, Boolean
+from hashlib import md5
+from sqlalchemy import Column, DateTime, Integer, BigInteger, SmallInteger, Float, String, ForeignKey, Boolean, \
+    Index, UniqueConstraint
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
@@ -6,47 +8,77 @@ from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
 
 
+def article_key(link: str) -> int:
+    """
+    Article id - first 8 bytes of link md5 as signed 64-bit integer.
+    """
+    return int.from_bytes(md5(link.encode()).digest()[:8], 'big', signed=True)
+
+
+class Dictionary(Base):
+    """
+    Repeated string values of articles (manufacturer, engine type, currency), stored once
+    and referenced by id from car_article.
+    """
+
+    __tablename__ = 'dictionary'
+    __table_args__ = (
+        UniqueConstraint('kind', 'value'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(16))
+    value = Column(String(128))
+
+
 class CarArticle(Base):
 
     __tablename__ = 'car_article'
+    __table_args__ = (
+        # reports select live articles only, so on_delete leads both report indexes
+        Index('ix_car_article_live_manufacturer_year', 'on_delete', 'manufacturer_id', 'year'),
+        Index('ix_car_article_live_record_created', 'on_delete', 'record_created'),
+    )
 
-    id = Column(String, primary_key=True)
+    id = Column(BigInteger, primary_key=True, autoincrement=False)
     name = Column(String(128))
-    manufacturer = Column(String(128))
-    year = Column(Date)
+    manufacturer_id = Column(SmallInteger, ForeignKey('dictionary.id'))
+    year = Column(SmallInteger)
     mileage = Column(Integer)
     engine_capacity = Column(Float)
-    engine_type = Column(String)
-    value = Column(String)
+    engine_type_id = Column(SmallInteger, ForeignKey('dictionary.id'))
+    # price in cents
+    value = Column(BigInteger)
     brutto = Column(Boolean)
     netto = Column(Boolean)
     negotiation = Column(Boolean)
     vat = Column(Boolean)
-    currency = Column(String)
+    currency_id = Column(SmallInteger, ForeignKey('dictionary.id'))
     location = Column(String)
     link = Column(String)
-    seller_id = Column(String(32))
+    seller_id = Column(String(32), index=True)
     record_created = Column(DateTime(timezone=True), default=func.now())
+    # set by sweep after complete crawl if article wasn't found anymore
     on_delete = Column(Boolean, default=False)
 
 
-    def __init__(self, id, name, manufacturer, year,
-                 mileage, engine_capacity, engine_type, value,
-                 brutto, netto, negotiation, vat, currency,
+    def __init__(self, id, name, manufacturer_id, year,
+                 mileage, engine_capacity, engine_type_id, value,
+                 brutto, netto, negotiation, vat, currency_id,
                  location, link, seller_id):
         self.id = id
         self.name = name
-        self.manufacturer = manufacturer
+        self.manufacturer_id = manufacturer_id
         self.year = year
         self.mileage = mileage
         self.engine_capacity = engine_capacity
-        self.engine_type = engine_type
+        self.engine_type_id = engine_type_id
         self.value = value
         self.brutto = brutto
         self.netto = netto
         self.negotiation = negotiation
         self.vat = vat
-        self.currency = currency
+        self.currency_id = currency_id
         self.location = location
         self.link = link
         self.seller_id = seller_id
@@ -62,7 +94,7 @@ class Phone(Base):
     id = Column(Integer, primary_key=True)
     number = Column(String)
 
-    car_id = Column(String, ForeignKey('car_article.id'))
+    car_id = Column(BigInteger, ForeignKey('car_article.id'), index=True)
     car = relationship("CarArticle", backref="phones")
 
     def __init__(self, number, car):
@@ -73,10 +105,67 @@ class Phone(Base):
         return self.number
 
 
+class PriceHistory(Base):
+    """
+    Replaced price of article, one row per change. Current price stays in car_article,
+    record_created is the time it was replaced.
+    """
+
+    __tablename__ = 'price_history'
+
+    id = Column(Integer, primary_key=True)
+    car_id = Column(BigInteger, ForeignKey('car_article.id'), index=True)
+    car = relationship("CarArticle", backref="price_history")
+    # price in cents
+    value = Column(BigInteger)
+    currency_id = Column(SmallInteger, ForeignKey('dictionary.id'))
+    brutto = Column(Boolean)
+    netto = Column(Boolean)
+    negotiation = Column(Boolean)
+    vat = Column(Boolean)
+    record_created = Column(DateTime(timezone=True), default=func.now())
+
+
 class MetaInfo(Base):
 
     __tablename__ = 'meta_info'
 
     id = Column(Integer, primary_key=True)
     last_start = Column(DateTime(timezone=True))
-    status = Column(Boolean, default=False)
\ No newline at end of file
+    status = Column(Boolean, default=False)
+
+
+class QueryCheckpoint(Base):
+
+    __tablename__ = 'query_checkpoint'
+
+    id = Column(Integer, primary_key=True)
+    query_hash = Column(String(32), unique=True)
+    query = Column(String)
+    last_start = Column(DateTime(timezone=True))
+    last_finish = Column(DateTime(timezone=True))
+    pages_crawled = Column(Integer, default=0)
+    articles_inserted = Column(Integer, default=0)
+    prices_updated = Column(Integer, default=0)
+    status = Column(Boolean, default=False)
+
+
+class CrawlTask(Base):
+    """
+    Search page in work queue shared by coordinator and worker processes.
+    """
+
+    __tablename__ = 'crawl_queue'
+    __table_args__ = (
+        UniqueConstraint('checkpoint_id', 'url'),
+        Index('ix_crawl_queue_status_lease', 'status', 'lease_expires'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    checkpoint_id = Column(Integer, ForeignKey('query_checkpoint.id'))
+    url = Column(String)
+    # pending, in_flight, done, failed
+    status = Column(String(16), default='pending')
+    lease_owner = Column(String(64))
+    lease_expires = Column(DateTime)
+    attempts = Column(Integer, default=0)
@@ -1,194 +1,168 @@
+import argparse
+import numpy as np
 import pandas as pd
-from models import CarArticle, Base, Phone, MetaInfo
-from utils import setup_db, get_pln_rates, get_ukr_rates, get_cc_value
-import datetime
-import xlsxwriter
+from sqlalchemy.orm import aliased
+from models import CarArticle, Base, Phone, MetaInfo, Dictionary
+from utils import setup_db, get_pln_rates, get_ukr_rates, cc_value_vector
+from export import CsvExport, XlsxExport, export_filename
 
+# rates are loaded on first use
 cur_ukr = get_ukr_rates()
 cur_pln = get_pln_rates()
 
 
-def convert_currency(row):
-    currency = row['currency']
-    value = row['value']
+def add_prices(df):
+    """
+    Add price_eur, price_real, customs_clearing and price_total columns.
+    """
+    value = df['value'].values
+    netto = df['netto'].fillna(False).values.astype(bool)
+    vat = df['vat'].fillna(False).values.astype(bool)
 
     # TODO: check this
-    if currency.lower() == 'pln':
-        return cur_pln(value, 'eur')
-    return value
+    pln = df['currency'].str.lower().values == 'pln'
+    price_eur = np.where(pln, np.round(cur_pln.rate('eur') * value, 2), value)
 
-
-def apply_pln_taxes(row):
-    real_value = row['price_eur']
-
-    if row['netto']:
-        real_value *= 1.23
-
-    if row['vat']:
-        return real_value / 1.23
-    return real_value
-
-
-def calculate_urk_taxes(row):
-    value = row['price_eur']
-    capacity = float(row['engine_capacity'])
-    engine_type = row['engine_type']
-    year = row['year'].year
+    price_real = np.where(netto, price_eur * 1.23, price_eur)
+    price_real = np.where(vat, price_real / 1.23, price_real)
 
     # TODO: check this
-    if row['netto']:
-        value = row['price_real']
-
-    customs_clearing_value = get_cc_value(value, capacity, engine_type, year, cur_ukr)
-    return customs_clearing_value
-
-
-def calculate_total(row):
-    return row['price_real'] + row['customs_clearing']
-
-session = setup_db()
-DATA = pd.read_sql(session.query(CarArticle).statement, session.bind)
-
-# data pre-processing
-DATA['value'] = DATA['value'].astype('float')
-DATA['price_eur'] = DATA.apply(convert_currency, axis=1)
-DATA['price_real'] = DATA.apply(apply_pln_taxes, axis=1)
-DATA['customs_clearing'] = DATA.apply(calculate_urk_taxes, axis=1)
-DATA['price_total'] = DATA.apply(calculate_total, axis=1)
-# TODO: value + tax calculation
-
-DB_META = session.query(MetaInfo).get(1)
-
-
-def color_row(workbook, format_class, color=None):
-    format = workbook.add_format()
-    for attr, val in format_class.__dict__.items():
-        setattr(format, attr, val)
-    if color:
-        format.bg_color = color
-    return format
-
-
-def export_xlsx(df):
-    filename = datetime.datetime.now().strftime("%d.%m.%Y_%H.%M") + '_otomoto.xlsx'
-
-    workbook = xlsxwriter.Workbook(filename)
-    worksheet = workbook.add_worksheet('page#1')
-
-    format_title = workbook.add_format(
-        {
-            'bold': True,
-            'align': 'center',
-            'valign': 'vcenter'
-         }
-    )
-    format_normal = workbook.add_format(
-        {
-        'align': 'center',
-        'valign': 'vcenter'
-        }
-    )
-
-    format_numeric = workbook.add_format(
-        {
-            'num_format': '#.0#',
-            'align': 'center',
-            'valign': 'vcenter'
-        }
-    )
-    format_capacity = workbook.add_format(
-        {
-            'num_format': '0.0#',
-            'align': 'center',
-            'valign': 'vcenter'
-        }
-    )
-    format_datetime = workbook.add_format(
-        {
-            'num_format': 'yy-mm-dd hh:mm:ss',
-            'align': 'center',
-            'valign': 'vcenter'
-        }
-    )
-
-    worksheet.set_column('A:A', 20)
-    worksheet.set_column('B:B', 15)
-    worksheet.set_column('C:C', 12)
-    worksheet.set_column('D:D', 15)
-    worksheet.set_column('E:E', 12)
-    worksheet.set_column('F:F', 15)
-    worksheet.set_column('G:G', 20)
-    worksheet.set_column('H:H', 12)
-    worksheet.set_column('I:I', 12)
-    worksheet.set_column('J:J', 12)
-    worksheet.set_column('K:K', 12)
-    worksheet.set_column('L:L', 12)
-    worksheet.set_column('M:M', 20)
-    worksheet.set_column('N:N', 20)
-    worksheet.set_column('O:O', 20)
-    worksheet.set_column('P:P', 20)
-    worksheet.set_column('Q:Q', 20)
-    worksheet.set_column('R:R', 12)
-    worksheet.set_column('S:S', 20)
-
-    worksheet.write('A1', 'Name', format_title)
-    worksheet.write('B1', 'Manufacturer', format_title)
-    worksheet.write('C1', 'Year', format_title)
-    worksheet.write('D1', 'Mileage', format_title)
-    worksheet.write('E1', 'Engine cap.', format_title)
-    worksheet.write('F1', 'Engine type', format_title)
-
-    worksheet.write('G1', 'Value', format_title)
-    worksheet.write('H1', 'Currency', format_title)
-
-    worksheet.write('I1', 'Negotiation', format_title)
-    worksheet.write('J1', 'Netto', format_title)
-    worksheet.write('K1', 'Brutto', format_title)
-    worksheet.write('L1', 'VAT', format_title)
-
-    worksheet.write('M1', 'Price (EUR)', format_title)
-    worksheet.write('N1', 'Price (EUR, VAT refund)', format_title)
-    worksheet.write('O1', 'Customs fee (EUR)', format_title)
-    worksheet.write('P1', 'Total price', format_title)
-
-    worksheet.write('Q1', 'Location', format_title)
-    worksheet.write('R1', 'Link', format_title)
-    worksheet.write('S1', 'DB date', format_title)
-
-    index = 2
-    for _, row in df.iterrows():
-        # TODO: replace this with index generating function
-
-        color = None
-        if DB_META.last_start < row['record_created']:
-            color = '#00C7CE'
-
-        worksheet.write('A{}'.format(index), row['name'], color_row(workbook, format_normal, color=color))
-        worksheet.write('B{}'.format(index), row['manufacturer'], color_row(workbook, format_normal, color=color))
-        worksheet.write('C{}'.format(index), row['year'].year, color_row(workbook, format_normal, color=color))
-        worksheet.write_number('D{}'.format(index), row['mileage'], color_row(workbook, format_normal, color=color))
-        worksheet.write('E{}'.format(index), row['engine_capacity'], color_row(workbook, format_capacity, color=color))
-        worksheet.write('F{}'.format(index), row['engine_type'], color_row(workbook, format_normal, color=color))
-
-        worksheet.write('G{}'.format(index), row['value'], color_row(workbook, format_numeric, color=color))
-        worksheet.write('H{}'.format(index), row['currency'], color_row(workbook, format_normal, color=color))
-
-        worksheet.write_boolean('I{}'.format(index), row['negotiation'], color_row(workbook, format_normal, color=color))
-        worksheet.write_boolean('J{}'.format(index), row['netto'], color_row(workbook, format_normal, color=color))
-        worksheet.write_boolean('K{}'.format(index), row['brutto'], color_row(workbook, format_normal, color=color))
-        worksheet.write_boolean('L{}'.format(index), row['vat'], color_row(workbook, format_normal, color=color))
-
-        worksheet.write('M{}'.format(index), row['price_eur'], color_row(workbook, format_numeric, color=color))
-        worksheet.write('N{}'.format(index), row['price_real'], color_row(workbook, format_numeric, color=color))
-        worksheet.write('O{}'.format(index), row['customs_clearing'], color_row(workbook, format_numeric, color=color))
-        worksheet.write('P{}'.format(index), row['price_total'], color_row(workbook, format_numeric, color=color))
-
-        worksheet.write('Q{}'.format(index), row['location'], color_row(workbook, format_normal, color=color))
-        worksheet.write_url('R{}'.format(index), row['link'], color_row(workbook, format_normal, color=color), string='link')
-        worksheet.write_datetime('S{}'.format(index), row['record_created'], color_row(workbook, format_datetime, color=color))
-
-        index += 1
-
-    workbook.close()
-
-export_xlsx(DATA)
\ No newline at end of file
+    cc_base = np.where(netto, price_real, price_eur)
+    customs_clearing = cc_value_vector(cc_base,
+                                       df['engine_capacity'].values.astype(float),
+                                       df['engine_type'].values,
+                                       df['year'].values,
+                                       cur_ukr.rate('eur'))
+
+    df['price_eur'] = price_eur
+    df['price_real'] = price_real
+    df['customs_clearing'] = customs_clearing
+    df['price_total'] = price_real + customs_clearing
+
+    return df
+
+
+def args_init():
+    arg_parser = argparse.ArgumentParser()
+
+    arg_parser.add_argument('--manufacturer', required=False, nargs='+',
+                            default=None, help='Report only given manufacturers')
+    arg_parser.add_argument('--year_from', required=False, type=int,
+                            default=None, help='Production year - from')
+    arg_parser.add_argument('--year_to', required=False, type=int,
+                            default=None, help='Production year - to')
+    arg_parser.add_argument('--new', required=False, action='store_true',
+                            help='Report only articles found by the last scraper run')
+    arg_parser.add_argument('--deleted', required=False, action='store_true',
+                            help='Include articles marked as delisted')
+    arg_parser.add_argument('--format', required=False, choices=('xlsx', 'csv'),
+                            default='xlsx', help='Report file format')
+    arg_parser.add_argument('--chunksize', required=False, type=int,
+                            default=10000, help='Number of articles processed at once')
+    arg_parser.add_argument('--in_memory', dest='constant_memory', required=False, action='store_false',
+                            help='Keep whole xlsx sheet in memory instead of flushing rows to disk by chunks')
+
+    return arg_parser.parse_args()
+
+
+def report_query(session, manufacturer=None, year_from=None, year_to=None, since=None, deleted=False):
+    """
+    Articles query with filters applied in SQL.
+
+    :param manufacturer: (list) manufacturers names
+    :param year_from: (int) production year - from
+    :param year_to: (int) production year - to
+    :param since: (datetime) only articles created after this time
+    :param deleted: include articles marked as delisted
+    """
+    manufacturer_name = aliased(Dictionary)
+    engine_type_name = aliased(Dictionary)
+    currency_name = aliased(Dictionary)
+
+    query = session.query(
+        CarArticle.id,
+        CarArticle.name,
+        manufacturer_name.value.label('manufacturer'),
+        CarArticle.year,
+        CarArticle.mileage,
+        CarArticle.engine_capacity,
+        engine_type_name.value.label('engine_type'),
+        CarArticle.value,
+        CarArticle.brutto,
+        CarArticle.netto,
+        CarArticle.negotiation,
+        CarArticle.vat,
+        currency_name.value.label('currency'),
+        CarArticle.location,
+        CarArticle.link,
+        CarArticle.seller_id,
+        CarArticle.record_created,
+        CarArticle.on_delete,
+    ).outerjoin(manufacturer_name, CarArticle.manufacturer_id == manufacturer_name.id)\
+        .outerjoin(engine_type_name, CarArticle.engine_type_id == engine_type_name.id)\
+        .outerjoin(currency_name, CarArticle.currency_id == currency_name.id)
+
+    if not deleted:
+        query = query.filter(CarArticle.on_delete == False)
+    if manufacturer:
+        manufacturer_ids = session.query(Dictionary.id).filter(
+            Dictionary.kind == 'manufacturer',
+            Dictionary.value.in_([name.lower() for name in manufacturer])
+        )
+        query = query.filter(CarArticle.manufacturer_id.in_(manufacturer_ids))
+    if year_from:
+        query = query.filter(CarArticle.year >= year_from)
+    if year_to:
+        query = query.filter(CarArticle.year <= year_to)
+    if since:
+        query = query.filter(CarArticle.record_created > since)
+
+    return query
+
+
+def generate_report(session, query, writer, chunksize=10000) -> int:
+    """
+    Read query result by chunks, add prices and pass every chunk to writer,
+    so memory usage is bounded by chunk size.
+    Query is run on a dedicated connection, session one could be already used with other options.
+
+    :return: (int) number of written articles
+    """
+    rows_counter = 0
+    with session.get_bind().connect() as connection:
+        connection = connection.execution_options(stream_results=True)
+        for chunk in pd.read_sql(query.statement, connection, chunksize=chunksize):
+            # cents to currency units
+            chunk['value'] = chunk['value'] / 100
+            add_prices(chunk)
+            writer.write_rows(chunk)
+            rows_counter += len(chunk)
+
+    return rows_counter
+
+
+def main():
+    args = args_init()
+
+    session = setup_db()
+    db_meta = session.query(MetaInfo).get(1)
+    last_start = db_meta.last_start if db_meta else None
+
+    query = report_query(session, manufacturer=args.manufacturer, year_from=args.year_from, year_to=args.year_to,
+                         since=last_start if args.new else None, deleted=args.deleted)
+
+    filename = export_filename(args.format)
+    if args.format == 'csv':
+        writer = CsvExport(filename)
+    else:
+        writer = XlsxExport(filename, last_start=last_start, constant_memory=args.constant_memory)
+
+    try:
+        generate_report(session, query, writer, chunksize=args.chunksize)
+    finally:
+        writer.close()
+        session.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,95 +1,384 @@
 import argparse
 import asyncio
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import datetime
 from datetime import date
 from decimal import Decimal
-from hashlib import md5
+from functools import lru_cache
 import json
 import logging
-from lxml import html
+import multiprocessing
+import os
+from lxml import etree, html
 from math import ceil, floor
 import pytz
 import re
+import socket
+from sys import intern
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError, OperationalError
+import time
 
-from models import CarArticle, Base, Phone, MetaInfo
-from session import GSession
-from utils import setup_db, tear_up, meta_get_or_create
+from metrics import REGISTRY
+from models import CarArticle, Base, Phone, PriceHistory, MetaInfo, QueryCheckpoint, article_key
+from session import EndpointClassifier, GSession, RateLimiter, ResponseCache, ResponseRecorder, ResponseReplay
+from utils import setup_db, tear_up, meta_get_or_create, checkpoint_get_or_create, DictionaryCache, \
+    sqlite_upsert, DB_URL
+from workqueue import WorkQueue, DONE, FAILED, PENDING
 
+logger = logging.getLogger(__name__)
 
-def db_fill(session: object, data: list):
-    articles = []
-    phones = []
-    ids_pool = []
-
-    logger.info('{} articles found in general.'.format(len(data) * 32))
 
+def db_start(session: object) -> MetaInfo:
     db_meta = meta_get_or_create(session, MetaInfo)
     db_meta.last_start = datetime.datetime.now(tz=pytz.utc)
     db_meta.status = False
     session.commit()
 
+    return db_meta
+
+
+def db_finish(session: object, db_meta: MetaInfo, ins_counter: int, upd_counter: int = 0, complete: bool = True):
+    """
+    :param complete: all pages of search were crawled, otherwise run is stored as partial
+    """
+    db_meta.status = complete
+
+    with REGISTRY.timer('db_commit'):
+        session.commit()
+
+    logger.info('\nScraper finished{}. {} new articles found and inserted, '
+                '{} price changes recorded.'.format(' successfully' if complete else ' with partial crawl',
+                                                    ins_counter, upd_counter))
+
+
+# car_article fields compared to detect price change
+PRICE_FIELDS = ('value', 'currency_id', 'brutto', 'netto', 'negotiation', 'vat')
+
+
+@lru_cache(maxsize=1)
+def article_upsert():
+    """
+    Upsert of car_article changing PRICE_FIELDS only. Built on first use, so import of the module
+    doesn't need SQLite with upsert support.
+    """
+    return sqlite_upsert(CarArticle.__table__, ('id',), PRICE_FIELDS)
+
+
+def article_price(article: tuple, dictionary: DictionaryCache) -> tuple:
+    """
+    :return: (tuple) values of PRICE_FIELDS
+    """
+    price_detail = article.price_detail
+
+    return (
+        int(article.price * 100),
+        dictionary.code('currency', article.currency),
+        'brutto' in price_detail,
+        'netto' in price_detail,
+        'donegocjacji' in price_detail,
+        'fakturavat' in price_detail,
+    )
+
+
+# car_article columns set from parsed article, in order of article_values
+ARTICLE_COLUMNS = ('id', 'name', 'manufacturer_id', 'year', 'mileage', 'engine_capacity', 'engine_type_id',
+                   'location', 'link', 'seller_id') + PRICE_FIELDS
+
+# statements of raw sqlite3 insert path, defaults of the rest of columns are the same as in models
+RAW_ARTICLE_INSERT = 'INSERT INTO {} ({}, record_created, on_delete) VALUES ({}, CURRENT_TIMESTAMP, 0)'.format(
+    CarArticle.__tablename__, ', '.join(ARTICLE_COLUMNS), ', '.join('?' * len(ARTICLE_COLUMNS)))
+RAW_PHONE_INSERT = 'INSERT INTO {} (number, car_id) VALUES (?, ?)'.format(Phone.__tablename__)
+
+
+def article_values(article_id: int, article: tuple, dictionary: DictionaryCache) -> tuple:
+    return (
+        article_id,
+        article.name,
+        dictionary.code('manufacturer', article.manufacturer),
+        article.item_year.year,
+        article.item_mileage,
+        article.item_engine_capacity,
+        dictionary.code('engine_type', article.item_fuel_type),
+        article.seller_location,
+        article.link,
+        article.seller_id,
+    ) + article_price(article, dictionary)
+
+
+def article_row(article_id: int, article: tuple, dictionary: DictionaryCache) -> dict:
+    return dict(zip(ARTICLE_COLUMNS, article_values(article_id, article, dictionary)))
+
+
+def db_existing_prices(session: object, ids: list, chunk_size: int = 500) -> dict:
+    """
+    Select price fields of articles present in car_article with chunked IN (...) queries.
+    Chunk size is kept below SQLite host parameters limit (999).
+
+    :return: (dict) tuples of PRICE_FIELDS values by article id
+    """
+    columns = [getattr(CarArticle, field) for field in PRICE_FIELDS]
+    existing = {}
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        for row in session.query(CarArticle.id, *columns).filter(CarArticle.id.in_(chunk)):
+            existing[row[0]] = tuple(row[1:])
+    return existing
+
+
+def db_split_articles(session: object, collection: list, ids_pool: set) -> tuple:
+    """
+    Split articles from collection that weren't processed during this run into new ones
+    and ones already in DB with price changed since they were stored.
+
+    :param session: DB session
+    :param collection: (list) Article records
+    :param ids_pool: (set) ids of articles already processed during this run, updated in place
+    :return: (tuple) new articles by id, (article, stored price tuple) of changed articles by id
+    """
+    candidates = {}
+    for article in collection:
+        link = article.link
+        article_id = article_key(link)
+
+        if article_id in ids_pool or article_id in candidates:
+            logger.debug('Article {} with id {} already processed.'.format(link, article_id))
+            continue
+        candidates[article_id] = article
+
+    ids_pool.update(candidates)
+
+    existing = db_existing_prices(session, list(candidates))
+    if not existing:
+        return candidates, {}
+
+    dictionary = DictionaryCache.of(session)
+
+    new_articles = {}
+    changed_articles = {}
+    for article_id, article in candidates.items():
+        stored = existing.get(article_id)
+        if stored is None:
+            new_articles[article_id] = article
+            continue
+        if article_price(article, dictionary) != stored:
+            changed_articles[article_id] = (article, stored)
+
+    return new_articles, changed_articles
+
+
+def db_write(session: object, new_articles: dict) -> int:
+    """
+    Insert new articles returned by db_split_articles with their phones.
+    Commit is left to the caller.
+    """
+    if not new_articles:
+        return 0
+    if session.info.get('raw_insert'):
+        return db_write_raw(session, new_articles)
+
+    dictionary = DictionaryCache.of(session)
+
+    articles = []
+    phones = []
+    for article_id, article in new_articles.items():
+        articles.append(article_row(article_id, article, dictionary))
+        for phone in article.phones:
+            phones.append({'number': phone, 'car_id': article_id})
+
+    session.execute(CarArticle.__table__.insert(), articles)
+    if phones:
+        session.execute(Phone.__table__.insert(), phones)
+
+    return len(articles)
+
+
+def db_write_raw(session: object, new_articles: dict) -> int:
+    """
+    db_write with plain tuples and sqlite3 executemany on connection of the session transaction,
+    without SQLAlchemy statement compilation and type processing.
+    """
+    dictionary = DictionaryCache.of(session)
+
+    articles = []
+    phones = []
+    for article_id, article in new_articles.items():
+        articles.append(article_values(article_id, article, dictionary))
+        for phone in article.phones:
+            phones.append((phone, article_id))
+
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.executemany(RAW_ARTICLE_INSERT, articles)
+        if phones:
+            cursor.executemany(RAW_PHONE_INSERT, phones)
+    finally:
+        cursor.close()
+
+    return len(articles)
+
+
+def db_update_prices(session: object, changed_articles: dict) -> int:
+    """
+    Write new prices of changed articles returned by db_split_articles with one upsert executemany
+    and move the stored ones to price_history. Commit is left to the caller.
+    """
+    if not changed_articles:
+        return 0
+
+    dictionary = DictionaryCache.of(session)
+    now = datetime.datetime.utcnow()
+
+    articles = []
+    history = []
+    for article_id, (article, stored) in changed_articles.items():
+        row = article_row(article_id, article, dictionary)
+        # used only if the article was removed from DB in the meantime
+        row['record_created'] = now
+        row['on_delete'] = False
+        articles.append(row)
+
+        entry = dict(zip(PRICE_FIELDS, stored))
+        entry['car_id'] = article_id
+        history.append(entry)
+
+    session.execute(PriceHistory.__table__.insert(), history)
+    session.execute(article_upsert(), articles)
+
+    return len(articles)
+
+
+def db_insert(session: object, collection: list, ids_pool: set) -> tuple:
+    """
+    Add articles from collection that are not in DB yet and price changes of the known ones
+    to the current transaction. Commit is left to the caller.
+
+    :param session: DB session
+    :param collection: (list) Article records
+    :param ids_pool: (set) ids of articles already processed during this run
+    :return: (tuple) number of inserted articles, number of price changes
+    """
+    with REGISTRY.timer('db_write'):
+        new_articles, changed_articles = db_split_articles(session, collection, ids_pool)
+        inserted = db_write(session, new_articles)
+        updated = db_update_prices(session, changed_articles)
+
+    REGISTRY.inc('articles_inserted', inserted)
+    REGISTRY.inc('prices_updated', updated)
+
+    return inserted, updated
+
+
+def db_sweep(session: object, seen_ids: set, year_from: int, year_to: int) -> tuple:
+    """
+    Mark articles of year range that weren't seen by complete crawl as delisted and unmark
+    delisted ones found again. Seen ids are loaded to temporary table, so each part is one UPDATE.
+    Commit is left to the caller.
+
+    :param session: DB session
+    :param seen_ids: (set) ids of all articles found by crawl
+    :param year_from: (int) production year - from, of crawl search query
+    :param year_to: (int) production year - to, of crawl search query
+    :return: (tuple) number of delisted articles, number of restored articles
+    """
+    if not seen_ids:
+        return 0, 0
+
+    session.execute(text('CREATE TEMP TABLE IF NOT EXISTS seen_article (id INTEGER PRIMARY KEY)'))
+    session.execute(text('DELETE FROM seen_article'))
+    session.execute(text('INSERT INTO seen_article (id) VALUES (:id)'), [{'id': item} for item in seen_ids])
+
+    deleted = session.execute(text(
+        'UPDATE car_article SET on_delete = 1 '
+        'WHERE on_delete = 0 AND year BETWEEN :year_from AND :year_to '
+        'AND id NOT IN (SELECT id FROM seen_article)'
+    ), {'year_from': year_from, 'year_to': year_to}).rowcount
+    restored = session.execute(text(
+        'UPDATE car_article SET on_delete = 0 '
+        'WHERE on_delete = 1 AND id IN (SELECT id FROM seen_article)'
+    )).rowcount
+
+    session.execute(text('DROP TABLE seen_article'))
+
+    return deleted, restored
+
+
+def db_finish_queue(session: object, checkpoint_id: int, complete: bool = True):
+    """
+    Finish coordinated run after work queue of the search is empty. Counters are collected by workers
+    in the search checkpoint.
+
+    :param complete: all pages of search were queued
+    """
+    checkpoint = session.query(QueryCheckpoint).get(checkpoint_id)
+    stats = WorkQueue(session).stats(checkpoint_id)
+    if stats.get(FAILED):
+        logger.warning('{} pages failed.'.format(stats[FAILED]))
+
+    complete = complete and not stats.get(FAILED)
+    checkpoint.last_finish = datetime.datetime.now(tz=pytz.utc)
+    checkpoint.status = complete
+    db_finish(session, meta_get_or_create(session, MetaInfo), checkpoint.articles_inserted or 0,
+              checkpoint.prices_updated or 0, complete=complete)
+
+
+def worker_process(scraper_args: tuple, scraper_kwargs: dict, db_url: str, metrics_path: str = None,
+                   raw_insert: bool = False) -> int:
+    """
+    Entry point of local worker process started by coordinator.
+
+    :param metrics_path: coordinator metrics file, worker metrics go next to it with process id in name
+    :param raw_insert: insert articles with sqlite3 executemany
+    """
+    # forked process inherits counters of coordinator
+    REGISTRY.reset()
+
+    session = setup_db(db_url=db_url, raw_insert=raw_insert)
+    scraper = Scraper(*scraper_args, **scraper_kwargs)
+
+    ins_counter = scraper.start_worker(session)
+
+    if metrics_path:
+        root, extension = os.path.splitext(metrics_path)
+        REGISTRY.write('{}.{}{}'.format(root, os.getpid(), extension))
+
+    return ins_counter
+
+
+def db_fill(session: object, data: list, complete: bool = True) -> set:
+    """
+    :param complete: all pages of search were crawled
+    :return: (set) ids of all found articles
+    """
+    ids_pool = set()
+
+    logger.info('{} articles found in general.'.format(
+        sum(len(collection) for collection in data if isinstance(collection, list))))
+
+    db_meta = db_start(session)
+
     ins_counter = 0
+    upd_counter = 0
     for collection in data:
         if not isinstance(collection, list):
             logger.warning('No articles found in collection.')
             continue
-        for article in collection:
-            link = article['link']
-            article_id = md5(link.encode()).hexdigest()
-
-            if article_id not in ids_pool:
-                ids_pool.append(article_id)
-            else:
-                logger.debug('Article {} with id {} already present in DB.'.format(link, article_id))
-                continue
-
-            if not session.query(CarArticle).get(article_id):
-                ins_counter += 1
-
-                brutto = True if 'brutto' in article['price_detail'] else False
-                netto = True if 'netto' in article['price_detail'] else False
-                negotiation = True if 'donegocjacji' in article['price_detail'] else False
-                vat = True if 'fakturavat' in article['price_detail'] else False
-
-                car_obj = CarArticle(article_id,
-                                     article['name'],
-                                     article['manufacturer'],
-                                     article['item_year'],
-                                     article['item_mileage'],
-                                     article['item_engine_capacity'],
-                                     article['item_fuel_type'],
-                                     str(article['price']),
-                                     brutto,
-                                     netto,
-                                     negotiation,
-                                     vat,
-                                     article['currency'],
-                                     article['seller_location'],
-                                     link,
-                                     article['seller_id'])
-
-                articles.append(car_obj)
-
-                for phone in article['phones']:
-                    phone_obj = Phone(phone, car_obj)
-                    phones.append(phone_obj)
-
-    session.bulk_save_objects(articles)
-    session.bulk_save_objects(phones)
-
-    db_meta.status = True
+        inserted, updated = db_insert(session, collection, ids_pool)
+        ins_counter += inserted
+        upd_counter += updated
 
-    session.commit()
+    db_finish(session, db_meta, ins_counter, upd_counter, complete=complete)
 
-    logger.info('\nScraper finished successfully. {} new articles found and inserted.'.format(ins_counter))
+    return ids_pool
 
 
 def args_init():
     arg_parser = argparse.ArgumentParser()
 
-    arg_parser.add_argument('--value_min', required=False, nargs=1,
+    arg_parser.add_argument('--value_min', required=False, type=int,
                             default=0, help='Car minimum value')
-    arg_parser.add_argument('--value_max', required=False, nargs=1,
+    arg_parser.add_argument('--value_max', required=False, type=int,
                             default=0, help='Car maximum value')
     arg_parser.add_argument('--year_from', required=False,
                             default='1990', help='Production year - from')
@@ -103,9 +392,92 @@ def args_init():
                             default='', help='Engine fuel type')
     arg_parser.add_argument('--damaged', required=False,
                             default=0, help='Add damaged cars to search query')
+    arg_parser.add_argument('--limit', required=False, type=int,
+                            default=50, help='Max number of simultaneous requests')
+    arg_parser.add_argument('--host_limit', required=False, type=int,
+                            default=0, help='Max number of simultaneous connections per host (0 - no limit)')
+    arg_parser.add_argument('--retries', required=False, type=int,
+                            default=3, help='Max retries of failed request')
+    arg_parser.add_argument('--rate', required=False, type=float,
+                            default=10.0, help='Initial requests per second, adapted separately for search pages '
+                                               'and phones (0 - no rate limit)')
+    arg_parser.add_argument('--max_rate', required=False, type=float,
+                            default=200.0, help='Max requests per second of adaptive rate')
+    arg_parser.add_argument('--phones', required=False, choices=('inline', 'defer', 'off'),
+                            default='inline', help='Fetch phones while crawling, after crawl or never')
+    arg_parser.add_argument('--phone_probe', required=False, type=int,
+                            default=1, help='Number of phone counters requested simultaneously per seller')
+    arg_parser.add_argument('--parse_workers', required=False, type=int,
+                            default=0, help='Number of parse workers (0 - parse in event loop)')
+    arg_parser.add_argument('--parse_executor', required=False, choices=('process', 'thread'),
+                            default='process', help='Parse workers type')
+    arg_parser.add_argument('--incremental', required=False, action='store_true',
+                            help='Crawl newest articles first and stop at page with known articles only')
+    arg_parser.add_argument('--incremental_window', required=False, type=int,
+                            default=2, help='Number of pages crawled simultaneously in incremental mode')
+    arg_parser.add_argument('--cache', required=False,
+                            default=None, help='Responses cache file (cache is disabled if not set)')
+    arg_parser.add_argument('--cache_ttl', required=False, type=int,
+                            default=3600, help='Search pages cache lifetime in seconds')
+    arg_parser.add_argument('--phone_cache_ttl', required=False, type=int,
+                            default=7 * 24 * 3600, help='Phone numbers cache lifetime in seconds')
+    arg_parser.add_argument('--cache_size', required=False, type=int,
+                            default=512, help='Responses cache size limit in MB')
+    arg_parser.add_argument('--record', required=False,
+                            default=None, help='Save all responses to directory')
+    arg_parser.add_argument('--replay', required=False,
+                            default=None, help='Get responses from recordings directory instead of network')
+    arg_parser.add_argument('--replay_latency', required=False, type=float,
+                            default=0.0, help='Artificial delay of replayed responses in seconds')
+    arg_parser.add_argument('--coordinator', required=False, action='store_true',
+                            help='Put search pages to work queue in DB and crawl them with worker processes')
+    arg_parser.add_argument('--worker', required=False, action='store_true',
+                            help='Crawl pages from work queue in DB until it is empty')
+    arg_parser.add_argument('--workers', required=False, type=int,
+                            default=0, help='Number of local worker processes started by coordinator')
+    arg_parser.add_argument('--resume', required=False, action='store_true',
+                            help='Continue unfinished crawl of the same search from work queue in DB: '
+                                 'done pages are skipped, failed ones are crawled again')
+    arg_parser.add_argument('--lease_time', required=False, type=int,
+                            default=300, help='Seconds before page leased by worker is given to another one')
+    arg_parser.add_argument('--db_url', required=False,
+                            default=DB_URL, help='DB shared by coordinator and workers')
+    arg_parser.add_argument('--shard', required=False, action='store_true',
+                            help='Split search by year and price ranges so every part fits in pages limit')
+    arg_parser.add_argument('--sweep', required=False, action='store_true',
+                            help='Mark articles of year range not found by complete crawl as delisted '
+                                 '(with --damaged only, so damaged cars are crawled too)')
+    arg_parser.add_argument('--metrics', required=False,
+                            default=None, help='Write run metrics to file: JSON if name ends with .json, '
+                                               'Prometheus text format otherwise')
+    arg_parser.add_argument('--insert', required=False, choices=('core', 'sqlite3'),
+                            default='core', help='Insert new articles with SQLAlchemy Core or with sqlite3 '
+                                                 'executemany directly (SQLite only)')
+    arg_parser.add_argument('--stream', required=False, action='store_true',
+                            help='Write articles to DB in batches while crawling')
+    arg_parser.add_argument('--batch_size', required=False, type=int,
+                            default=500, help='Number of articles per DB commit in stream mode')
+    arg_parser.add_argument('--queue_size', required=False, type=int,
+                            default=64, help='Max number of parsed pages waiting for DB writer in stream mode')
 
     args = arg_parser.parse_args()
 
+    if args.sweep and (args.value_min or args.value_max or args.mileage_min or args.mileage_max or args.fuel_type):
+        arg_parser.error('--sweep works only with year range filter')
+    # without --damaged search is limited to cars with no accident, others would be marked as delisted
+    if args.sweep and not args.damaged:
+        arg_parser.error('--sweep needs --damaged, default search skips damaged cars')
+    if args.sweep and args.incremental:
+        arg_parser.error('--sweep needs full crawl and can\'t be used with --incremental')
+    if args.shard and args.incremental:
+        arg_parser.error('--shard can\'t be used with --incremental')
+    if (args.coordinator or args.worker or args.resume) and (args.incremental or args.stream or args.sweep):
+        arg_parser.error('--coordinator, --worker and --resume can\'t be used with --incremental, --stream or --sweep')
+    if args.insert == 'sqlite3' and not args.db_url.startswith('sqlite'):
+        arg_parser.error('--insert sqlite3 works only with SQLite DB')
+    if args.resume and args.worker:
+        arg_parser.error('--resume is a coordinator option and can\'t be used with --worker')
+
     value_min = args.value_min
     value_max = args.value_max
 
@@ -120,7 +492,32 @@ def args_init():
 
     logger.info('Keys accepted.')
 
-    return value_min, value_max, year_from, year_to, mileage_min, mileage_max, fuel_type, damaged
+    return (value_min, value_max, year_from, year_to, mileage_min, mileage_max, fuel_type, damaged), args
+
+
+# search range of one shard, value_max 0 - no upper price limit
+SearchShard = namedtuple('SearchShard', ('value_min', 'value_max', 'year_from', 'year_to'))
+
+# upper price used to split shards without value_max
+SHARD_PRICE_MAX = 5000000
+
+
+def split_shard(shard: SearchShard):
+    """
+    Split shard in two halves: by year while it covers more than one year, then by price.
+    Halves share the middle price, so articles on the boundary aren't lost (they are deduplicated by id).
+
+    :return: (tuple) two shards or None if shard can't be split anymore
+    """
+    if shard.year_from < shard.year_to:
+        middle = (shard.year_from + shard.year_to) // 2
+        return shard._replace(year_to=middle), shard._replace(year_from=middle + 1)
+
+    value_max = shard.value_max or SHARD_PRICE_MAX
+    if value_max - shard.value_min < 2:
+        return None
+    middle = (shard.value_min + value_max) // 2
+    return shard._replace(value_max=middle), shard._replace(value_min=middle)
 
 
 class FilterArticle(object):
@@ -140,6 +537,7 @@ class FilterArticle(object):
         'price_detail', 'item_year', 'item_mileage', 'item_engine_capacity',
         'item_fuel_type', 'link', 'seller_location', 'seller_id'
     )
+    PRICE_PLACES = Decimal('.00')
 
     @staticmethod
     def strip_all(string: str, concat_symb=' ') -> str:
@@ -160,15 +558,77 @@ class FilterArticle(object):
     def float_round(num, places=0, direction=floor):
         return direction(num * (10 ** places)) / float(10 ** places)
 
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def strip_cached(string: str, concat_symb=' ') -> str:
+        """
+        strip_all for fields with small set of repeated values (currency, fuel type, location)
+        """
+        return FilterArticle.strip_all(string, concat_symb)
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def parse_price_detail(price_detail: str) -> tuple:
+        return tuple(FilterArticle.strip_all(price_detail, concat_symb='').split(','))
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def parse_year(item_year: str) -> datetime.datetime:
+        item_year_string = FilterArticle.strip_all(item_year, concat_symb='')
+        return datetime.datetime.strptime(item_year_string, '%Y')
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def parse_engine_capacity(item_engine_capacity: str) -> float:
+        if not item_engine_capacity:
+            item_engine_capacity = '50 cm3'
+        item_engine_capacity_string = FilterArticle.strip_all(item_engine_capacity, concat_symb='')
+        item_engine_capacity_string = FilterArticle.PATTERN_ENGINE_CAPACITY.search(item_engine_capacity_string)
+        if not item_engine_capacity_string:
+            raise ValueError('unknown engine capacity format [{}]'.format(item_engine_capacity))
+        item_engine_capacity_full = int(item_engine_capacity_string.group(1)) / 1000
+        return FilterArticle.float_round(item_engine_capacity_full, 1, direction=ceil)
+
     def get_dict(self, *args):
         dic = None
+        fields = self.get_fields(*args)
+        if fields:
+            dic = {k: v for k, v in zip(self.FILTER_FIELDS, fields)}
+        return dic
+
+    def get_fields(self, *args):
+        fields = None
         try:
             fields = self.filter(*args)
-            if fields:
-                dic = {k: v for k, v in zip(self.FILTER_FIELDS, fields)}
         except Exception as err:
             logger.error('filtering article data failed. Reason: {}'.format(err))
-        return dic
+        return fields
+
+    def filter_many(self, rows) -> list:
+        """
+        get_dict for every row of a page. Rows are still filtered one by one,
+        repeated values are fast because of cached normalizers of filter.
+
+        :param rows: iterable of filter arguments tuples
+        :return: (list) get_dict result for every row, in the same order
+        """
+        keys = self.FILTER_FIELDS
+        return [dict(zip(keys, fields)) if fields else None for fields in self.get_fields_many(rows)]
+
+    def get_fields_many(self, rows) -> list:
+        """
+        get_fields for every row, result is aligned with rows.
+        """
+        result = []
+        append = result.append
+        filter_row = self.filter
+        for row in rows:
+            try:
+                append(filter_row(*row))
+            except Exception as err:
+                logger.error('filtering article data failed. Reason: {}'.format(err))
+                append(None)
+        return result
 
     def filter(self, *args):
         name, \
@@ -182,10 +642,10 @@ class FilterArticle(object):
         link, \
         seller_location = args
 
-        logger.debug('Filtering {}'.format(link))
+        logger.debug('Filtering %s', link)
 
         name = self.strip_all(name)
-        manufacturer_matched = re.match(self.PATTERN_MANUFACTURER, name)
+        manufacturer_matched = self.PATTERN_MANUFACTURER.match(name)
         if manufacturer_matched:
             manufacturer = manufacturer_matched.group(1)
             name = name.replace(manufacturer, '')[1:]  # remove manufacturer and trailing space
@@ -195,21 +655,20 @@ class FilterArticle(object):
         try:
             price_string = price.replace(' ', '')
             price_string = price_string.split(',')[0]
-            price = Decimal(price_string).quantize(Decimal('.00'))
+            price = Decimal(price_string).quantize(self.PRICE_PLACES)
         except Exception as err:
             logger.warning('Unable to process price [{}] for article {}. Price set to zero.'.format(price, link))
-            price = Decimal('0').quantize(Decimal('.00'))
+            price = Decimal('0').quantize(self.PRICE_PLACES)
 
-        currency = self.strip_all(currency)
+        currency = self.strip_cached(currency)
 
         try:
-            price_detail = self.strip_all(price_detail, concat_symb='').split(',')
+            price_detail = self.parse_price_detail(price_detail)
         except:
             logger.warning('Unable to process price details [{}] for article {}. Details set to "brutto".')
-            price_detail = ['brutto']
+            price_detail = ('brutto',)
 
-        item_year_string = self.strip_all(item_year, concat_symb='')
-        item_year = datetime.datetime.strptime(item_year_string, '%Y')
+        item_year = self.parse_year(item_year)
 
         # cut last two chars - kilometer abbreviation
         try:
@@ -218,31 +677,24 @@ class FilterArticle(object):
             logger.warning('Unable to process mileage [{}] for article {}. Mileage set to 0'.format(item_mileage, link))
             item_mileage = 0
 
-
-        if not item_engine_capacity:
-            item_engine_capacity = '50 cm3'
-        item_engine_capacity_string = self.strip_all(item_engine_capacity, concat_symb='')
-        item_engine_capacity_string = re.search(self.PATTERN_ENGINE_CAPACITY, item_engine_capacity_string)
-        if item_engine_capacity_string:
-            item_engine_capacity_full = int(item_engine_capacity_string.group(1)) / 1000
-        item_engine_capacity_rounded = self.float_round(item_engine_capacity_full, 1, direction=ceil)
+        item_engine_capacity_rounded = self.parse_engine_capacity(item_engine_capacity)
 
         try:
-            item_fuel_type = self.strip_all(item_fuel_type, concat_symb='')
+            item_fuel_type = self.strip_cached(item_fuel_type, concat_symb='')
         except Exception as err:
             logger.warning('Unable to process fuel type [{}] for article {}. '
                            'Fuel type set to benzyna'.format(item_mileage, link))
             item_fuel_type = 'benzyna'
 
         try:
-            seller_location = self.strip_all(seller_location)
+            seller_location = self.strip_cached(seller_location)
         except Exception as err:
             logger.warning('Unable to process seller location [{}] for article {}.'
                            ' Location set to "Unknown"'.format(seller_location, link))
             seller_location = 'Unknown'
 
         try:
-            seller_id = re.match(self.PATTERN_ID_FROM_URL, link).group(1)
+            seller_id = self.PATTERN_ID_FROM_URL.match(link).group(1)
         except Exception as err:
             logger.warning('Unable to process seller id for article {}.'
                            ' This article would be skipped.'.format(link))
@@ -254,15 +706,162 @@ class FilterArticle(object):
             logger.warning('Unable to process link for article {}.'
                            ' This article would be skipped.'.format(link))
 
-        return name, manufacturer, price, currency, price_detail, \
+        # values repeated across articles are kept once in memory
+        return name, intern(manufacturer), price, intern(currency), price_detail, \
               item_year, item_mileage, item_engine_capacity_rounded, \
-              item_fuel_type, link, seller_location, seller_id
+              intern(item_fuel_type), link, intern(seller_location), seller_id
+
+
+ARTICLE_FILTER = FilterArticle()
+
+# parsed article passed from parser to DB writer: filtered fields and phones of seller
+Article = namedtuple('Article', FilterArticle.FILTER_FIELDS + ('phones',))
+
+# price details and production years shared by articles of different pages, see compact_article
+SHARED_VALUES = {}
+
+
+def compact_article(article: Article) -> Article:
+    """
+    Articles unpickled from parse process have own copies of repeated values.
+    Replace them with interned strings and shared objects of this process.
+    """
+    return article._replace(
+        manufacturer=intern(article.manufacturer),
+        currency=intern(article.currency),
+        price_detail=SHARED_VALUES.setdefault(article.price_detail, article.price_detail),
+        item_year=SHARED_VALUES.setdefault(article.item_year, article.item_year),
+        item_fuel_type=intern(article.item_fuel_type),
+        seller_location=intern(article.seller_location),
+    )
+
+# search page extractors, compiled once
+XPATH_ARTICLES = etree.XPath('//article')
+# relative to article
+XPATH_CONTENT = etree.XPath('./div[@class="offer-item__content"]')
+# relative to article content
+XPATH_TITLE_LINK = etree.XPath('./div[@class="offer-item__title"]/h2/a')
+XPATH_PRICE_SPANS = etree.XPath('./div[@class="offer-item__price"]/div[@class="offer-price"]/span')
+XPATH_PARAMS_ITEMS = etree.XPath('./ul[@class="offer-item__params"]/li')
+XPATH_BOTTOM_ROW = etree.XPath('./div[contains(@class, "offer-item__bottom-row ")]')
+
+
+def extract_article(article) -> tuple:
+    """
+    Extract raw article fields in one pass over offer-item__content node.
+    Missing field is None, field without text is empty string (same as findtext).
+
+    :param article: article element of search page
+    :return: (tuple) arguments for FilterArticle.filter
+    """
+    content = XPATH_CONTENT(article)[0]
+
+    link_element = XPATH_TITLE_LINK(content)[0]
+    name = link_element.text or ''
+    link = link_element.attrib['href']
+
+    # price details
+    price = currency = price_detail = None
+    for span in XPATH_PRICE_SPANS(content):
+        span_class = span.get('class')
+        if span_class == 'offer-price__number' and price is None:
+            price = span.text or ''
+            for child in span:
+                if child.tag == 'span' and child.get('class') == 'offer-price__currency':
+                    currency = child.text or ''
+                    break
+        elif span_class == 'offer-price__details' and price_detail is None:
+            price_detail = span.text or ''
+
+    # car parameters
+    params = {}
+    for item in XPATH_PARAMS_ITEMS(content):
+        value = item.find('span')
+        if value is not None:
+            params.setdefault(item.get('data-code'), value.text or '')
+
+    # location
+    location = ''
+    bottom_row = XPATH_BOTTOM_ROW(content)
+    if bottom_row:
+        location = bottom_row[0].findtext('./span[@class="offer-item__location"]/h4')
+
+    return name, price, currency, price_detail, \
+        params.get('year'), params.get('mileage'), params.get('engine_capacity'), params.get('fuel_type'), \
+        link, location
+
+
+def parse_page_count(page_content: str):
+    """
+    Get number of result pages from pager of search page.
+
+    :param page_content: (str) page content
+    :return: (int) pages count or None if pager not found
+    """
+    root = html.fromstring(page_content)
+
+    try:
+        page_anchor = root.xpath('//ul[@class="om-pager rel"]')[0]
+        page_count = page_anchor.xpath('./li[position() = last() - 1]/a/span/text()')[0]
+    except Exception:
+        return None
+
+    return int(page_count)
+
+
+# parse_articles timings and failures, returned to the caller because it could run in another process
+ParseStats = namedtuple('ParseStats', ('extract_seconds', 'filter_seconds', 'extract_failed', 'filter_failed'))
+
+
+def parse_articles(page_content: str) -> tuple:
+    """
+    Parse items of search page and filter them with FilterArticle.
+    Function is executed in parse executor (could be another process), so
+    it's kept at module level.
+
+    :param page_content: (str) page content
+    :return: (tuple) list of Article records without phones, ParseStats
+    """
+    articles_fields = []
+
+    start = time.perf_counter()
+    root = html.fromstring(page_content)
+
+    rows = []
+    extract_failed = 0
+    for article in XPATH_ARTICLES(root):
+        try:
+            rows.append(extract_article(article))
+        except Exception as err:
+            extract_failed += 1
+            logger.warning('failed to extract article. Reason: {}'.format(err))
+    extracted = time.perf_counter()
+
+    filter_failed = 0
+    for raw_fields, fields in zip(rows, ARTICLE_FILTER.get_fields_many(rows)):
+        if not fields:
+            filter_failed += 1
+            logger.warning('failed to parse article at {}'.format(raw_fields[8]))
+        else:
+            articles_fields.append(Article(*fields, phones=()))
+
+    stats = ParseStats(extracted - start, time.perf_counter() - extracted, extract_failed, filter_failed)
+
+    return articles_fields, stats
+
+
+# seconds between work queue checks of idle worker
+WORKER_POLL = 5
+# attempts of worker transaction when DB is locked by another process
+DB_WRITE_RETRIES = 5
+# endpoint classes of rate limiter and metrics labels
+ENDPOINT_CLASSES = (('phones', r'/ajax/misc/contact/multi_phone/'), ('search', r''))
 
 
 class Scraper(object):
 
     BASE_URL = 'https://www.otomoto.pl/oferty/'
-    ENTRY_URL = None
+    PHONE_URL = 'https://www.otomoto.pl/ajax/misc/contact/multi_phone/{0}/{1}/'
 
     def __init__(self, *args, **kwargs):
         assert len(args) == 8
@@ -278,42 +877,458 @@ class Scraper(object):
         self.fuel_type = fuel_type
         self.damaged = damaged
 
-        async_limit = kwargs.get('limit', 50)
-        self.semaphore = asyncio.Semaphore(async_limit)
+        self.async_limit = kwargs.get('limit', 50)
+        self.host_limit = kwargs.get('host_limit', 0)
+        self.retries = kwargs.get('retries', 3)
+        # semaphore is bound to event loop, so it's created in init_session
+        self.semaphore = None
+
+        # adaptive requests rate per host and endpoint class, kept between runs of this scraper
+        self.rate_limiter = None
+        if kwargs.get('rate', 10.0):
+            self.rate_limiter = RateLimiter(
+                classes=ENDPOINT_CLASSES,
+                rate=kwargs.get('rate', 10.0),
+                max_rate=kwargs.get('max_rate', 200.0),
+            )
 
         self.timeout = kwargs.get('timeout', 15)
 
+        # max pages of one search (site doesn't show more), with sharding - of one shard
         self.parse_limit = kwargs.get('pages_limit', 500)
+        self.shard = kwargs.get('shard', False)
+
+        # work queue mode: seconds before leased page is given to another worker
+        self.lease_time = kwargs.get('lease_time', 300)
+        # continue unfinished crawl of the same search from its pages in work queue
+        self.resume = kwargs.get('resume', False)
+
+        # result of the last crawl: all pages and articles parsed without errors, ids of all found articles
+        self.crawl_complete = False
+        self.pages_failed = 0
+        self.articles_failed = 0
+        self.pages_truncated = False
+        self.seen_ids = set()
+
+        # phones mode: inline - fetch while crawling, defer - fetch by separate run_phones pass, off - skip
+        self.phones_mode = kwargs.get('phones', 'inline')
+        self.phone_probe = kwargs.get('phone_probe', 1)
+
+        # incremental mode: newest-first results, crawled by windows of pages until known page found
+        self.incremental = kwargs.get('incremental', False)
+        self.incremental_window = kwargs.get('incremental_window', 2)
+
+        # stream mode settings
+        self.batch_size = kwargs.get('batch_size', 500)
+        self.queue_size = kwargs.get('queue_size', 64)
+
+        # on-disk responses cache, disabled if path isn't set
+        self.response_cache = None
+        cache_path = kwargs.get('cache')
+        if cache_path:
+            self.response_cache = ResponseCache(
+                cache_path,
+                ttl=kwargs.get('cache_ttl', 3600),
+                ttl_rules=((r'/ajax/misc/contact/multi_phone/', kwargs.get('phone_cache_ttl', 7 * 24 * 3600)),),
+                max_size=kwargs.get('cache_size', 512) * 1024 * 1024,
+                # the last phone probe of seller ends with error response
+                negative_patterns=(r'/ajax/misc/contact/multi_phone/',),
+            )
+
+        # record responses to directory or replay them from it instead of network
+        self.recorder = ResponseRecorder(kwargs['record']) if kwargs.get('record') else None
+        self.replay = ResponseReplay(kwargs['replay'], latency=kwargs.get('replay_latency', 0.0)) \
+            if kwargs.get('replay') else None
+
+        # parse executor: number of workers (0 - parse in event loop) and type (process or thread)
+        self.parse_workers = kwargs.get('parse_workers', 0)
+        self.parse_executor = kwargs.get('parse_executor', 'process')
+        self.executor = None
+
+    def start(self, db_session=None):
+        """
+        Run scraper in own event loop.
 
-        self.filter = FilterArticle()
+        :param db_session: if passed, articles are written to DB while crawling (stream mode)
+        and number of inserted articles is returned instead of scraped data
+        """
+        if db_session is None:
+            return self.run_in_loop(self.run())
+        if self.incremental:
+            return self.run_in_loop(self.run_incremental(db_session))
+        return self.run_in_loop(self.run_stream(db_session))
+
+    def start_coordinator(self, db_session) -> int:
+        return self.run_in_loop(self.run_enqueue(db_session))
+
+    def start_worker(self, db_session) -> int:
+        return self.run_in_loop(self.run_worker(db_session))
 
-    def start(self):
+    def start_phones(self, db_session):
+        return self.run_in_loop(self.run_phones(db_session))
+
+    def run_in_loop(self, coro):
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
 
-        result = loop.run_until_complete(self.run())
-
-        loop.close()
+        self.executor = self.init_executor()
+        try:
+            result = loop.run_until_complete(coro)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+            loop.close()
 
         return result
 
+    def init_executor(self):
+        if not self.parse_workers:
+            return None
+        if self.parse_executor == 'thread':
+            return ThreadPoolExecutor(max_workers=self.parse_workers)
+        return ProcessPoolExecutor(max_workers=self.parse_workers)
+
     async def run(self):
         # create session
         self.session = await self.init_session()
 
-        # get url's list
-        urls = await self.prepare()
+        self.pages_failed = 0
+        self.articles_failed = 0
+
+        try:
+            # get url's list
+            urls = await self.prepare()
 
-        coros = []
-        for url in urls[:self.parse_limit]:
-            coros.append(self.scrap_content(url))
+            coros = []
+            for url in urls:
+                coros.append(self.scrap_content(url))
 
-        result = await asyncio.gather(*coros, return_exceptions=True)
+            result = await asyncio.gather(*coros, return_exceptions=True)
 
-        self.session.close()
+            self.pages_failed += sum(isinstance(item, Exception) for item in result)
+            self.crawl_complete = self.check_complete(urls)
+        finally:
+            await self.close_session()
 
         return result
 
+    async def run_stream(self, db_session) -> int:
+        """
+        Crawl pages with a fixed pool of workers and pass parsed articles to DB writer
+        through bounded queue. Workers wait while queue is full, so memory usage
+        does not depend on number of pages.
+
+        :param db_session: DB session
+        :return: (int) number of inserted articles
+        """
+        self.session = await self.init_session()
+        self.pages_failed = 0
+        self.articles_failed = 0
+
+        try:
+            urls = await self.prepare()
+
+            url_queue = asyncio.Queue()
+            for url in urls:
+                url_queue.put_nowait(url)
+
+            article_queue = asyncio.Queue(maxsize=self.queue_size)
+
+            workers = [self.stream_worker(url_queue, article_queue) for _ in range(self.async_limit)]
+            crawl = asyncio.ensure_future(asyncio.gather(*workers))
+            writer = asyncio.ensure_future(self.stream_writer(db_session, article_queue))
+
+            # FIRST_EXCEPTION would wait for writer after crawl finished normally, and writer waits for
+            # end-of-crawl mark
+            await asyncio.wait([crawl, writer], return_when=asyncio.FIRST_COMPLETED)
+            if writer.done():
+                # writer could finish only with an error before end-of-crawl mark
+                crawl.cancel()
+                return writer.result()
+            if crawl.exception() is not None:
+                writer.cancel()
+                raise crawl.exception()
+
+            self.crawl_complete = self.check_complete(urls)
+            await article_queue.put(None)
+            return await writer
+        finally:
+            await self.close_session()
+
+    async def run_incremental(self, db_session) -> int:
+        """
+        Crawl newest-first results in windows of pages and stop after the window
+        where a whole page contains only articles known from DB or this run.
+        Phones are fetched for new articles only.
+
+        :param db_session: DB session
+        :return: (int) number of inserted articles
+        """
+        self.session = await self.init_session()
+
+        try:
+            urls = await self.prepare()
+
+            checkpoint = checkpoint_get_or_create(db_session, self.form_payload())
+            checkpoint.last_start = datetime.datetime.now(tz=pytz.utc)
+            checkpoint.status = False
+            db_meta = db_start(db_session)
+
+            # newest pages only, so incremental crawl is never complete
+            self.crawl_complete = False
+            self.seen_ids = ids_pool = set()
+            pages_counter = 0
+            ins_counter = 0
+            upd_counter = 0
+            for i in range(0, len(urls), self.incremental_window):
+                collections = await asyncio.gather(*[self.scrap_content(url, phones=False)
+                                                     for url in urls[i:i + self.incremental_window]],
+                                                   return_exceptions=True)
+
+                known_page_found = False
+                for collection in collections:
+                    if isinstance(collection, Exception):
+                        logger.error('Page processing failed. Reason: {}'.format(collection))
+                        continue
+                    pages_counter += 1
+
+                    new_articles, changed_articles = db_split_articles(db_session, collection, ids_pool)
+                    if collection and not new_articles:
+                        known_page_found = True
+
+                    new_articles = dict(zip(new_articles, await self.resolve_phones(list(new_articles.values()))))
+                    ins_counter += db_write(db_session, new_articles)
+                    upd_counter += db_update_prices(db_session, changed_articles)
+
+                with REGISTRY.timer('db_commit'):
+                    db_session.commit()
+
+                if known_page_found:
+                    logger.info('Page with known articles only found, {} of {} pages crawled.'.format(
+                        pages_counter, len(urls)))
+                    break
+
+            checkpoint.last_finish = datetime.datetime.now(tz=pytz.utc)
+            checkpoint.pages_crawled = pages_counter
+            checkpoint.articles_inserted = ins_counter
+            checkpoint.status = True
+            db_finish(db_session, db_meta, ins_counter, upd_counter, complete=False)
+
+            return ins_counter
+        finally:
+            await self.close_session()
+
+    async def run_enqueue(self, db_session) -> int:
+        """
+        Coordinator part: put pages of search (or of its shards) to work queue.
+        Pages are crawled by run_worker, run is finished by db_finish_queue.
+
+        With resume option unfinished crawl of the search continues: its done pages and counters are kept,
+        so only pages which weren't crawled or failed are crawled now.
+
+        :param db_session: DB session
+        :return: (int) id of search checkpoint
+        """
+        self.session = await self.init_session()
+
+        try:
+            urls = await self.prepare()
+        finally:
+            await self.close_session()
+
+        checkpoint = checkpoint_get_or_create(db_session, self.form_payload())
+        # finished crawl is started again even with resume option
+        resume = self.resume and checkpoint.id is not None and not checkpoint.status
+        if not resume:
+            checkpoint.last_start = datetime.datetime.now(tz=pytz.utc)
+            checkpoint.pages_crawled = 0
+            checkpoint.articles_inserted = 0
+            checkpoint.prices_updated = 0
+        checkpoint.status = False
+        db_start(db_session)
+
+        queue = WorkQueue(db_session)
+        added = queue.enqueue(checkpoint.id, urls, resume=resume)
+        db_session.commit()
+
+        if resume:
+            stats = queue.stats(checkpoint.id)
+            logger.info('Crawl started at {} resumed: {} pages done, {} pages queued.'.format(
+                checkpoint.last_start, stats.get(DONE, 0), stats.get(PENDING, 0)))
+        else:
+            logger.info('{} pages queued, {} left from previous run.'.format(added, len(urls) - added))
+
+        return checkpoint.id
+
+    async def run_worker(self, db_session) -> int:
+        """
+        Lease pages from work queue, crawl them and write their articles together with the done mark
+        in one transaction. Runs until no page is pending or in flight.
+
+        :param db_session: DB session
+        :return: (int) number of inserted articles
+        """
+        self.session = await self.init_session()
+
+        queue = WorkQueue(db_session, lease_time=self.lease_time)
+        owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+        ins_counter = 0
+        try:
+            while True:
+                tasks = await self.lease_tasks(db_session, queue, owner)
+                if not tasks:
+                    if not queue.active():
+                        break
+                    # pages are leased by other workers, wait for them to finish or expire
+                    await asyncio.sleep(WORKER_POLL)
+                    continue
+
+                results = await asyncio.gather(*[self.scrap_task(url) for _, _, url in tasks],
+                                               return_exceptions=True)
+                ins_counter += await self.write_tasks(db_session, queue, tasks, results)
+
+            logger.info('Worker {} finished, {} articles inserted.'.format(owner, ins_counter))
+
+            return ins_counter
+        finally:
+            await self.close_session()
+
+    async def lease_tasks(self, db_session, queue: WorkQueue, owner: str) -> list:
+        """
+        Lease pages from work queue, lease is repeated if DB is locked by another worker.
+
+        :return: (list) (task id, checkpoint id, url) tuples
+        """
+        for attempt in range(1, DB_WRITE_RETRIES + 1):
+            try:
+                return queue.lease(owner, self.async_limit)
+            except OperationalError as err:
+                db_session.rollback()
+                if attempt == DB_WRITE_RETRIES:
+                    raise
+                logger.warning('Lease failed, attempt {} of {}. Reason: {}'.format(attempt, DB_WRITE_RETRIES, err))
+                await asyncio.sleep(attempt)
+
+    async def scrap_task(self, url: str) -> list:
+        collection = await self.fetch_page(url)
+        if collection is None:
+            raise RuntimeError('Response status != 200 at {}'.format(url))
+        return collection
+
+    async def write_tasks(self, db_session, queue: WorkQueue, tasks: list, results: list) -> int:
+        """
+        Write articles of crawled pages, mark pages as done or failed and update search checkpoints.
+        Transaction is repeated if DB is locked by another worker or another worker inserted the same
+        article or dictionary value in the meantime. Rollback drops dictionary cache of the session,
+        so the next attempt reloads it.
+
+        :return: (int) number of inserted articles
+        """
+        for attempt in range(1, DB_WRITE_RETRIES + 1):
+            try:
+                ins_counter = 0
+                failed = []
+                progress = {}
+                ids_pool = set()
+                for (task_id, checkpoint_id, url), collection in zip(tasks, results):
+                    if isinstance(collection, Exception):
+                        logger.error('Processing of {} failed. Reason: {}'.format(url, collection))
+                        failed.append(task_id)
+                        continue
+
+                    inserted, updated = db_insert(db_session, collection, ids_pool)
+                    ins_counter += inserted
+
+                    task_ids, pages_inserted, pages_updated = progress.get(checkpoint_id, ([], 0, 0))
+                    task_ids.append(task_id)
+                    progress[checkpoint_id] = (task_ids, pages_inserted + inserted, pages_updated + updated)
+
+                queue.fail(failed)
+                for checkpoint_id, (task_ids, inserted, updated) in progress.items():
+                    queue.complete(task_ids)
+                    queue.progress(checkpoint_id, len(task_ids), inserted, updated)
+                with REGISTRY.timer('db_commit'):
+                    db_session.commit()
+
+                return ins_counter
+            except (OperationalError, IntegrityError) as err:
+                db_session.rollback()
+                if attempt == DB_WRITE_RETRIES:
+                    raise
+                logger.warning('DB write failed, attempt {} of {}. Reason: {}'.format(attempt, DB_WRITE_RETRIES, err))
+                await asyncio.sleep(attempt)
+
+    async def stream_worker(self, url_queue: asyncio.Queue, article_queue: asyncio.Queue):
+        while True:
+            try:
+                url = url_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+
+            try:
+                collection = await self.scrap_content(url)
+            except Exception as err:
+                logger.error('Processing of {} failed. Reason: {}'.format(url, err))
+                self.pages_failed += 1
+                continue
+
+            if collection:
+                await article_queue.put(collection)
+
+    async def stream_writer(self, db_session, article_queue: asyncio.Queue) -> int:
+        """
+        Get parsed articles from queue and commit them to DB in batches.
+        Queue item None marks the end of crawl.
+        """
+        db_meta = db_start(db_session)
+
+        self.seen_ids = ids_pool = set()
+        batch = []
+        found_counter = 0
+        ins_counter = 0
+        upd_counter = 0
+        while True:
+            collection = await article_queue.get()
+            if collection is not None:
+                batch.extend(collection)
+                found_counter += len(collection)
+
+            if batch and (collection is None or len(batch) >= self.batch_size):
+                inserted, updated = db_insert(db_session, batch, ids_pool)
+                ins_counter += inserted
+                upd_counter += updated
+                with REGISTRY.timer('db_commit'):
+                    db_session.commit()
+                logger.info('{} articles processed, {} inserted, {} price changes.'.format(
+                    found_counter, ins_counter, upd_counter))
+                batch = []
+
+            if collection is None:
+                break
+
+        db_finish(db_session, db_meta, ins_counter, upd_counter, complete=self.crawl_complete)
+
+        return ins_counter
+
+    def check_complete(self, urls: list) -> bool:
+        """
+        Crawl is complete if search has pages, all of them are within pages_limit and none failed.
+        Articles of 200 pages that failed to parse aren't in seen_ids either, so they make crawl partial too.
+        """
+        if not urls:
+            return False
+        if self.pages_truncated:
+            return False
+        if self.pages_failed:
+            logger.warning('{} of {} pages failed.'.format(self.pages_failed, len(urls)))
+            return False
+        if self.articles_failed:
+            logger.warning('{} articles failed to parse.'.format(self.articles_failed))
+            return False
+        return True
+
     async def init_session(self):
         HEADERS = {
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
@@ -328,29 +1343,111 @@ class Scraper(object):
             'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) '
                           'Chrome/61.0.3163.100 Safari/537.36 OPR/48.0.2685.50',
         }
-        session = GSession(headers=HEADERS)
+        self.semaphore = asyncio.Semaphore(self.async_limit)
+        session = GSession(headers=HEADERS, limit=self.async_limit, limit_per_host=self.host_limit,
+                           retries=self.retries, rate_limiter=self.rate_limiter, cache=self.response_cache,
+                           recorder=self.recorder, replay=self.replay, metrics=REGISTRY,
+                           endpoints=EndpointClassifier(ENDPOINT_CLASSES))
         return session
 
+    async def close_session(self):
+        await self.session.close()
+
+        if self.response_cache is not None:
+            self.response_cache.flush()
+            logger.info('Responses cache stats: {}'.format(self.response_cache.stats()))
+        if self.rate_limiter is not None:
+            logger.info('Requests rate (per second): {}'.format(self.rate_limiter.rates()))
+
     async def prepare(self) -> list:
-        payload = self.form_payload()
+        """
+        Get pages urls of search, or of all its shards if sharding is enabled.
+        Pages over pages_limit of one search are dropped and crawl is marked as partial.
+        """
+        self.pages_truncated = False
+
+        if self.shard:
+            return await self.prepare_shards()
+
+        urls = await self.search_pages(self.form_payload())
+        if urls is None:
+            self.pages_truncated = True
+            return []
+        if len(urls) > self.parse_limit:
+            logger.warning('{} of {} pages crawled because of pages limit.'.format(self.parse_limit, len(urls)))
+            self.pages_truncated = True
+        return urls[:self.parse_limit]
+
+    async def prepare_shards(self) -> list:
+        """
+        Split search by year and price ranges until every shard fits in pages_limit.
+        Shards are probed level by level, probes of one level run concurrently.
+        """
+        root = SearchShard(self.value_min or 0, self.value_max or 0, self.year_from.year, self.year_to.year)
+
+        urls = []
+        shards_counter = 0
+        level = [root]
+        while level:
+            results = await asyncio.gather(*[self.search_pages(self.form_payload(shard)) for shard in level],
+                                           return_exceptions=True)
+            next_level = []
+            for shard, pages in zip(level, results):
+                if isinstance(pages, Exception) or pages is None:
+                    logger.error('Probe of shard {} failed. Reason: {}'.format(shard, pages))
+                    self.pages_truncated = True
+                    continue
+
+                if len(pages) <= self.parse_limit:
+                    shards_counter += 1
+                    urls.extend(pages)
+                    continue
+
+                halves = split_shard(shard)
+                if halves is None:
+                    logger.warning('Shard {} has {} pages and can\'t be split, {} pages crawled.'.format(
+                        shard, len(pages), self.parse_limit))
+                    self.pages_truncated = True
+                    shards_counter += 1
+                    urls.extend(pages[:self.parse_limit])
+                else:
+                    next_level.extend(halves)
+            level = next_level
+
+        logger.info('Search split in {} shards, {} pages.'.format(shards_counter, len(urls)))
+
+        return urls
+
+    async def search_pages(self, payload: dict):
+        """
+        :return: (list) pages urls of search or None if search request failed
+        """
         response = await self.session.post(self.BASE_URL, data=payload, semaphore=self.semaphore, timeout=self.timeout)
         if response.status == 200:
             # get pages urls
-            self.ENTRY_URL = response.url
-            urls = await self.parse_url_range(response.content)
+            urls = await self.parse_url_range(response.content, response.url)
             return urls
         else:
             logger.error('Prepare stage failed: response status {}'.format(response.status))
-            return []
+            return None
+
+    def form_payload(self, shard: SearchShard = None) -> dict:
+        """
+        :param shard: search range replacing price and year filters
+        """
+        if shard is None:
+            value_min, value_max, year_from, year_to = \
+                self.value_min, self.value_max, self.year_from.year, self.year_to.year
+        else:
+            value_min, value_max, year_from, year_to = shard
 
-    def form_payload(self) -> str:
         payload = {
             'search[category_id]': 29,
             'search[filter_enum_make]': '',
-            'search[filter_float_price:from]': self.value_min or '',
-            'search[filter_float_price:to]': self.value_max or '',
-            'search[filter_float_year:from]': self.year_from.year or '',
-            'search[filter_float_year:to]': self.year_to.year or '',
+            'search[filter_float_price:from]': value_min or '',
+            'search[filter_float_price:to]': value_max or '',
+            'search[filter_float_year:from]': year_from or '',
+            'search[filter_float_year:to]': year_to or '',
             'search[filter_float_mileage:from]': self.mileage_min or '',
             'search[filter_float_mileage:to]': self.mileage_max or '',
             'search[filter_enum_fuel_type]': self.fuel_type or '',
@@ -358,127 +1455,180 @@ class Scraper(object):
             'search[filter_enum_no_accident]': '1' if not self.damaged else '',
         }
 
-        return payload
+        if self.incremental:
+            payload['search[order]'] = 'created_at:desc'
 
-    async def scrap_content(self, url: str) -> list:
-        logger.debug('Start of processing {}'.format(url))
+        return payload
 
-        response = await self.session.get(url, semaphore=self.semaphore, timeout=self.timeout)
-        if response.status == 200:
-            content_data = await self.parse_content(response.content)
-            return content_data
-        else:
-            logger.warning('Response status != 200 at {}'.format(url))
+    async def scrap_content(self, url: str, phones: bool = True) -> list:
+        collection = await self.fetch_page(url, phones=phones)
+        if collection is None:
+            self.pages_failed += 1
             return []
+        return collection
+
+    async def fetch_page(self, url: str, phones: bool = True):
+        """
+        Get and parse search page, recorded by page timer and pages counter.
+        Errors raised after the last retry are counted as failed pages too.
+
+        :return: (list) Article records or None if response status isn't 200
+        """
+        logger.debug('Start of processing {}'.format(url))
 
-    async def parse_url_range(self, page_content: str) -> list:
+        with REGISTRY.timer('page'):
+            try:
+                response = await self.session.get(url, semaphore=self.semaphore, timeout=self.timeout)
+                if response.status != 200:
+                    logger.warning('Response status {} at {}'.format(response.status, url))
+                    REGISTRY.inc('pages', result='failed')
+                    return None
+                content_data = await self.parse_content(response.content, phones=phones)
+            except Exception:
+                REGISTRY.inc('pages', result='failed')
+                raise
+
+        REGISTRY.inc('pages', result='ok')
+        return content_data
+
+    async def parse_url_range(self, page_content: str, entry_url: str) -> list:
         """
         This method is used for obtaining list if URL's with car articles.
         Each article contains up to 32 offers.
 
-        :param page_content:
+        :param page_content: first page of search
+        :param entry_url: url of search results
         :return:
         """
-        root = html.fromstring(page_content)
-
-        try:
-            page_anchor = root.xpath('//ul[@class="om-pager rel"]')[0]
-            page_count = page_anchor.xpath('./li[position() = last() - 1]/a/span/text()')[0]
-        except Exception:
-            logger.warning('No articles found on a page. Empty list will be returned')
-            return []
+        page_count = await self.in_executor(parse_page_count, page_content)
+        if page_count is None:
+            logger.debug('No pager found on a page, results fit one page.')
+            page_count = 1
 
         urls = []
-        for i in range(1, int(page_count)):
-            urls.append('{}&page={}'.format(self.ENTRY_URL, i))
+        for i in range(1, page_count + 1):
+            urls.append('{}&page={}'.format(entry_url, i))
 
         return urls
 
-    async def parse_content(self, page_content: str) -> list:
+    async def parse_content(self, page_content: str, phones: bool = True) -> list:
         """
         This function parse content of items in search page.
 
         :param page_content: (str) page content
-        :return:
+        :param phones: resolve phones of articles, otherwise it's left to the caller
+        :return: (list) Article records
         """
-        articles_data = []
-
-        root = html.fromstring(page_content)
-
-        articles = root.xpath('//article')
-
-        for article in articles:
-            # TODO: take out offer-item__content to the outer scope
-            name = article.findtext('./div[@class="offer-item__content"]/div[@class="offer-item__title"]/h2/a')
-
-            link_element = article.find('./div[@class="offer-item__content"]/div[@class="offer-item__title"]/h2/a')
-            link = link_element.attrib['href']
-
-            # price details
-            offer_detail = article.find('./div[@class="offer-item__content"]/div[@class="offer-item__price"]/'
-                                 'div[@class="offer-price"]')
-            price = offer_detail.findtext('./span[@class="offer-price__number"]')
-            currency = offer_detail.findtext('./span[@class="offer-price__number"]/span[@class="offer-price__currency"]')
-            price_detail = offer_detail.findtext('./span[@class="offer-price__details"]')
-
-            # car parameters
-            item_params = article.find('./div[@class="offer-item__content"]/ul[@class="offer-item__params"]')
-            item_year = item_params.findtext('./li[@data-code="year"]/span')
-            item_mileage = item_params.findtext('./li[@data-code="mileage"]/span')
-            item_engine_capacity = item_params.findtext('./li[@data-code="engine_capacity"]/span')
-            item_fuel_type = item_params.findtext('./li[@data-code="fuel_type"]/span')
-
-            # location
-            location_temp = article.xpath('./div[@class="offer-item__content"]'
-                                    '/div[contains(@class, "offer-item__bottom-row ")]')
-            location = ''
-            if location_temp:
-                location = location_temp[0].findtext('./span[@class="offer-item__location"]/h4')
-
-            # logger.debug(name, price, currency, price_detail, item_year, item_mileage, item_engine_capacity, item_fuel_type, link)
-            article_data = self.filter.get_dict(
-                                            name,
-                                            price,
-                                            currency,
-                                            price_detail,
-                                            item_year,
-                                            item_mileage,
-                                            item_engine_capacity,
-                                            item_fuel_type,
-                                            link,
-                                            location
-            )
+        with REGISTRY.timer('parse'):
+            articles_data, stats = await self.in_executor(parse_articles, page_content)
 
-            if not article_data:
-                logger.warning('failed to parse article at {}'.format(link))
-            else:
-                phones = await self.get_phones(article_data['seller_id'])
-                article_data['phones'] = phones
-                articles_data.append(article_data)
+        REGISTRY.observe('extract', stats.extract_seconds)
+        REGISTRY.observe('filter', stats.filter_seconds)
+        REGISTRY.inc('parse_failures', stats.extract_failed, stage='extract')
+        REGISTRY.inc('parse_failures', stats.filter_failed, stage='filter')
+        REGISTRY.inc('articles_parsed', len(articles_data))
+        self.articles_failed += stats.extract_failed + stats.filter_failed
+
+        if isinstance(self.executor, ProcessPoolExecutor):
+            articles_data = [compact_article(article) for article in articles_data]
+
+        if phones:
+            articles_data = await self.resolve_phones(articles_data)
 
         return articles_data
 
+    async def in_executor(self, func, *args):
+        """
+        Run CPU-bound func in parse executor or directly in event loop if executor isn't set.
+        """
+        if self.executor is None:
+            return func(*args)
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    async def resolve_phones(self, articles_data: list) -> list:
+        """
+        Fetch phones of all articles from page simultaneously.
+        In "defer" and "off" modes articles are left with empty phones.
+
+        :return: (list) Article records with phones
+        """
+        if self.phones_mode != 'inline':
+            return articles_data
+
+        results = await asyncio.gather(*[self.get_phones(article_data.seller_id)
+                                         for article_data in articles_data], return_exceptions=True)
+        resolved = []
+        for article_data, phones in zip(articles_data, results):
+            if isinstance(phones, Exception):
+                logger.warning('Unable to get phones for article {}. Reason: {}'.format(article_data.link, phones))
+                phones = ()
+            resolved.append(article_data._replace(phones=phones))
+        return resolved
+
     async def get_phones(self, seller_id: str) -> list:
+        """
+        Probe phone numbers of seller by counter until non-200 response.
+        Counters are requested in windows of phone_probe size simultaneously.
+        """
         phones = []
         counter = 0
-        while True:
-            response = await self.session.get('https://www.otomoto.pl/ajax/misc/contact/multi_phone/{0}/{1}/'.format(
-                seller_id,
-                counter
-            ), semaphore=self.semaphore)
-            if response.status != 200:
-                break
-            phones.append(json.loads(response.content)['value'].replace(' ', ''))
-            counter += 1
-        return phones
+        with REGISTRY.timer('phone_lookup'):
+            while True:
+                responses = await asyncio.gather(*[
+                    self.session.get(self.PHONE_URL.format(seller_id, counter + i), semaphore=self.semaphore)
+                    for i in range(self.phone_probe)
+                ])
+                for response in responses:
+                    if response.status != 200:
+                        REGISTRY.inc('phones_found', len(phones))
+                        return phones
+                    phones.append(json.loads(response.content)['value'].replace(' ', ''))
+                counter += self.phone_probe
+
+    async def run_phones(self, db_session, chunk_size: int = 500) -> int:
+        """
+        Deferred phones pass: fetch phones for stored articles that have none.
+
+        :param db_session: DB session
+        :param chunk_size: number of articles processed and committed at once
+        :return: (int) number of inserted phones
+        """
+        self.session = await self.init_session()
+
+        try:
+            missing = db_session.query(CarArticle.id, CarArticle.seller_id)\
+                .outerjoin(Phone, Phone.car_id == CarArticle.id)\
+                .filter(Phone.id.is_(None))\
+                .all()
+            logger.info('{} articles without phones found.'.format(len(missing)))
+
+            ins_counter = 0
+            for i in range(0, len(missing), chunk_size):
+                chunk = missing[i:i + chunk_size]
+                results = await asyncio.gather(*[self.get_phones(seller_id) for _, seller_id in chunk],
+                                               return_exceptions=True)
+
+                phones = []
+                for (article_id, _), numbers in zip(chunk, results):
+                    if isinstance(numbers, Exception):
+                        logger.warning('Unable to get phones for article {}. Reason: {}'.format(article_id, numbers))
+                        continue
+                    phones.extend({'number': number, 'car_id': article_id} for number in numbers)
+
+                if phones:
+                    db_session.execute(Phone.__table__.insert(), phones)
+                    with REGISTRY.timer('db_commit'):
+                        db_session.commit()
+                ins_counter += len(phones)
+
+            return ins_counter
+        finally:
+            await self.close_session()
 
 if __name__ == '__main__':
 
     tear_up()
 
-    session = setup_db()
-
-    logger = logging.getLogger(__name__)
     logger.setLevel(logging.INFO)
 
     log_formatter = logging.Formatter('[%(asctime)s](App: %(name)s)<Level: %(levelname)s>: %(message)s')
@@ -496,12 +1646,65 @@ if __name__ == '__main__':
     logger.addHandler(con_handler)
     logger.addHandler(file_handler)
 
-    input_args = args_init()
+    input_args, options = args_init()
+
+    raw_insert = options.insert == 'sqlite3'
+    session = setup_db(db_url=options.db_url, raw_insert=raw_insert)
 
-    scraper = Scraper(*input_args, limit=50, pages_limit=500)
+    scraper_kwargs = dict(limit=options.limit, host_limit=options.host_limit,
+                          retries=options.retries, rate=options.rate, max_rate=options.max_rate, pages_limit=500,
+                          phones=options.phones, phone_probe=options.phone_probe,
+                          parse_workers=options.parse_workers, parse_executor=options.parse_executor,
+                          batch_size=options.batch_size, queue_size=options.queue_size,
+                          incremental=options.incremental, incremental_window=options.incremental_window,
+                          shard=options.shard, lease_time=options.lease_time, resume=options.resume,
+                          cache=options.cache, cache_ttl=options.cache_ttl, phone_cache_ttl=options.phone_cache_ttl,
+                          cache_size=options.cache_size,
+                          record=options.record, replay=options.replay, replay_latency=options.replay_latency)
+    scraper = Scraper(*input_args, **scraper_kwargs)
 
     logger.info('Scraping started.')
 
-    data = scraper.start()
+    if options.coordinator or options.resume:
+        checkpoint_id = scraper.start_coordinator(session)
+
+        workers = [multiprocessing.Process(target=worker_process,
+                                           args=(input_args, scraper_kwargs, options.db_url, options.metrics,
+                                                 raw_insert))
+                   for _ in range(options.workers)]
+        for worker in workers:
+            worker.start()
+
+        # coordinator crawls too, so queue is processed even if local workers die
+        scraper.start_worker(session)
+        for worker in workers:
+            worker.join()
+
+        db_finish_queue(session, checkpoint_id, complete=not scraper.pages_truncated)
+    elif options.worker:
+        scraper.start_worker(session)
+    elif options.stream or options.incremental:
+        scraper.start(db_session=session)
+        seen_ids = scraper.seen_ids
+    else:
+        data = scraper.start()
+
+        seen_ids = db_fill(session, data, complete=scraper.crawl_complete)
+
+    if options.sweep:
+        if meta_get_or_create(session, MetaInfo).status:
+            logger.info('Sweep of delisted articles started.')
+            deleted, restored = db_sweep(session, seen_ids, scraper.year_from.year, scraper.year_to.year)
+            session.commit()
+            logger.info('{} articles marked as delisted, {} found again.'.format(deleted, restored))
+        else:
+            logger.warning('Crawl is partial, sweep of delisted articles skipped.')
+
+    if options.phones == 'defer':
+        logger.info('Phones lookup started.')
+        phones_count = scraper.start_phones(session)
+        logger.info('{} phones inserted.'.format(phones_count))
 
-    db_fill(session, data)
\ No newline at end of file
+    logger.info('Run metrics:\n{}'.format(REGISTRY.summary()))
+    if options.metrics:
+        REGISTRY.write(options.metrics)
\ No newline at end of file
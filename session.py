@@ -1,9 +1,426 @@
 import asyncio
 import aiohttp
+from hashlib import md5
+import json
 import logging
+import os
+import random
+import re
+import sqlite3
+import time
+from urllib.parse import urlsplit
+
+from metrics import Metrics
 
 # TODO: add file output for logger
 
+
+class RetryBudget(object):
+    """
+    Limit share of retried requests for the whole session.
+    Retry is allowed while retries < min_retries + ratio * requests, so when
+    the site is down we stop retrying instead of multiplying the load.
+    """
+
+    def __init__(self, ratio=0.2, min_retries=10):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.requests = 0
+        self.retries = 0
+
+    def on_request(self):
+        self.requests += 1
+
+    def can_retry(self) -> bool:
+        return self.retries < self.min_retries + self.ratio * self.requests
+
+    def on_retry(self):
+        self.retries += 1
+
+
+class AdaptiveRate(object):
+    """
+    Token bucket with AIMD rate of one host and endpoint class.
+    Until the first failure rate grows by slow_start share with every second of healthy responses
+    (slow start), after it every healthy response adds increase / rate, so the rate grows by about
+    `increase` requests/s every second. Throttling or server error statuses, connection errors and
+    latency above latency_factor * baseline multiply the rate by decrease, at most once per cooldown
+    seconds, so a burst of failed requests already in flight counts as one signal.
+    """
+
+    def __init__(self, rate=10.0, min_rate=0.5, max_rate=200.0, increase=2.0, decrease=0.7, slow_start=0.5,
+                 latency_factor=3.0, cooldown=1.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_start = slow_start
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+
+        # smoothed latency and its lowest value, baseline drifts up slowly to follow permanent changes
+        self.latency = None
+        self.baseline = None
+
+        self.decreases = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+
+            # bucket size of one second keeps bursts at the current rate
+            self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return
+            await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+    def on_success(self, latency: float):
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        self.baseline = self.latency if self.baseline is None else min(self.baseline * 1.001, self.latency)
+
+        if self.latency > self.latency_factor * self.baseline:
+            self.on_failure()
+        elif not self.decreases:
+            self.rate = min(self.max_rate, self.rate + self.slow_start)
+        else:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_failure(self, retry_after: float = 0.0):
+        now = time.monotonic()
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.decreases += 1
+
+
+class EndpointClassifier(object):
+    """
+    Endpoint class of URL: the name of first matching URL pattern from classes, 'default' otherwise.
+    """
+
+    def __init__(self, classes=()):
+        """
+        :param classes: sequence of (class name, url regex pattern) pairs
+        """
+        self.classes = [(name, re.compile(pattern)) for name, pattern in classes]
+
+    def classify(self, url) -> str:
+        url = str(url)
+        for name, pattern in self.classes:
+            if pattern.search(url):
+                return name
+        return 'default'
+
+
+class RateLimiter(object):
+    """
+    Adaptive request rate per host and endpoint class, see EndpointClassifier.
+    """
+
+    THROTTLE_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, classes=(), **rate_kwargs):
+        """
+        :param classes: sequence of (class name, url regex pattern) pairs
+        :param rate_kwargs: AdaptiveRate parameters
+        """
+        self.classifier = EndpointClassifier(classes)
+        self.rate_kwargs = rate_kwargs
+        self.buckets = {}
+
+    def endpoint(self, url) -> str:
+        return self.classifier.classify(url)
+
+    def bucket(self, url) -> AdaptiveRate:
+        key = '{}/{}'.format(urlsplit(str(url)).netloc, self.endpoint(url))
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = AdaptiveRate(**self.rate_kwargs)
+            self.buckets[key] = bucket
+        return bucket
+
+    async def acquire(self, url):
+        await self.bucket(url).acquire()
+
+    def on_response(self, url, status: int, latency: float, retry_after: float = 0.0):
+        if status in self.THROTTLE_STATUSES:
+            self.bucket(url).on_failure(retry_after)
+        else:
+            self.bucket(url).on_success(latency)
+
+    def on_error(self, url):
+        self.bucket(url).on_failure()
+
+    def rates(self) -> dict:
+        """
+        :return: (dict) current requests/s by host/endpoint class
+        """
+        return {key: round(bucket.rate, 2) for key, bucket in self.buckets.items()}
+
+
+def retry_after_seconds(value) -> float:
+    """
+    Retry-After header value in seconds, HTTP-date form is ignored.
+    """
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class CachedResponse(object):
+    """
+    Response restored from ResponseCache. Has the same attributes scraper uses from GSession responses.
+    """
+
+    def __init__(self, url, status, content, headers=None):
+        self.url = url
+        self.status = status
+        self.content = content
+        self.headers = headers or {}
+
+
+class ResponseCache(object):
+    """
+    On-disk (SQLite) cache of GSession responses keyed by method + URL + payload.
+    TTL is chosen by first matching URL pattern from ttl_rules, default ttl otherwise.
+    Only 200 responses are cached, and also client errors (4xx except 429) of URLs matching negative_patterns.
+    Expired entries with ETag/Last-Modified are revalidated with conditional request.
+    When cache content exceeds max_size bytes, least recently used entries are evicted.
+    """
+
+    # number of cache hits after which their access times are written to DB
+    ACCESS_FLUSH = 100
+
+    def __init__(self, path, ttl=3600, ttl_rules=(), max_size=512 * 1024 * 1024, negative_patterns=()):
+        """
+        :param path: cache DB file
+        :param ttl: default entry lifetime in seconds
+        :param ttl_rules: sequence of (url regex pattern, ttl) pairs
+        :param max_size: max total size of cached content in bytes
+        :param negative_patterns: url regex patterns whose client error responses are cached too
+        """
+        self.ttl = ttl
+        self.ttl_rules = [(re.compile(pattern), rule_ttl) for pattern, rule_ttl in ttl_rules]
+        self.max_size = max_size
+        self.negative_patterns = [re.compile(pattern) for pattern in negative_patterns]
+        # access times of cache hits not written to DB yet, by key
+        self.accessed = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evicted = 0
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS http_cache ('
+            'key TEXT PRIMARY KEY, url TEXT, response_url TEXT, status INTEGER, content TEXT, '
+            'etag TEXT, last_modified TEXT, created REAL, accessed REAL, size INTEGER)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_http_cache_accessed ON http_cache (accessed)')
+        self.conn.commit()
+
+        self.size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM http_cache').fetchone()[0]
+
+    @staticmethod
+    def make_key(method, url, data=None) -> str:
+        payload = json.dumps(data, sort_keys=True, default=str) if data is not None else ''
+        return md5('{} {} {}'.format(method.upper(), url, payload).encode()).hexdigest()
+
+    def ttl_for(self, url) -> float:
+        for pattern, rule_ttl in self.ttl_rules:
+            if pattern.search(url):
+                return rule_ttl
+        return self.ttl
+
+    def cacheable(self, url, status: int) -> bool:
+        if status == 200:
+            return True
+        return 400 <= status < 500 and status != 429 and any(pattern.search(url) for pattern in self.negative_patterns)
+
+    def lookup(self, key, url):
+        """
+        :return: (fresh, entry) where entry is a dict or None if nothing is cached
+        """
+        row = self.conn.execute(
+            'SELECT response_url, status, content, etag, last_modified, created FROM http_cache WHERE key = ?',
+            (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+
+        entry = dict(zip(('response_url', 'status', 'content', 'etag', 'last_modified', 'created'), row))
+        fresh = time.time() - entry['created'] < self.ttl_for(url)
+        if fresh:
+            self.hits += 1
+            self.touch(key)
+        else:
+            self.misses += 1
+        return fresh, entry
+
+    def touch(self, key, refresh=False):
+        now = time.time()
+        if refresh:
+            self.conn.execute('UPDATE http_cache SET accessed = ?, created = ? WHERE key = ?', (now, now, key))
+            self.conn.commit()
+            return
+
+        self.accessed[key] = now
+        if len(self.accessed) >= self.ACCESS_FLUSH:
+            self.flush()
+
+    def flush(self):
+        """
+        Write access times of cache hits with one commit.
+        """
+        if not self.accessed:
+            return
+        self.conn.executemany('UPDATE http_cache SET accessed = ? WHERE key = ?',
+                              [(accessed, key) for key, accessed in self.accessed.items()])
+        self.conn.commit()
+        self.accessed.clear()
+
+    def revalidate(self, key):
+        # server answered 304 Not Modified
+        self.revalidated += 1
+        self.touch(key, refresh=True)
+
+    def store(self, key, url, response_url, status, content, etag=None, last_modified=None):
+        size = len(content.encode()) if content else 0
+        old = self.conn.execute('SELECT size FROM http_cache WHERE key = ?', (key,)).fetchone()
+        if old:
+            self.size -= old[0]
+
+        now = time.time()
+        self.conn.execute(
+            'INSERT OR REPLACE INTO http_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (key, url, response_url, status, content, etag, last_modified, now, now, size)
+        )
+        self.accessed.pop(key, None)
+        self.size += size
+
+        if self.size > self.max_size:
+            self.evict()
+        self.conn.commit()
+
+    def evict(self):
+        # drop least recently used entries until cache fits into 90% of max_size
+        self.flush()
+        target = self.max_size * 0.9
+        keys = []
+        for key, size in self.conn.execute('SELECT key, size FROM http_cache ORDER BY accessed'):
+            if self.size <= target:
+                break
+            keys.append((key,))
+            self.size -= size
+        self.conn.executemany('DELETE FROM http_cache WHERE key = ?', keys)
+        self.evicted += len(keys)
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidated': self.revalidated,
+            'evicted': self.evicted,
+            'size': self.size,
+        }
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class ResponseRecorder(object):
+    """
+    Directory store of request/response pairs for offline runs.
+    Every response is saved to own JSON file named <method+url key>_<method+url+payload key>.json,
+    so replay can fall back to method+url match when payload differs (e.g. search form with other year).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def entry_name(method, url, data=None) -> str:
+        return '{}_{}.json'.format(ResponseCache.make_key(method, url), ResponseCache.make_key(method, url, data))
+
+    def record(self, method, url, data, response):
+        entry = {
+            'method': method,
+            'url': url,
+            'data': data,
+            'response_url': str(response.url),
+            'status': response.status,
+            'content': response.content,
+        }
+        with open(os.path.join(self.path, self.entry_name(method, url, data)), 'w', encoding='utf-8') as entry_file:
+            json.dump(entry, entry_file, default=str)
+
+
+class ResponseReplay(object):
+    """
+    Serve responses saved by ResponseRecorder instead of network.
+    Not recorded requests get 404 response (that's how phone numbers probing ends).
+    """
+
+    def __init__(self, path, latency=0.0):
+        """
+        :param path: recordings directory
+        :param latency: artificial delay of every response in seconds
+        """
+        self.path = path
+        self.latency = latency
+        self.missed = 0
+
+        self.files = set(os.listdir(path))
+        self.url_index = {}
+        for name in sorted(self.files):
+            self.url_index.setdefault(name.split('_')[0], name)
+
+    def load(self, method, url, data=None):
+        name = ResponseRecorder.entry_name(method, url, data)
+        if name not in self.files:
+            name = self.url_index.get(ResponseCache.make_key(method, url))
+        if name is None:
+            return None
+        with open(os.path.join(self.path, name), encoding='utf-8') as entry_file:
+            return json.load(entry_file)
+
+    async def response(self, method, url, data=None, semaphore=None):
+        if semaphore:
+            await semaphore.acquire()
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+        finally:
+            if semaphore:
+                semaphore.release()
+
+        entry = self.load(method, url, data)
+        if entry is None:
+            self.missed += 1
+            return CachedResponse(url, 404, None)
+        return CachedResponse(entry['response_url'], entry['status'], entry['content'])
+
+
 class GSession(aiohttp.ClientSession):
     """
     Make Session great again!
@@ -11,46 +428,168 @@ class GSession(aiohttp.ClientSession):
     Also, request wrapped into semaphore context manager to explicitly limit number of active connections
     """
 
-    def __init__(self, *args, **kwargs):
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, *args, limit=100, limit_per_host=0, retries=3, backoff_base=1.0, backoff_max=30.0,
+                 retry_budget=None, rate_limiter=None, cache=None, recorder=None, replay=None, metrics=None,
+                 endpoints=None, **kwargs):
+        """
+        :param limit: total number of simultaneous connections
+        :param limit_per_host: number of simultaneous connections to one host (0 - no limit)
+        :param retries: max retries of one request
+        :param backoff_base: first retry delay upper bound in seconds, doubled for every next retry
+        :param backoff_max: retry delay upper bound in seconds
+        :param retry_budget: RetryBudget instance shared by all requests of session
+        :param rate_limiter: RateLimiter instance, requests rate isn't limited if not set
+        :param cache: ResponseCache instance, responses aren't cached if not set
+        :param recorder: ResponseRecorder instance to save all responses
+        :param replay: ResponseReplay instance to get responses from instead of network
+        :param metrics: metrics.Metrics registry for requests counters and latencies
+        :param endpoints: EndpointClassifier for metrics labels, all requests are labeled 'default' if not set
+        """
+        if 'connector' not in kwargs:
+            kwargs['connector'] = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host)
         super().__init__(*args, **kwargs)
         self.logger = logging.getLogger('great_session')
 
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_budget = retry_budget or RetryBudget()
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.recorder = recorder
+        self.replay = replay
+        self.metrics = metrics or Metrics()
+        # independent of rate limiter, which could be turned off
+        self.endpoints = endpoints or EndpointClassifier()
+
+    def endpoint(self, url) -> str:
+        """
+        Endpoint class of url for metrics labels.
+        """
+        return self.endpoints.classify(url)
+
+    def report_rate(self, url):
+        """
+        Current requests/s of rate limiter bucket of url as gauge.
+        """
+        self.metrics.gauge('request_rate', self.rate_limiter.bucket(url).rate,
+                           host=urlsplit(str(url)).netloc, endpoint=self.rate_limiter.endpoint(url))
+
+    def backoff(self, attempt: int) -> float:
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
     async def get(self, url, *, allow_redirects=True, semaphore=None, **kwargs):
-        retries = 0
-        while True:
-            if semaphore:
-                semaphore.locked()
-            try:
-                async with super().get(url, allow_redirects=True, **kwargs) as response:
-                    content = await response.text()
+        return await self.fetch('GET', url, semaphore=semaphore, allow_redirects=allow_redirects, **kwargs)
 
-                    response.content = content if content else None
-                    return response
-            except asyncio.TimeoutError:
-                self.logger.error('Timeout at {}. Retry #{}'.format(url, retries))
+    async def post(self, url, *, data, semaphore=None, **kwargs):
+        return await self.fetch('POST', url, semaphore=semaphore, data=data, **kwargs)
+
+    async def fetch(self, method, url, *, semaphore=None, **kwargs):
+        """
+        Get response from replay recordings, cache or network.
+        Time of the whole call (with retries and waiting for rate limiter) goes to fetch histogram.
+        """
+        with self.metrics.timer('fetch', endpoint=self.endpoint(url)):
+            if self.replay is not None:
+                return await self.replay.response(method, url, kwargs.get('data'), semaphore=semaphore)
+
+            response = await self.fetch_cached(method, url, semaphore=semaphore, **kwargs)
+            if self.recorder is not None:
+                self.recorder.record(method, url, kwargs.get('data'), response)
+            return response
+
+    async def fetch_cached(self, method, url, *, semaphore=None, **kwargs):
+        """
+        Get response from cache or make request. See ResponseCache for responses which are cached.
+        """
+        if self.cache is None:
+            return await self.request_content(method, url, semaphore=semaphore, **kwargs)
+
+        key = self.cache.make_key(method, url, kwargs.get('data'))
+        fresh, entry = self.cache.lookup(key, url)
+        if fresh:
+            self.metrics.inc('http_cache_hits', endpoint=self.endpoint(url))
+            return CachedResponse(entry['response_url'], entry['status'], entry['content'])
+
+        if entry:
+            headers = dict(kwargs.pop('headers', None) or {})
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+            kwargs['headers'] = headers
+
+        response = await self.request_content(method, url, semaphore=semaphore, **kwargs)
+
+        if response.status == 304 and entry:
+            self.metrics.inc('http_cache_revalidated', endpoint=self.endpoint(url))
+            self.cache.revalidate(key)
+            return CachedResponse(entry['response_url'], entry['status'], entry['content'])
+        if self.cache.cacheable(url, response.status):
+            self.cache.store(key, url, str(response.url), response.status, response.content,
+                             etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'))
+        return response
 
-                retries += 1
-                if retries > 3:
-                    break
-                else:
+    async def request_content(self, method, url, *, semaphore=None, **kwargs):
+        """
+        Make request and read its content. Semaphore is held only while request is active,
+        so waiting for retry does not block other requests.
+        Timeouts, connection errors and RETRY_STATUSES responses are retried while
+        retries limit and retry budget allow it.
+        Every attempt waits for rate limiter and reports its outcome to it.
+        """
+        self.retry_budget.on_request()
+        endpoint = self.endpoint(url)
+
+        attempt = 0
+        while True:
+            try:
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.acquire(url)
+                if semaphore:
+                    await semaphore.acquire()
+                try:
+                    start = time.perf_counter()
+                    async with super().request(method, url, **kwargs) as response:
+                        body = await response.read()
+                        content = await response.text()
+                finally:
                     if semaphore:
                         semaphore.release()
-                    asyncio.sleep(2)
-            finally:
-                if semaphore:
-                    semaphore.release()
+                # assigned after release, aiohttp uses response.content while releasing connection
+                response.content = content if content else None
+                latency = time.perf_counter() - start
 
-    async def post(self, url, *, data, semaphore=None, **kwargs):
-        if semaphore:
-            semaphore.locked()
-        try:
-            async with super().post(url, data=data, **kwargs) as response:
-                content = await response.text()
+                self.metrics.observe('http_request', latency, endpoint=endpoint)
+                self.metrics.inc('http_responses', endpoint=endpoint, status=response.status)
+                self.metrics.inc('http_bytes', len(body), endpoint=endpoint)
+                if self.rate_limiter is not None:
+                    self.rate_limiter.on_response(url, response.status, latency,
+                                                  retry_after_seconds(response.headers.get('Retry-After')))
+                    self.report_rate(url)
 
-                response.content = content if content else None
+                if response.status not in self.RETRY_STATUSES:
+                    return response
+                error = None
+                self.logger.warning('Response status {} at {}. Retry #{}'.format(response.status, url, attempt))
+            except (asyncio.TimeoutError, aiohttp.ClientError) as err:
+                self.metrics.inc('http_errors', endpoint=endpoint, error=type(err).__name__)
+                if self.rate_limiter is not None:
+                    self.rate_limiter.on_error(url)
+                    self.report_rate(url)
+                response = None
+                error = err
+                self.logger.error('{} at {}. Retry #{}'.format(type(err).__name__, url, attempt))
+
+            if attempt >= self.retries or not self.retry_budget.can_retry():
+                if error is not None:
+                    raise error
                 return response
-        except asyncio.TimeoutError:
-            self.logger.error('timeout error for url: {}'.format(url))
-        finally:
-            if semaphore:
-                semaphore.release()
+
+            self.retry_budget.on_retry()
+            self.metrics.inc('http_retries', endpoint=endpoint)
+            await asyncio.sleep(self.backoff(attempt))
+            attempt += 1
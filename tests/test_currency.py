@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+from utils import RatesProvider, get_pln_rates
+
+RATES = {'base': 'PLN', 'rates': {'EUR': 0.25}}
+
+
+class StubSource(object):
+    """
+    Rates source counting calls, raises err instead of returning data if it's set.
+    """
+
+    def __init__(self, data=RATES, err=None):
+        self.data = data
+        self.err = err
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.err is not None:
+            raise self.err
+        return self.data
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr('utils.time.time', lambda: now[0])
+    return now
+
+
+def provider(tmpdir, source, ttl=3600):
+    return RatesProvider('test', source, cache_dir=str(tmpdir), ttl=ttl)
+
+
+def test_cache_hit(tmpdir, clock):
+    source = StubSource()
+    assert provider(tmpdir, source).data() == RATES
+
+    clock[0] += 3599
+    # new provider (next run) reads rates from disk
+    assert provider(tmpdir, source).data() == RATES
+    assert source.calls == 1
+
+
+def test_cache_refresh(tmpdir, clock):
+    provider(tmpdir, StubSource()).data()
+
+    clock[0] += 3600
+    fresh = {'base': 'PLN', 'rates': {'EUR': 0.2}}
+    source = StubSource(fresh)
+    assert provider(tmpdir, source).data() == fresh
+    assert source.calls == 1
+
+    with open(tmpdir.join('rates_test.json'), encoding='utf-8') as cache_file:
+        assert json.load(cache_file) == {'timestamp': clock[0], 'data': fresh}
+
+
+def test_stale_cache_on_source_failure(tmpdir, clock):
+    provider(tmpdir, StubSource()).data()
+
+    clock[0] += 10 * 3600
+    source = StubSource(err=AttributeError('Failed to get currency rates. Check connection.'))
+    assert provider(tmpdir, source).data() == RATES
+    assert source.calls == 1
+
+
+def test_source_failure_without_cache(tmpdir, clock):
+    with pytest.raises(AttributeError):
+        provider(tmpdir, StubSource(err=AttributeError('offline'))).data()
+
+
+@pytest.mark.parametrize('content', [
+    'not json',
+    '[1, 2]',
+    '{"data": {}}',
+    '{"timestamp": "yesterday", "data": {}}',
+])
+def test_broken_cache_ignored(tmpdir, clock, content):
+    tmpdir.join('rates_test.json').write(content)
+    source = StubSource()
+
+    assert provider(tmpdir, source).data() == RATES
+    assert source.calls == 1
+
+
+def test_pln_conversion(tmpdir, clock):
+    cur_pln = get_pln_rates(source=StubSource(), cache_dir=str(tmpdir))
+
+    assert cur_pln(100, 'eur') == 25.0
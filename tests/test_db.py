@@ -0,0 +1,204 @@
+import asyncio
+import datetime
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import event
+
+import scraper
+from models import CarArticle, Dictionary, MetaInfo, PriceHistory, article_key
+from utils import DictionaryCache, setup_db
+
+
+@pytest.fixture
+def session():
+    session = setup_db(db_url='sqlite://')
+    yield session
+    session.close()
+    session.bind.dispose()
+
+
+def add_article(session, article_id, year, on_delete=False):
+    article = CarArticle(article_id, 'a4', None, year, 1000, 2.0, None, 100000, True, False, False, False,
+                         None, 'warszawa', 'link', 'seller')
+    article.on_delete = on_delete
+    session.add(article)
+    session.commit()
+
+
+def delisted(session) -> dict:
+    return dict(session.query(CarArticle.id, CarArticle.on_delete).all())
+
+
+def make_scraper(**kwargs):
+    return scraper.Scraper(0, 0, datetime.datetime(2000, 1, 1), datetime.datetime(2010, 1, 1), 0, 0, '', 1,
+                           **kwargs)
+
+
+def test_sweep_full_crawl(session):
+    add_article(session, 1, 2005)
+    add_article(session, 2, 2005)
+    add_article(session, 3, 2005, on_delete=True)
+    # out of year range of the crawl
+    add_article(session, 4, 2015)
+
+    assert scraper.db_sweep(session, {1, 3}, 2000, 2010) == (1, 1)
+    session.commit()
+    assert delisted(session) == {1: False, 2: True, 3: False, 4: False}
+
+
+def test_sweep_nothing_seen(session):
+    add_article(session, 1, 2005)
+
+    assert scraper.db_sweep(session, set(), 2000, 2010) == (0, 0)
+    assert delisted(session) == {1: False}
+
+
+def test_partial_crawl_not_swept(session):
+    add_article(session, 1, 2005)
+    article_scraper = make_scraper()
+
+    async def parse():
+        # the only article of page can't be extracted
+        return await article_scraper.parse_content('<html><body><article></article></body></html>', phones=False)
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(parse()) == []
+    finally:
+        loop.close()
+
+    assert article_scraper.articles_failed == 1
+    assert not article_scraper.check_complete(['page'])
+
+    # run stored as partial is not swept
+    scraper.db_fill(session, [[]], complete=article_scraper.check_complete(['page']))
+    assert not session.query(MetaInfo).one().status
+    assert delisted(session) == {1: False}
+
+    article_scraper.articles_failed = 0
+    assert article_scraper.check_complete(['page'])
+    article_scraper.pages_failed = 1
+    assert not article_scraper.check_complete(['page'])
+
+
+def make_article(number, price, price_detail=('brutto',)):
+    return scraper.Article(
+        name='a4', manufacturer='audi', price=Decimal(price), currency='pln', price_detail=price_detail,
+        item_year=datetime.datetime(2005, 1, 1), item_mileage=1000, item_engine_capacity=2.0,
+        item_fuel_type='diesel', link='https://www.otomoto.pl/oferta/audi-ID{}.html'.format(number),
+        seller_location='warszawa', seller_id=str(number), phones=('111',))
+
+
+def stored_price(session, number) -> tuple:
+    return session.query(CarArticle.value, CarArticle.netto)\
+        .filter(CarArticle.id == article_key(make_article(number, 0).link)).one()
+
+
+def test_price_changed(session):
+    scraper.db_insert(session, [make_article(1, 1000), make_article(2, 2000)], set())
+    session.commit()
+
+    assert scraper.db_insert(session, [make_article(1, 1500, ('netto',)), make_article(2, 2000)], set()) == (0, 1)
+    session.commit()
+
+    assert stored_price(session, 1) == (150000, True)
+    history = session.query(PriceHistory.car_id, PriceHistory.value, PriceHistory.netto).all()
+    assert history == [(article_key(make_article(1, 0).link), 100000, False)]
+
+
+def test_price_unchanged(session):
+    scraper.db_insert(session, [make_article(1, 1000)], set())
+    session.commit()
+
+    assert scraper.db_insert(session, [make_article(1, 1000)], set()) == (0, 0)
+    session.commit()
+
+    assert stored_price(session, 1) == (100000, False)
+    assert not session.query(PriceHistory).count()
+
+
+def test_price_changed_of_deleted_article(session):
+    scraper.db_insert(session, [make_article(1, 1000)], set())
+    session.commit()
+
+    new_articles, changed_articles = scraper.db_split_articles(session, [make_article(1, 1500)], set())
+    assert not new_articles and len(changed_articles) == 1
+    # article removed by another session between lookup and write
+    session.query(CarArticle).delete()
+
+    assert scraper.db_update_prices(session, changed_articles) == 1
+    session.commit()
+
+    assert stored_price(session, 1) == (150000, False)
+    assert session.query(CarArticle.on_delete).scalar() is False
+    assert session.query(PriceHistory).count() == 1
+
+
+def stored_ids(session) -> set:
+    return {article_id for article_id, in session.query(CarArticle.id)}
+
+
+def test_duplicates_in_batch(session):
+    ids_pool = set()
+    batch = [make_article(1, 1000), make_article(2, 2000), make_article(1, 1500)]
+
+    # the first copy of article is kept
+    assert scraper.db_insert(session, batch, ids_pool) == (2, 0)
+    session.commit()
+
+    assert ids_pool == stored_ids(session) == {article_key(make_article(number, 0).link) for number in (1, 2)}
+    assert stored_price(session, 1) == (100000, False)
+
+
+def test_duplicates_across_batches(session):
+    ids_pool = set()
+    scraper.db_insert(session, [make_article(1, 1000)], ids_pool)
+    session.commit()
+
+    # article of other page of the same run is skipped even if price differs
+    assert scraper.db_insert(session, [make_article(1, 1500), make_article(2, 2000)], ids_pool) == (1, 0)
+    session.commit()
+    assert stored_price(session, 1) == (100000, False)
+
+    # the next run finds it in DB
+    assert scraper.db_insert(session, [make_article(1, 1000), make_article(2, 2000)], set()) == (0, 0)
+    assert not session.query(PriceHistory).count()
+
+
+def test_existing_prices_chunked(session):
+    articles = [make_article(number, 1000) for number in range(1200)]
+    assert scraper.db_insert(session, articles, set()) == (1200, 0)
+    session.commit()
+
+    statements = []
+
+    @event.listens_for(session.bind, 'before_cursor_execute')
+    def count_lookup(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('SELECT car_article.id'):
+            statements.append(len(parameters))
+
+    changed = articles[:-1] + [make_article(1199, 1500), make_article(1200, 1000), make_article(1, 1000)]
+    try:
+        assert scraper.db_insert(session, changed, set()) == (1, 1)
+    finally:
+        event.remove(session.bind, 'before_cursor_execute', count_lookup)
+    session.commit()
+
+    # 1201 unique ids are looked up by 500
+    assert statements == [500, 500, 201]
+    assert session.query(CarArticle).count() == 1201
+    assert stored_price(session, 1199) == (150000, False)
+
+
+def test_dictionary_cache_dropped_on_rollback(session):
+    code = DictionaryCache.of(session).code('manufacturer', 'audi')
+    assert session.query(Dictionary.value).filter(Dictionary.id == code).scalar() == 'audi'
+
+    session.rollback()
+
+    # code inserted in the rolled back transaction doesn't exist anymore
+    assert 'dictionary' not in session.info
+    assert not session.query(Dictionary).count()
+    code = DictionaryCache.of(session).code('manufacturer', 'audi')
+    assert session.query(Dictionary.value).filter(Dictionary.id == code).scalar() == 'audi'
@@ -0,0 +1,50 @@
+import datetime
+import re
+import zipfile
+
+import pandas as pd
+
+import export
+
+
+def make_frame():
+    return pd.DataFrame({
+        'name': ['a4'], 'manufacturer': ['audi'], 'year': [2010], 'mileage': [150000],
+        'engine_capacity': [2.0], 'engine_type': ['diesel'], 'value': [30000.0], 'currency': ['pln'],
+        'negotiation': [True], 'netto': [False], 'brutto': [True], 'vat': [False],
+        'price_eur': [7000.0], 'price_real': [7000.0], 'customs_clearing': [1000.0], 'price_total': [8000.0],
+        'location': ['warszawa'], 'link': ['https://www.otomoto.pl/oferta/a4-ID1.html'],
+        'record_created': [datetime.datetime(2017, 11, 29, 15, 53)],
+    })
+
+
+def cell_number_format(filename, cell):
+    with zipfile.ZipFile(filename) as workbook:
+        sheet = workbook.read('xl/worksheets/sheet1.xml').decode()
+        styles = workbook.read('xl/styles.xml').decode()
+
+    style = int(re.search(r'<c r="{}" s="(\d+)"'.format(cell), sheet).group(1))
+    cell_formats = re.search(r'<cellXfs[^>]*>(.*?)</cellXfs>', styles, re.S).group(1)
+    num_format_id = re.findall(r'<xf numFmtId="(\d+)"', cell_formats)[style]
+    return dict(re.findall(r'<numFmt numFmtId="(\d+)" formatCode="([^"]*)"', styles)).get(num_format_id)
+
+
+def test_record_created_has_date_format(tmpdir):
+    filename = str(tmpdir.join('report.xlsx'))
+    export.export_xlsx(make_frame(), filename=filename)
+
+    column = [field for _, field, _, _, _ in export.COLUMNS].index('record_created')
+    assert cell_number_format(filename, '{}2'.format(chr(ord('A') + column))) == 'yy-mm-dd hh:mm:ss'
+
+
+def test_csv_rows_appended(tmpdir):
+    filename = str(tmpdir.join('report.csv'))
+    writer = export.CsvExport(filename)
+    writer.write_rows(make_frame())
+    writer.write_rows(make_frame())
+    writer.close()
+
+    frame = pd.read_csv(filename)
+    # header is written once, columns are the same as of xlsx report
+    assert list(frame.columns) == [title for title, _, _, _, _ in export.COLUMNS]
+    assert list(frame['Name']) == ['a4', 'a4']
@@ -0,0 +1,71 @@
+import datetime
+from decimal import Decimal
+
+import pytest
+
+from scraper import FilterArticle
+
+ROWS = [
+    ('  Audi A4 2.0 TDI ', '45 900', 'PLN', 'Brutto, Do negocjacji', ' 2012 ', '187 000 km', '1 968 cm3', 'Diesel',
+     'https://www.otomoto.pl/oferta/audi-a4-ID6zDg1a.html#abc', ' Kraków ,  Małopolskie '),
+    ('BMW X5', '12 500,50', 'EUR', 'Netto', '2015', '98 500 km', '2 993 cm3', 'Benzyna',
+     'https://www.otomoto.pl/oferta/bmw-x5-ID6zZ9Qb.html', 'Warszawa'),
+    ('Fiat', 'n/a', 'PLN', 'Brutto', '2001', 'brak', '', 'Benzyna+LPG',
+     'https://www.otomoto.pl/oferta/fiat-ID6yy0Cc.html', 'Łódź'),
+    ('Škoda Octavia', '30 000', 'PLN', 'Brutto, Faktura VAT', '2010', '210 000 km', '1 598 cm3', 'Diesel',
+     'https://www.otomoto.pl/oferta/skoda-ID6aaaaa.html', 'Gdańsk'),
+    # no seller id in link
+    ('Opel Astra', '9 999', 'PLN', 'Brutto', '2005', '150 000 km', '1 600 cm3', 'Benzyna',
+     'https://www.otomoto.pl/oferta/opel-astra.html', 'Poznań'),
+    # unknown engine capacity format
+    ('Mercedes-Benz Klasa E', '99 000', 'PLN', 'Brutto', '2016', '55 000 km', 'electric', 'Elektryczny',
+     'https://www.otomoto.pl/oferta/mercedes-ID6bbbbb.html', 'Wrocław'),
+    # unknown year format
+    ('Toyota Yaris', '21 000', 'PLN', 'Brutto', 'unknown', '80 000 km', '998 cm3', 'Benzyna',
+     'https://www.otomoto.pl/oferta/toyota-ID6ccccc.html', 'Lublin'),
+]
+
+# get_dict results of the implementation before normalizers caching
+EXPECTED = [
+    {'name': 'a4 2.0 tdi', 'manufacturer': 'audi', 'price': Decimal('45900.00'), 'currency': 'pln',
+     'price_detail': ['brutto', 'donegocjacji'], 'item_year': datetime.datetime(2012, 1, 1), 'item_mileage': 187000,
+     'item_engine_capacity': 2.0, 'item_fuel_type': 'diesel',
+     'link': 'https://www.otomoto.pl/oferta/audi-a4-ID6zDg1a.html', 'seller_location': 'kraków , małopolskie',
+     'seller_id': '6zDg1a'},
+    {'name': 'x5', 'manufacturer': 'bmw', 'price': Decimal('12500.00'), 'currency': 'eur',
+     'price_detail': ['netto'], 'item_year': datetime.datetime(2015, 1, 1), 'item_mileage': 98500,
+     'item_engine_capacity': 3.0, 'item_fuel_type': 'benzyna',
+     'link': 'https://www.otomoto.pl/oferta/bmw-x5-ID6zZ9Qb.html', 'seller_location': 'warszawa',
+     'seller_id': '6zZ9Qb'},
+    {'name': 'fiat', 'manufacturer': 'Unknown', 'price': Decimal('0.00'), 'currency': 'pln',
+     'price_detail': ['brutto'], 'item_year': datetime.datetime(2001, 1, 1), 'item_mileage': 0,
+     'item_engine_capacity': 0.1, 'item_fuel_type': 'benzyna+lpg',
+     'link': 'https://www.otomoto.pl/oferta/fiat-ID6yy0Cc.html', 'seller_location': 'łódź',
+     'seller_id': '6yy0Cc'},
+    {'name': 'octavia', 'manufacturer': 'škoda', 'price': Decimal('30000.00'), 'currency': 'pln',
+     'price_detail': ['brutto', 'fakturavat'], 'item_year': datetime.datetime(2010, 1, 1), 'item_mileage': 210000,
+     'item_engine_capacity': 1.6, 'item_fuel_type': 'diesel',
+     'link': 'https://www.otomoto.pl/oferta/skoda-ID6aaaaa.html', 'seller_location': 'gdańsk',
+     'seller_id': '6aaaaa'},
+    None,
+    None,
+    None,
+]
+
+
+def normalized(result):
+    # price_detail is a tuple now, so it could be cached and shared between articles
+    if result is not None:
+        result = dict(result, price_detail=list(result['price_detail']))
+    return result
+
+
+@pytest.mark.parametrize('row, expected', list(zip(ROWS, EXPECTED)))
+def test_get_dict(row, expected):
+    assert normalized(FilterArticle().get_dict(*row)) == expected
+
+
+def test_filter_many():
+    # repeated rows are served by normalizers caches
+    rows = ROWS * 2
+    assert [normalized(result) for result in FilterArticle().filter_many(rows)] == EXPECTED * 2
@@ -0,0 +1,116 @@
+import asyncio
+import datetime
+
+import pytest
+
+import scraper
+from metrics import Histogram, Metrics, REGISTRY
+
+
+def test_quantile_interpolated_in_bucket():
+    histogram = Histogram(buckets=(1.0, 2.0, 4.0))
+    for value in (0.5, 1.5, 1.5, 3.0):
+        histogram.observe(value)
+
+    assert histogram.counts == [1, 2, 1, 0]
+    assert histogram.quantile(0.25) == 1.0
+    assert histogram.quantile(0.5) == 1.5
+    assert histogram.quantile(1.0) == 4.0
+    assert Histogram().quantile(0.5) == 0.0
+
+
+def test_quantile_of_inf_bucket():
+    histogram = Histogram(buckets=(1.0, 2.0))
+    histogram.observe(10.0)
+
+    # values above the last bound are reported as the last bound
+    assert histogram.quantile(0.99) == 2.0
+    assert histogram.cumulative() == [(1.0, 0), (2.0, 0), (float('inf'), 1)]
+
+
+def make_metrics():
+    metrics = Metrics(prefix='test')
+    metrics.inc('pages', result='ok')
+    metrics.inc('pages', 2, result='ok')
+    metrics.gauge('request_rate', 7.5, endpoint='search')
+    metrics.histograms[Metrics.key('page', {})] = Histogram(buckets=(0.1, 1.0))
+    metrics.observe('page', 0.05)
+    metrics.observe('page', 0.5)
+    return metrics
+
+
+def test_to_dict():
+    assert make_metrics().to_dict() == {
+        'counters': [{'name': 'pages', 'labels': {'result': 'ok'}, 'value': 3}],
+        'gauges': [{'name': 'request_rate', 'labels': {'endpoint': 'search'}, 'value': 7.5}],
+        'histograms': [{'name': 'page', 'labels': {}, 'count': 2, 'sum': 0.55, 'p50': 0.1, 'p99': 0.982,
+                        'buckets': [[0.1, 1], [1.0, 2], ['+Inf', 2]]}],
+    }
+
+
+def test_to_prometheus():
+    assert make_metrics().to_prometheus() == '\n'.join([
+        '# TYPE test_pages_total counter',
+        'test_pages_total{result="ok"} 3',
+        '# TYPE test_request_rate gauge',
+        'test_request_rate{endpoint="search"} 7.5',
+        '# TYPE test_page_seconds histogram',
+        'test_page_seconds_bucket{le="0.1"} 1',
+        'test_page_seconds_bucket{le="1.0"} 2',
+        'test_page_seconds_bucket{le="+Inf"} 2',
+        'test_page_seconds_sum 0.55',
+        'test_page_seconds_count 2',
+    ]) + '\n'
+
+
+def test_reset():
+    metrics = make_metrics()
+    metrics.reset()
+
+    assert metrics.to_dict() == {'counters': [], 'gauges': [], 'histograms': []}
+
+
+class Response(object):
+
+    def __init__(self, status):
+        self.status = status
+        self.content = '<html><body></body></html>'
+
+
+class StubSession(object):
+
+    def __init__(self, result):
+        self.result = result
+
+    async def get(self, url, **kwargs):
+        if isinstance(self.result, Exception):
+            raise self.result
+        return Response(self.result)
+
+
+def scrap(method, result):
+    page_scraper = scraper.Scraper(0, 0, datetime.datetime(2000, 1, 1), datetime.datetime(2010, 1, 1), 0, 0, '', 1)
+    page_scraper.session = StubSession(result)
+    REGISTRY.reset()
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(getattr(page_scraper, method)('page'))
+    except Exception as err:
+        return err
+    finally:
+        loop.close()
+
+
+@pytest.mark.parametrize('method', ['scrap_content', 'scrap_task'])
+@pytest.mark.parametrize('result, pages_result', [
+    (200, 'ok'),
+    (503, 'failed'),
+    (asyncio.TimeoutError(), 'failed'),
+])
+def test_pages_counted(method, result, pages_result):
+    scrap(method, result)
+
+    pages = {labels: value for (name, labels), value in REGISTRY.counters.items() if name == 'pages'}
+    assert pages == {(('result', pages_result),): 1}
+    assert REGISTRY.histogram('page').count == 1
@@ -0,0 +1,70 @@
+from hashlib import md5
+import os
+import sqlite3
+
+import pytest
+import sqlalchemy
+
+import migrate
+from models import CarArticle, Dictionary, Phone, article_key
+from utils import setup_db
+
+LINKS = ['https://www.otomoto.pl/oferta/audi-ID{}.html'.format(i) for i in range(3)]
+
+
+@pytest.fixture
+def old_db(tmpdir):
+    """
+    DB file of car_article schema before the compact one: md5 hex ids, string prices, date years.
+    """
+    path = str(tmpdir.join('old.db'))
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE car_article (id VARCHAR PRIMARY KEY, name VARCHAR(128), manufacturer VARCHAR(128), '
+                 'year DATE, mileage INTEGER, engine_capacity FLOAT, engine_type VARCHAR, value VARCHAR, '
+                 'brutto BOOLEAN, netto BOOLEAN, negotiation BOOLEAN, vat BOOLEAN, currency VARCHAR, '
+                 'location VARCHAR, link VARCHAR, seller_id VARCHAR(32), record_created DATETIME, '
+                 'on_delete BOOLEAN)')
+    conn.execute('CREATE TABLE phone_number (id INTEGER PRIMARY KEY, number VARCHAR, '
+                 'car_id VARCHAR REFERENCES car_article (id))')
+    conn.execute('CREATE TABLE meta_info (id INTEGER PRIMARY KEY, last_start DATETIME, status BOOLEAN)')
+    conn.executemany(
+        'INSERT INTO car_article VALUES (?, ?, ?, ?, 1000, 2.0, ?, ?, 1, 0, 0, 0, ?, ?, ?, ?, ?, 0)',
+        [(md5(link.encode()).hexdigest(), 'a4', 'audi', '2005-01-01', 'diesel', '1234.5', 'pln', 'warszawa', link,
+          str(number), '2020-01-01 00:00:00') for number, link in enumerate(LINKS)]
+    )
+    conn.execute('INSERT INTO phone_number (number, car_id) VALUES (?, ?)', ('111', md5(LINKS[0].encode()).hexdigest()))
+    conn.execute("INSERT INTO meta_info (last_start, status) VALUES ('2020-01-01 00:00:00', 1)")
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_old_schema_not_changed_in_place(old_db):
+    with pytest.raises(RuntimeError):
+        setup_db(db_url='sqlite:///' + old_db)
+
+    # check runs before any table is created
+    engine = sqlalchemy.create_engine('sqlite:///' + old_db)
+    assert Dictionary.__tablename__ not in sqlalchemy.inspect(engine).get_table_names()
+    engine.dispose()
+
+
+def test_convert(old_db, tmpdir):
+    new_db = str(tmpdir.join('new.db'))
+    assert migrate.convert(old_db, new_db) == len(LINKS)
+    assert os.path.exists(old_db)
+
+    session = setup_db(db_url='sqlite:///' + new_db)
+    try:
+        articles = session.query(CarArticle).order_by(CarArticle.link).all()
+        assert {article.id: article.link for article in articles} == {article_key(link): link for link in LINKS}
+        assert {(article.year, article.value) for article in articles} == {(2005, 123450)}
+
+        dictionary = dict(session.query(Dictionary.id, Dictionary.value))
+        assert {(dictionary[article.manufacturer_id], dictionary[article.engine_type_id],
+                 dictionary[article.currency_id]) for article in articles} == {('audi', 'diesel', 'pln')}
+
+        assert session.query(Phone.number, Phone.car_id).all() == [('111', article_key(LINKS[0]))]
+    finally:
+        session.close()
+        session.bind.dispose()
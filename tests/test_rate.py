@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+from session import AdaptiveRate, RateLimiter, retry_after_seconds
+
+URL = 'http://127.0.0.1/oferty/'
+
+
+class Clock(object):
+    """
+    Fake time.monotonic and asyncio.sleep of session module: sleep only moves the time.
+    """
+
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr('session.time', clock)
+    monkeypatch.setattr('session.asyncio.sleep', clock.sleep)
+    return clock
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+@pytest.mark.parametrize('status', [429, 500, 503])
+def test_decrease_on_throttle(clock, status):
+    limiter = RateLimiter(rate=10.0, decrease=0.5)
+    limiter.on_response(URL, status, 0.1)
+
+    assert limiter.rates() == {'127.0.0.1/default': 5.0}
+    assert limiter.bucket(URL).decreases == 1
+
+
+def test_no_decrease_on_client_error(clock):
+    limiter = RateLimiter(rate=10.0, slow_start=0.5)
+    limiter.on_response(URL, 404, 0.1)
+
+    assert limiter.rates() == {'127.0.0.1/default': 10.5}
+
+
+def test_slow_start_then_additive_increase(clock):
+    rate = AdaptiveRate(rate=10.0, slow_start=0.5, increase=2.0, decrease=0.5)
+    for _ in range(4):
+        rate.on_success(0.1)
+    assert rate.rate == 12.0
+
+    rate.on_failure()
+    assert rate.rate == 6.0
+    # after the first failure every response adds increase / rate
+    rate.on_success(0.1)
+    assert rate.rate == pytest.approx(6.0 + 2.0 / 6.0)
+
+
+def test_rate_bounds(clock):
+    rate = AdaptiveRate(rate=1.0, min_rate=0.5, max_rate=2.0, slow_start=1.0, decrease=0.1, cooldown=0)
+    for _ in range(5):
+        rate.on_success(0.1)
+    assert rate.rate == 2.0
+
+    for _ in range(5):
+        clock.now += 1
+        rate.on_failure()
+    assert rate.rate == 0.5
+
+
+def test_latency_spike_decreases_rate(clock):
+    rate = AdaptiveRate(rate=10.0, decrease=0.5, latency_factor=3.0)
+    rate.on_success(0.1)
+    rate.on_success(2.0)
+
+    assert rate.decreases == 1
+    assert rate.rate == pytest.approx(10.5 * 0.5)
+
+
+def test_cooldown(clock):
+    rate = AdaptiveRate(rate=10.0, decrease=0.5, cooldown=1.0)
+    # burst of failures of requests already in flight is one signal
+    for _ in range(3):
+        rate.on_failure()
+    assert (rate.rate, rate.decreases) == (5.0, 1)
+
+    clock.now += 1.0
+    rate.on_failure()
+    assert (rate.rate, rate.decreases) == (2.5, 2)
+
+
+def test_retry_after(clock):
+    limiter = RateLimiter(rate=100.0, cooldown=1.0)
+    run(limiter.acquire(URL))
+    assert clock.sleeps == []
+
+    limiter.on_response(URL, 429, 0.1, retry_after=retry_after_seconds('5'))
+    # the next 429 in cooldown doesn't decrease rate again, but extends the block
+    limiter.on_response(URL, 429, 0.1, retry_after=7.0)
+    start = clock.now
+    run(limiter.acquire(URL))
+
+    assert clock.now - start >= 7.0
+    assert clock.sleeps[0] == 7.0
+    assert limiter.bucket(URL).decreases == 1
+
+
+@pytest.mark.parametrize('value, seconds', [
+    ('5', 5.0),
+    ('1.5', 1.5),
+    ('-3', 0.0),
+    ('Wed, 21 Oct 2015 07:28:00 GMT', 0.0),
+    (None, 0.0),
+])
+def test_retry_after_seconds(value, seconds):
+    assert retry_after_seconds(value) == seconds
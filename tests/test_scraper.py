@@ -0,0 +1,40 @@
+import asyncio
+import datetime
+
+import pytest
+
+import scraper
+
+
+class StubSession(object):
+
+    def __init__(self):
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.parametrize('method', ['run', 'run_stream'])
+def test_session_closed_on_error(monkeypatch, method):
+    page_scraper = scraper.Scraper(0, 0, datetime.datetime(2000, 1, 1), datetime.datetime(2010, 1, 1), 0, 0, '', 1)
+    session = StubSession()
+
+    async def init_session():
+        return session
+
+    async def prepare():
+        raise RuntimeError('Response status != 200 at search')
+
+    monkeypatch.setattr(page_scraper, 'init_session', init_session)
+    monkeypatch.setattr(page_scraper, 'prepare', prepare)
+
+    args = () if method == 'run' else (None,)
+    loop = asyncio.new_event_loop()
+    try:
+        with pytest.raises(RuntimeError):
+            loop.run_until_complete(getattr(page_scraper, method)(*args))
+    finally:
+        loop.close()
+
+    assert session.closed
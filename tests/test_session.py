@@ -0,0 +1,277 @@
+import asyncio
+import socket
+import time
+
+import aiohttp
+from aiohttp import web
+import pytest
+
+from session import EndpointClassifier, GSession, RateLimiter, ResponseCache, RetryBudget
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Server(object):
+    """
+    Local server answering every request with responses from the list, the last one is repeated.
+    Response is a status or 'slow' (sleeps longer than client timeout) or 'broken' (closes connection).
+    """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = 0
+        self.port = free_port()
+        self.runner = None
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}/'.format(self.port)
+
+    async def handle(self, request):
+        response = self.responses[min(self.requests, len(self.responses) - 1)]
+        self.requests += 1
+        if response == 'slow':
+            await asyncio.sleep(1)
+            return web.Response(text='late')
+        if response == 'broken':
+            request.transport.close()
+            return web.Response(text='lost')
+        return web.Response(status=response, text='body')
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_route('*', '/{path:.*}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', self.port).start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.runner.cleanup()
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+async def fetch(responses, semaphore=None, url=None, **session_kwargs):
+    """
+    :return: (tuple) response or raised exception, number of requests got by server, session
+    """
+    session_kwargs.setdefault('backoff_base', 0)
+    async with Server(responses) as server:
+        session = GSession(**session_kwargs)
+        try:
+            response = await session.get(url or server.url, semaphore=semaphore, timeout=0.2)
+        except Exception as err:
+            response = err
+        finally:
+            await session.close()
+    return response, server.requests, session
+
+
+@pytest.mark.parametrize('responses', [
+    [200],
+    [404],
+    [503],
+    [503, 200],
+    ['slow'],
+    ['broken'],
+])
+def test_semaphore_released(responses):
+    async def scenario():
+        semaphore = asyncio.Semaphore(1)
+        await fetch(responses, semaphore=semaphore, retries=1)
+        return semaphore.locked()
+
+    assert not run(scenario())
+
+
+def test_semaphore_released_on_connection_error():
+    async def scenario():
+        semaphore = asyncio.Semaphore(1)
+        session = GSession(retries=1, backoff_base=0)
+        try:
+            with pytest.raises(aiohttp.ClientError):
+                await session.get('http://127.0.0.1:{}/'.format(free_port()), semaphore=semaphore)
+        finally:
+            await session.close()
+        return semaphore.locked()
+
+    assert not run(scenario())
+
+
+def test_semaphore_released_on_cancel():
+    async def scenario():
+        semaphore = asyncio.Semaphore(1)
+        async with Server(['slow']) as server:
+            session = GSession(retries=0)
+            task = asyncio.ensure_future(session.get(server.url, semaphore=semaphore, timeout=5))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            await session.close()
+        return semaphore.locked()
+
+    assert not run(scenario())
+
+
+@pytest.mark.parametrize('responses, retries, status, requests', [
+    ([200], 3, 200, 1),
+    ([404], 3, 404, 1),
+    ([503, 502, 200], 3, 200, 3),
+    ([429], 2, 429, 3),
+    ([503], 0, 503, 1),
+])
+def test_retry_count(responses, retries, status, requests):
+    response, server_requests, session = run(fetch(responses, retries=retries))
+
+    assert response.status == status
+    assert server_requests == requests
+    assert session.metrics.counters.get(('http_retries', (('endpoint', 'default'),)), 0) == requests - 1
+
+
+@pytest.mark.parametrize('responses', [['slow'], ['broken']])
+def test_error_raised_after_retries(responses):
+    response, server_requests, session = run(fetch(responses, retries=2))
+
+    assert isinstance(response, (asyncio.TimeoutError, aiohttp.ClientError))
+    # aiohttp itself repeats request once on dropped keep-alive connection
+    assert server_requests >= 3
+    assert session.metrics.counters[('http_retries', (('endpoint', 'default'),))] == 2
+
+
+def test_retry_budget_exhausted():
+    async def scenario():
+        budget = RetryBudget(ratio=0, min_retries=2)
+        async with Server([503]) as server:
+            session = GSession(retries=5, backoff_base=0, retry_budget=budget)
+            first = await session.get(server.url)
+            first_requests = server.requests
+            second = await session.get(server.url)
+            await session.close()
+        return first.status, first_requests, second.status, server.requests - first_requests, budget.retries
+
+    # budget allows 2 retries for the whole session: both are used by the first request
+    assert run(scenario()) == (503, 3, 503, 1, 2)
+
+
+def test_retry_budget_grows_with_requests():
+    budget = RetryBudget(ratio=0.5, min_retries=0)
+    assert not budget.can_retry()
+
+    for _ in range(4):
+        budget.on_request()
+    budget.on_retry()
+    assert budget.can_retry()
+    budget.on_retry()
+    assert not budget.can_retry()
+
+
+def test_backoff_bounds():
+    session = GSession.__new__(GSession)
+    session.backoff_base = 1.0
+    session.backoff_max = 5.0
+
+    for attempt, bound in enumerate((1.0, 2.0, 4.0, 5.0, 5.0)):
+        delays = [session.backoff(attempt) for _ in range(200)]
+        assert all(0 <= delay <= bound for delay in delays)
+        # full jitter spreads delays over the whole interval
+        assert max(delays) > bound / 2
+
+
+def test_backoff_waits_between_attempts(monkeypatch):
+    delays = []
+    attempts = []
+    original_sleep = asyncio.sleep
+
+    async def sleep(delay, *args, **kwargs):
+        delays.append(delay)
+        await original_sleep(0)
+
+    def backoff(self, attempt):
+        attempts.append(attempt)
+        return 0.5 * 2 ** attempt
+
+    monkeypatch.setattr(GSession, 'backoff', backoff)
+    monkeypatch.setattr('session.asyncio.sleep', sleep)
+    response, server_requests, _ = run(fetch([503], retries=3))
+
+    assert server_requests == 4
+    assert attempts == [0, 1, 2]
+    # zero delays are aiohttp internals
+    assert [delay for delay in delays if delay] == [0.5, 1.0, 2.0]
+
+
+PHONE_PATTERN = r'/ajax/misc/contact/multi_phone/'
+
+
+@pytest.mark.parametrize('path, status, requests', [
+    ('ajax/misc/contact/multi_phone/abc/1/', 404, 1),
+    ('ajax/misc/contact/multi_phone/abc/0/', 200, 1),
+    ('oferty/', 404, 2),
+    ('ajax/misc/contact/multi_phone/abc/1/', 429, 2),
+])
+def test_cached_statuses(tmpdir, path, status, requests):
+    async def scenario():
+        cache = ResponseCache(str(tmpdir.join('cache.db')), negative_patterns=(PHONE_PATTERN,))
+        async with Server([status]) as server:
+            session = GSession(retries=0, cache=cache)
+            responses = [await session.get(server.url + path) for _ in range(2)]
+            await session.close()
+        cache.close()
+        return [response.status for response in responses], server.requests
+
+    assert run(scenario()) == ([status, status], requests)
+
+
+def test_cache_hits_written_in_batches(tmpdir):
+    cache = ResponseCache(str(tmpdir.join('cache.db')))
+    cache.store('key', 'url', 'url', 200, 'body')
+    stored = cache.conn.execute('SELECT accessed FROM http_cache').fetchone()[0]
+    changes = cache.conn.total_changes
+    time.sleep(0.01)
+
+    assert cache.lookup('key', 'url')[0]
+    assert cache.conn.total_changes == changes
+
+    cache.flush()
+    assert cache.conn.execute('SELECT accessed FROM http_cache').fetchone()[0] > stored
+    assert not cache.accessed
+
+
+def test_endpoint_labels_without_rate_limiter():
+    async def scenario():
+        endpoints = EndpointClassifier((('phones', PHONE_PATTERN), ('search', r'')))
+        async with Server([200]) as server:
+            session = GSession(retries=0, endpoints=endpoints)
+            await session.get(server.url + 'ajax/misc/contact/multi_phone/abc/0/')
+            await session.get(server.url + 'oferty/')
+            await session.close()
+        return session.metrics.counters
+
+    counters = run(scenario())
+    assert counters[('http_responses', (('endpoint', 'phones'), ('status', 200)))] == 1
+    assert counters[('http_responses', (('endpoint', 'search'), ('status', 200)))] == 1
+
+
+def test_rate_gauge():
+    async def scenario():
+        limiter = RateLimiter(rate=10.0, decrease=0.5)
+        async with Server([503]) as server:
+            session = GSession(retries=0, rate_limiter=limiter)
+            await session.get(server.url)
+            await session.close()
+        return session.metrics.gauges, '127.0.0.1:{}'.format(server.port)
+
+    gauges, host = run(scenario())
+    assert gauges == {('request_rate', (('endpoint', 'default'), ('host', host))): 5.0}
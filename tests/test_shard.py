@@ -0,0 +1,49 @@
+from scraper import SHARD_PRICE_MAX, SearchShard, split_shard
+
+
+def test_split_by_year_first():
+    assert split_shard(SearchShard(1000, 2000, 2000, 2010)) == (
+        SearchShard(1000, 2000, 2000, 2005),
+        SearchShard(1000, 2000, 2006, 2010),
+    )
+    assert split_shard(SearchShard(0, 0, 2004, 2005)) == (
+        SearchShard(0, 0, 2004, 2004),
+        SearchShard(0, 0, 2005, 2005),
+    )
+
+
+def test_split_single_year_by_price():
+    # halves share the middle price
+    assert split_shard(SearchShard(1000, 2000, 2005, 2005)) == (
+        SearchShard(1000, 1500, 2005, 2005),
+        SearchShard(1500, 2000, 2005, 2005),
+    )
+
+
+def test_split_without_price_limit():
+    lower, upper = split_shard(SearchShard(0, 0, 2005, 2005))
+
+    assert lower == SearchShard(0, SHARD_PRICE_MAX // 2, 2005, 2005)
+    # upper half keeps no price limit, so articles above SHARD_PRICE_MAX are still found
+    assert upper == SearchShard(SHARD_PRICE_MAX // 2, 0, 2005, 2005)
+
+
+def test_split_stops_on_single_price():
+    assert split_shard(SearchShard(1000, 1001, 2005, 2005)) is None
+    assert split_shard(SearchShard(1000, 1000, 2005, 2005)) is None
+    assert split_shard(SearchShard(SHARD_PRICE_MAX, 0, 2005, 2005)) is None
+
+
+def test_split_down_to_single_year_and_price():
+    shards = [SearchShard(1000, 1004, 2004, 2005)]
+    leaves = []
+    while shards:
+        shard = shards.pop()
+        halves = split_shard(shard)
+        if halves is None:
+            leaves.append(shard)
+        else:
+            shards.extend(halves)
+
+    assert sorted(leaves) == [SearchShard(price, price + 1, year, year)
+                              for price in range(1000, 1004) for year in (2004, 2005)]
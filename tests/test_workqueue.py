@@ -0,0 +1,148 @@
+import asyncio
+import datetime
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import scraper
+from models import CrawlTask
+from utils import setup_db, checkpoint_get_or_create
+from workqueue import WorkQueue, DONE, FAILED, IN_FLIGHT, PENDING
+
+URLS = ['page={}'.format(i) for i in range(4)]
+
+
+@pytest.fixture
+def session():
+    session = setup_db(db_url='sqlite://')
+    yield session
+    session.close()
+    session.bind.dispose()
+
+
+@pytest.fixture
+def checkpoint_id(session):
+    checkpoint = checkpoint_get_or_create(session, {'search': 'test'})
+    session.commit()
+    return checkpoint.id
+
+
+def statuses(session) -> dict:
+    return dict(session.query(CrawlTask.url, CrawlTask.status).all())
+
+
+def test_lease_complete_fail(session, checkpoint_id):
+    queue = WorkQueue(session)
+    assert queue.enqueue(checkpoint_id, URLS + URLS[:1]) == 4
+    session.commit()
+
+    tasks = queue.lease('worker', 3)
+    assert [url for _, _, url in tasks] == URLS[:3]
+    assert {checkpoint for _, checkpoint, _ in tasks} == {checkpoint_id}
+    # leased pages aren't given to another worker
+    assert [url for _, _, url in queue.lease('other', 3)] == URLS[3:]
+
+    queue.complete([tasks[0][0]])
+    queue.fail([tasks[1][0]])
+    session.commit()
+
+    assert statuses(session) == {URLS[0]: DONE, URLS[1]: PENDING, URLS[2]: IN_FLIGHT, URLS[3]: IN_FLIGHT}
+    assert queue.active(checkpoint_id) == 3
+
+
+def test_expired_lease(session, checkpoint_id):
+    queue = WorkQueue(session, lease_time=-1, max_attempts=2)
+    queue.enqueue(checkpoint_id, URLS[:1])
+    session.commit()
+
+    first = queue.lease('killed', 1)
+    # lease of killed worker expired, page is given to another one
+    second = queue.lease('worker', 1)
+    assert first == second
+    assert session.query(CrawlTask.lease_owner).scalar().startswith('worker/')
+
+    # attempts are used up by expired leases
+    assert queue.lease('worker', 1) == []
+    assert statuses(session) == {URLS[0]: FAILED}
+
+
+def test_fail_attempts_cap(session, checkpoint_id):
+    queue = WorkQueue(session, max_attempts=2)
+    queue.enqueue(checkpoint_id, URLS[:1])
+    session.commit()
+
+    for status in (PENDING, FAILED):
+        task_id = queue.lease('worker', 1)[0][0]
+        queue.fail([task_id])
+        session.commit()
+        assert statuses(session) == {URLS[0]: status}
+
+    assert queue.lease('worker', 1) == []
+    assert not queue.active()
+
+
+def test_resume(session, checkpoint_id):
+    queue = WorkQueue(session, max_attempts=1)
+    queue.enqueue(checkpoint_id, URLS)
+    session.commit()
+
+    done, failed, in_flight = queue.lease('worker', 3)
+    queue.complete([done[0]])
+    queue.fail([failed[0]])
+    session.commit()
+    assert statuses(session) == {URLS[0]: DONE, URLS[1]: FAILED, URLS[2]: IN_FLIGHT, URLS[3]: PENDING}
+
+    assert queue.enqueue(checkpoint_id, URLS, resume=True) == 0
+    session.commit()
+
+    # done page is kept, the rest is crawled again with attempts reset
+    assert [url for _, _, url in queue.lease('worker', 10)] == URLS[1:]
+    assert statuses(session)[URLS[0]] == DONE
+    assert {attempts for attempts, in session.query(CrawlTask.attempts).filter(CrawlTask.status == IN_FLIGHT)} == {1}
+
+
+def test_enqueue_without_resume(session, checkpoint_id):
+    queue = WorkQueue(session, max_attempts=1)
+    queue.enqueue(checkpoint_id, URLS)
+    session.commit()
+
+    done, failed = queue.lease('worker', 2)
+    queue.complete([done[0]])
+    queue.fail([failed[0]])
+    session.commit()
+
+    # finished pages are crawled again, unfinished ones are kept
+    assert queue.enqueue(checkpoint_id, URLS) == 2
+    session.commit()
+    assert statuses(session) == {url: PENDING for url in URLS}
+
+
+def test_lease_retried_on_locked_db(monkeypatch, session, checkpoint_id):
+    queue = WorkQueue(session)
+    queue.enqueue(checkpoint_id, URLS[:1])
+    session.commit()
+
+    lease = queue.lease
+    calls = []
+
+    def locked_lease(owner, count):
+        calls.append(owner)
+        if len(calls) == 1:
+            raise OperationalError('UPDATE crawl_queue', {}, Exception('database is locked'))
+        return lease(owner, count)
+
+    async def sleep(delay):
+        pass
+
+    monkeypatch.setattr(queue, 'lease', locked_lease)
+    monkeypatch.setattr('scraper.asyncio.sleep', sleep)
+    worker = scraper.Scraper(0, 0, datetime.datetime(2000, 1, 1), datetime.datetime(2010, 1, 1), 0, 0, '', 1)
+
+    loop = asyncio.new_event_loop()
+    try:
+        tasks = loop.run_until_complete(worker.lease_tasks(session, queue, 'worker'))
+    finally:
+        loop.close()
+
+    assert len(calls) == 2
+    assert [url for _, _, url in tasks] == URLS[:1]
@@ -1,27 +1,141 @@
 import os
+import hashlib
 import sqlalchemy
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import bindparam, event, text
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.schema import CreateColumn
 import sqlite3
 import json
 import requests
 import datetime
+import logging
+import numpy as np
 import pytz
+import time
 
-from models import CarArticle, Base, Phone
+from models import CarArticle, Base, Phone, QueryCheckpoint, Dictionary
 
+logger = logging.getLogger(__name__)
 
-#  DB utils
-def setup_db(echo=False):
-    engine = sqlalchemy.create_engine('sqlite:///db\\otomoto.db', echo=echo)
 
+#  DB utils
+DB_URL = 'sqlite:///db\\otomoto.db'
+
+
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 256 * 1024 * 1024),
+    # negative value is cache size in KiB
+    ('cache_size', -64 * 1024),
+)
+
+
+def sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS:
+        cursor.execute('PRAGMA {}={}'.format(name, value))
+    cursor.close()
+
+
+# indexes replaced by newer ones
+OBSOLETE_INDEXES = (
+    ('car_article', 'ix_car_article_manufacturer_year'),
+    ('car_article', 'ix_car_article_record_created'),
+)
+
+
+def check_schema(engine):
+    """
+    DB files with string article ids should be converted by migrate.py, checked before any table is created,
+    so such file is left as it was.
+    """
+    inspector = sqlalchemy.inspect(engine)
+    if CarArticle.__tablename__ not in inspector.get_table_names():
+        return
+
+    article_columns = {column['name'] for column in inspector.get_columns(CarArticle.__tablename__)}
+    if 'manufacturer_id' not in article_columns:
+        raise RuntimeError('DB {} has old car_article schema. '
+                           'Convert it with: python migrate.py <old db file> <new db file>'.format(engine.url))
+
+
+def migrate_db(engine):
+    """
+    Create columns and indexes declared in models that are missing in DB file created by older version
+    and drop obsolete indexes.
+    """
+    inspector = sqlalchemy.inspect(engine)
+
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                with engine.begin() as connection:
+                    connection.execute(text('ALTER TABLE {} ADD COLUMN {}'.format(
+                        table.name, CreateColumn(column).compile(engine))))
+
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
+    for table_name, index_name in OBSOLETE_INDEXES:
+        if index_name in {index['name'] for index in inspector.get_indexes(table_name)}:
+            with engine.begin() as connection:
+                connection.execute(text('DROP INDEX {}'.format(index_name)))
+
+
+def setup_db(echo=False, db_url=DB_URL, tune=True, raw_insert=False):
+    """
+    :param tune: set SQLITE_PRAGMAS on every connection
+    :param raw_insert: insert new articles and phones with sqlite3 executemany, bypassing SQLAlchemy
+    """
+    engine = sqlalchemy.create_engine(db_url, echo=echo)
+    if tune and engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', sqlite_pragmas)
+    if raw_insert and engine.dialect.name != 'sqlite':
+        raise ValueError('Raw insert works only with SQLite, not {}'.format(engine.dialect.name))
+
+    check_schema(engine)
     Base.metadata.create_all(engine, checkfirst=True)
+    migrate_db(engine)
 
     Session = sessionmaker(bind=engine)
     session = Session()
+    # read by scraper.db_write
+    session.info['raw_insert'] = raw_insert
 
     return session
 
 
+def sqlite_upsert(table, conflict_columns, update_columns):
+    """
+    INSERT ... ON CONFLICT DO UPDATE statement (SQLite 3.24+) with all table columns as bind parameters,
+    for executemany. Conflicting row is updated only if any of update_columns differs.
+
+    :param table: sqlalchemy Table
+    :param conflict_columns: columns of primary key or unique constraint
+    :param update_columns: columns taken from the new row on conflict
+    """
+    if sqlite3.sqlite_version_info < (3, 24, 0):
+        raise RuntimeError('SQLite {} has no ON CONFLICT upsert, 3.24+ is required'.format(sqlite3.sqlite_version))
+
+    columns = [column.name for column in table.columns]
+    statement = text(
+        'INSERT INTO {table} ({columns}) VALUES ({values}) '
+        'ON CONFLICT ({conflict}) DO UPDATE SET {updates} WHERE {changed}'.format(
+            table=table.name,
+            columns=', '.join(columns),
+            values=', '.join(':' + column for column in columns),
+            conflict=', '.join(conflict_columns),
+            updates=', '.join('{0} = excluded.{0}'.format(column) for column in update_columns),
+            changed=' OR '.join('{0}.{1} IS NOT excluded.{1}'.format(table.name, column)
+                                for column in update_columns),
+        ))
+    return statement.bindparams(*[bindparam(column.name, type_=column.type) for column in table.columns])
+
+
 def tear_up():
     if not os.path.exists('db\\otomoto.db'):
         conn = sqlite3.connect("db\\otomoto.db")
@@ -38,35 +152,190 @@ def meta_get_or_create(session, model, **kwargs):
         return instance
 
 
+class DictionaryCache(object):
+    """
+    In-memory copy of dictionary table. Missing values are inserted on first use.
+    Cache is dropped on rollback, as codes inserted in the rolled back transaction don't exist anymore.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.codes = {(kind, value): code for code, kind, value in
+                      session.query(Dictionary.id, Dictionary.kind, Dictionary.value)}
+
+    @classmethod
+    def of(cls, session):
+        """
+        Cache bound to session, created on first call.
+        """
+        if 'dictionary' not in session.info:
+            session.info['dictionary'] = cls(session)
+        return session.info['dictionary']
+
+    def code(self, kind, value):
+        if value is None:
+            return None
+        code = self.codes.get((kind, value))
+        if code is None:
+            # value could be inserted by another session after the cache was loaded
+            self.session.execute(Dictionary.__table__.insert().prefix_with('OR IGNORE', dialect='sqlite'),
+                                 {'kind': kind, 'value': value})
+            code = self.session.query(Dictionary.id).filter_by(kind=kind, value=value).scalar()
+            self.codes[(kind, value)] = code
+        return code
+
+
+@event.listens_for(Session, 'after_rollback')
+def reset_dictionary_cache(session):
+    session.info.pop('dictionary', None)
+
+
+def checkpoint_get_or_create(session, payload):
+    query = json.dumps(payload, sort_keys=True)
+    query_hash = hashlib.md5(query.encode()).hexdigest()
+
+    instance = session.query(QueryCheckpoint).filter_by(query_hash=query_hash).first()
+    if instance:
+        return instance
+    else:
+        instance = QueryCheckpoint(query_hash=query_hash, query=query)
+        session.add(instance)
+        return instance
+
+
 # Currency utils
-def get_pln_rates(base_cur='pln'):
-    resp = requests.get('https://api.fixer.io/latest?base={}'.format(base_cur))
-    if resp.status_code == 200:
-        rates = json.loads(resp.text)
+RATES_CACHE_DIR = 'db'
 
-        def inner(amount, cur_to):
-            rate = rates['rates'][cur_to.upper()]
-            return round(rate * amount, 2)
-        return inner
-    raise AttributeError('Failed to get currency rates. Check connection.')
+
+def fixer_source(base_cur='pln'):
+    def source():
+        resp = requests.get('https://api.fixer.io/latest?base={}'.format(base_cur))
+        if resp.status_code == 200:
+            return json.loads(resp.text)
+        raise AttributeError('Failed to get currency rates. Check connection.')
+    return source
 
 
-def get_ukr_rates():
-    indexes = {'USD': 6, 'EUR': 5}
+def bank_ua_source():
     resp = requests.get('http://bank-ua.com/export/exchange_rate_cash.json')
     if resp.status_code == 200:
-        rates = json.loads(resp.text)
-        print(rates)
-        def inner(amount, cur_from, buy=True):
-            conversion_type = 'rateBuy'
-            if buy:
-                conversion_type = 'rateSale'
-            rate = float(rates[indexes[cur_from.upper()]][conversion_type])
-            return round(rate * amount, 2)
-        return inner
+        return json.loads(resp.text)
     raise AttributeError('Failed to get currency rates. Check connection.')
 
 
+class RatesProvider(object):
+    """
+    Currency rates loaded from source on first use and cached on disk.
+    Cached rates are used while they are younger than ttl; if source fails,
+    the last known rates are used whatever their age.
+    """
+
+    def __init__(self, name, source, cache_dir=RATES_CACHE_DIR, ttl=24 * 3600):
+        """
+        :param name: cache file name prefix
+        :param source: callable returning JSON-compatible rates data
+        :param cache_dir: cache directory, cache is disabled if None
+        :param ttl: cached rates lifetime in seconds
+        """
+        self.name = name
+        self.source = source
+        self.cache_path = os.path.join(cache_dir, 'rates_{}.json'.format(name)) if cache_dir else None
+        self.ttl = ttl
+        self._data = None
+
+    def data(self):
+        if self._data is None:
+            self._data = self.load()
+        return self._data
+
+    def load(self):
+        cached = self.read_cache()
+        if cached and time.time() - cached['timestamp'] < self.ttl:
+            return cached['data']
+
+        try:
+            data = self.source()
+        except Exception as err:
+            if cached:
+                logger.warning('Failed to get {} rates ({}). Rates from {} are used.'.format(
+                    self.name, err, datetime.datetime.fromtimestamp(cached['timestamp'])))
+                return cached['data']
+            raise
+
+        self.write_cache(data)
+        return data
+
+    def read_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return None
+        try:
+            with open(self.cache_path, encoding='utf-8') as cache_file:
+                cached = json.load(cache_file)
+            # valid JSON of other structure (e.g. written by hand) is broken cache too
+            return {'timestamp': float(cached['timestamp']), 'data': cached['data']}
+        except (ValueError, KeyError, TypeError):
+            logger.warning('Broken rates cache {} is ignored.'.format(self.cache_path))
+            return None
+
+    def write_cache(self, data):
+        if not self.cache_path:
+            return
+        with open(self.cache_path, 'w', encoding='utf-8') as cache_file:
+            json.dump({'timestamp': time.time(), 'data': data}, cache_file)
+
+
+class PlnRates(object):
+    """
+    Conversion from base currency by fixer.io rates: cur_pln(amount, 'eur')
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def rate(self, cur_to):
+        return self.provider.data()['rates'][cur_to.upper()]
+
+    def __call__(self, amount, cur_to):
+        rate = self.rate(cur_to)
+        return round(rate * amount, 2)
+
+
+class UkrRates(object):
+    """
+    Conversion to UAH by bank-ua.com cash rates: cur_ukr(amount, 'eur')
+    """
+
+    INDEXES = {'USD': 6, 'EUR': 5}
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def rate(self, cur_from, buy=True):
+        conversion_type = 'rateBuy'
+        if buy:
+            conversion_type = 'rateSale'
+        return float(self.provider.data()[self.INDEXES[cur_from.upper()]][conversion_type])
+
+    def __call__(self, amount, cur_from, buy=True):
+        rate = self.rate(cur_from, buy=buy)
+        return round(rate * amount, 2)
+
+
+def get_pln_rates(base_cur='pln', source=None, cache_dir=RATES_CACHE_DIR, ttl=24 * 3600):
+    """
+    Rates are loaded on first conversion. source allows to replace fixer.io (e.g. by local stub).
+    """
+    return PlnRates(RatesProvider('fixer_{}'.format(base_cur), source or fixer_source(base_cur),
+                                  cache_dir=cache_dir, ttl=ttl))
+
+
+def get_ukr_rates(source=None, cache_dir=RATES_CACHE_DIR, ttl=24 * 3600):
+    """
+    Rates are loaded on first conversion. source allows to replace bank-ua.com (e.g. by local stub).
+    """
+    return UkrRates(RatesProvider('bank_ua', source or bank_ua_source, cache_dir=cache_dir, ttl=ttl))
+
+
 def excises_benzine(capacity, year):
     cur_year = datetime.datetime.now(tz=pytz.utc).year
 
@@ -152,3 +421,65 @@ def get_cc_value(value, capacity, engine_type, year, cur_obj):
     pension_fee = get_pension_fee(cur_obj, value + excise + customs_duty)
 
     return calculated_value + pension_fee
+
+
+# Vectorized versions of pricing utils above. They take numpy arrays (or pandas Series)
+# and keep the same branch order and arithmetic, so results are equal to scalar ones.
+def excises_vector(capacity, year, engine_type):
+    """
+    excises_benzine or excises_diesel by engine_type for every element.
+    Other engine types get NaN (get_cc_value raises KeyError for them).
+    """
+    cur_year = datetime.datetime.now(tz=pytz.utc).year
+
+    capacity = np.asarray(capacity, dtype=float)
+    engine_type = np.asarray(engine_type, dtype=object)
+    new = (cur_year - np.asarray(year)) < 7
+    c = capacity
+
+    benzine_rate = np.where(
+        new,
+        np.select([c < 1.0, (1.0 <= c) & (c <= 1.5), (1.5 < c) & (c <= 2.2), (2.2 < c) & (c <= 3)],
+                  [0.102, 0.063, 0.267, 0.276], 2.209),
+        np.select([c < 1.0, (1.0 < c) & (c < 1.5), (1.5 < c) & (c < 2.2), (2.2 < c) & (c < 3)],
+                  [1.094, 1.367, 1.643, 2.213], 3.329)
+    )
+    diesel_rate = np.where(
+        new,
+        np.select([c < 1.5, (1.5 <= c) & (c <= 2.5)], [0.103, 0.327], 2.209),
+        np.select([c < 1.5, (1.5 <= c) & (c <= 2.5)], [1.367, 1.923], 2.779)
+    )
+
+    rate = np.select([engine_type == 'benzine', engine_type == 'diesel'], [benzine_rate, diesel_rate], np.nan)
+
+    return (rate * capacity) * 1000
+
+
+def pension_fee_vector(eur_rate, value):
+    """
+    get_pension_fee for every element, eur_rate is the rate used by currency object.
+    """
+    value = np.asarray(value, dtype=float)
+    ua_value = np.round(eur_rate * value, 2)
+
+    rate = np.select([ua_value < 267960, (267960 <= ua_value) & (ua_value <= 470960)], [0.03, 0.04], 0.05)
+
+    return value * rate
+
+
+def cc_value_vector(value, capacity, engine_type, year, eur_rate):
+    value = np.asarray(value, dtype=float)
+
+    # 10% for customs duty fee
+    customs_duty = value * 0.1
+
+    # excises
+    excise = excises_vector(capacity, year, engine_type)
+
+    # 20% for VAT fee
+    vat = (value + customs_duty + excise) * 0.2
+
+    calculated_value = excise + customs_duty + vat
+    pension_fee = pension_fee_vector(eur_rate, value + excise + customs_duty)
+
+    return calculated_value + pension_fee
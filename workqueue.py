@@ -0,0 +1,135 @@
+"""
+Durable queue of search pages in crawl_queue table. Coordinator puts pages of a search to it,
+worker processes (on this or other hosts with access to the same DB) lease them, crawl and mark
+as done. Pages of a killed worker become available again when their lease expires.
+
+The queue is also the persisted frontier of a crawl: pages are marked as done in the transaction
+that commits their articles, so interrupted crawl could be resumed without crawling them again.
+"""
+import datetime
+import uuid
+from sqlalchemy import and_, or_, func
+
+from models import CrawlTask, QueryCheckpoint
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class WorkQueue(object):
+
+    def __init__(self, session, lease_time=300, max_attempts=3):
+        """
+        :param session: DB session
+        :param lease_time: seconds before leased page is given to another worker
+        :param max_attempts: page is marked as failed after this number of failed or expired leases
+        """
+        self.session = session
+        self.table = CrawlTask.__table__
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+
+    def enqueue(self, checkpoint_id: int, urls: list, resume: bool = False) -> int:
+        """
+        Add pages of search. Pages finished by previous crawl of the same search are removed,
+        unfinished ones are kept. Commit is left to the caller.
+
+        :param resume: continue interrupted crawl - done pages are kept and not crawled again, failed pages
+        and pages leased by processes of that crawl are returned to queue with attempts reset
+        :return: (int) number of added pages
+        """
+        table = self.table
+        search = table.c.checkpoint_id == checkpoint_id
+        if resume:
+            self.session.execute(table.update().where(and_(search, table.c.status.in_((IN_FLIGHT, FAILED))))
+                                 .values(status=PENDING, lease_owner=None, lease_expires=None, attempts=0))
+        else:
+            self.session.execute(table.delete().where(and_(search, table.c.status.in_((DONE, FAILED)))))
+
+        known = {url for url, in self.session.query(CrawlTask.url).filter(CrawlTask.checkpoint_id == checkpoint_id)}
+        rows = [{'checkpoint_id': checkpoint_id, 'url': url, 'status': PENDING, 'attempts': 0}
+                for url in dict.fromkeys(urls) if url not in known]
+        if rows:
+            self.session.execute(table.insert(), rows)
+
+        return len(rows)
+
+    def lease(self, owner: str, count: int) -> list:
+        """
+        Take up to count pending pages or pages with expired lease. Pages are taken by one UPDATE,
+        so concurrent workers never get the same page. Commits.
+
+        :param owner: worker name
+        :return: (list) (task id, checkpoint id, url) tuples
+        """
+        table = self.table
+        now = datetime.datetime.utcnow()
+        expired = and_(table.c.status == IN_FLIGHT, table.c.lease_expires < now)
+
+        # pages that used up their attempts
+        self.session.execute(table.update().where(and_(expired, table.c.attempts >= self.max_attempts))
+                             .values(status=FAILED, lease_owner=None))
+
+        available = or_(table.c.status == PENDING, expired)
+        candidates = self.session.query(CrawlTask.id).filter(available).order_by(CrawlTask.id).limit(count)
+        token = '{}/{}'.format(owner, uuid.uuid4().hex)
+        self.session.execute(table.update().where(and_(table.c.id.in_(candidates), available)).values(
+            status=IN_FLIGHT,
+            lease_owner=token,
+            lease_expires=now + datetime.timedelta(seconds=self.lease_time),
+            attempts=table.c.attempts + 1,
+        ))
+        self.session.commit()
+
+        return self.session.query(CrawlTask.id, CrawlTask.checkpoint_id, CrawlTask.url)\
+            .filter(CrawlTask.lease_owner == token).all()
+
+    def complete(self, task_ids: list):
+        """
+        Commit is left to the caller, so pages are marked together with their articles.
+        """
+        if task_ids:
+            self.session.execute(self.table.update().where(self.table.c.id.in_(task_ids))
+                                 .values(status=DONE, lease_owner=None, lease_expires=None))
+
+    def fail(self, task_ids: list):
+        """
+        Return pages to queue or mark them as failed if attempts are used up. Commit is left to the caller.
+        """
+        if not task_ids:
+            return
+        table = self.table
+        leased = table.c.id.in_(task_ids)
+        self.session.execute(table.update().where(and_(leased, table.c.attempts >= self.max_attempts))
+                             .values(status=FAILED, lease_owner=None, lease_expires=None))
+        self.session.execute(table.update().where(and_(leased, table.c.attempts < self.max_attempts))
+                             .values(status=PENDING, lease_owner=None, lease_expires=None))
+
+    def progress(self, checkpoint_id: int, pages: int, inserted: int, updated: int):
+        """
+        Add counters of finished pages to the search checkpoint. Commit is left to the caller.
+        """
+        table = QueryCheckpoint.__table__
+        self.session.execute(table.update().where(table.c.id == checkpoint_id).values(
+            pages_crawled=func.coalesce(table.c.pages_crawled, 0) + pages,
+            articles_inserted=func.coalesce(table.c.articles_inserted, 0) + inserted,
+            prices_updated=func.coalesce(table.c.prices_updated, 0) + updated,
+        ))
+
+    def stats(self, checkpoint_id: int = None) -> dict:
+        """
+        :return: (dict) number of pages by status
+        """
+        query = self.session.query(CrawlTask.status, func.count(CrawlTask.id))
+        if checkpoint_id is not None:
+            query = query.filter(CrawlTask.checkpoint_id == checkpoint_id)
+        return dict(query.group_by(CrawlTask.status).all())
+
+    def active(self, checkpoint_id: int = None) -> int:
+        """
+        :return: (int) number of pending and in-flight pages
+        """
+        stats = self.stats(checkpoint_id)
+        return stats.get(PENDING, 0) + stats.get(IN_FLIGHT, 0)